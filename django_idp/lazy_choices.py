@@ -0,0 +1,42 @@
+class LazyChoices(list):
+    """ Field choices computed the first time they are used,
+        instead of at import time
+    """
+
+    def __init__(self, func):
+        super().__init__()
+        self._func = func
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            self.extend(self._func())
+
+    def __bool__(self):
+        # Field.__init__ tests choices, do not load them there
+        return True
+
+    def __iter__(self):
+        self._load()
+        return super().__iter__()
+
+    def __len__(self):
+        self._load()
+        return super().__len__()
+
+    def __getitem__(self, key):
+        self._load()
+        return super().__getitem__(key)
+
+    def __contains__(self, item):
+        self._load()
+        return super().__contains__(item)
+
+    def __eq__(self, other):
+        self._load()
+        return super().__eq__(other)
+
+    def __repr__(self):
+        self._load()
+        return super().__repr__()
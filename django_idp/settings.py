@@ -9,7 +9,6 @@ https://docs.djangoproject.com/en/2.0/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.0/ref/settings/
 """
-import ldap
 import os
 
 from .settingslocal import *
@@ -98,6 +97,7 @@ AUTHENTICATION_BACKENDS = [
 # LDAP, optional
 #################
 if 'ldap_peoples' in INSTALLED_APPS:
+    import ldap
     LDAP_BASEDN = 'dc='+',dc='.join(LDAP_BASE_DOMAIN.split('.'))
 
     # load default and overrides as you prefer
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_idp.settings")
 
 application = get_wsgi_application()
+
+# with uwsgi this runs in the master, before workers are forked
+from django.conf import settings
+if getattr(settings, 'SAML_IDP_WARMUP', False):
+    from uniauth.warmup import warm_up
+    warm_up()
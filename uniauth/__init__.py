@@ -1 +1 @@
-
+default_app_config = 'uniauth.apps.UniauthConfig'
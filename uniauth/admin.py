@@ -1,14 +1,24 @@
 import json
 
+from django import forms
 from django.contrib import admin
 from django.contrib import messages
+from django.core.paginator import Paginator
 from django.forms.utils import ErrorList
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import escape, format_html, format_html_join
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from . models import (AgreementRecord,
                       MetadataStore,
                       ServiceProvider)
+from . attribute_maps import converter_registry
+from . policy import compile_policy
+from . utils import get_idp_config
 
 
 def valida_elemento(modeladmin, request, queryset):
@@ -27,6 +37,16 @@ def valida_elemento(modeladmin, request, queryset):
 valida_elemento.short_description = _("Validate")
 
 
+def refresh_metadata(modeladmin, request, queryset):
+    from . metadata_refresh import metadata_refresher
+    for i in queryset.filter(type='remote'):
+        outcome = metadata_refresher.refresh(i, force=True)
+        level = messages.ERROR if outcome == 'failed' else messages.SUCCESS
+        messages.add_message(request, level, '{}: {} {}'.format(i.name, outcome,
+                                                                i.refresh_error or ''))
+refresh_metadata.short_description = _("Refresh remote metadata now")
+
+
 @admin.register(AgreementRecord)
 class AgreementRecordAdmin(admin.ModelAdmin):
     list_display = ('user',
@@ -41,24 +61,42 @@ class MetadataStoreAdmin(admin.ModelAdmin):
                     'type',
                     'is_valid',
                     'is_active',
+                    'is_stale',
                     'updated')
     list_filter = ('is_valid',
                    'is_active',
+                   'auto_federate',
                    'updated')
     search_fields = ('name', 'url')
     readonly_fields = ('created', 'updated', 'is_valid',
-                       'metadata_element_preview')
-    actions = (valida_elemento,)
+                       'metadata_element_preview',
+                       'local_copy', 'etag', 'last_modified', 'fetched',
+                       'valid_until', 'next_refresh', 'refresh_error',
+                       'changes_report', 'validation_report',
+                       'entities_link')
+    actions = (valida_elemento, refresh_metadata)
     list_editable = ('is_active',)
     fieldsets = (
                 (None, {'fields': (('name', 'type'),
                                    ('url', 'file'),
                                    'kwargs',
-                                   ('is_active', ),
+                                   ('is_active', 'auto_federate'),
                                    'is_valid',
                                    ('created', 'updated'),
-                                   'metadata_element_preview'
+                                   'metadata_element_preview',
+                                   'entities_link'
                                    )}),
+                (_('Remote refresh'), {'fields': (('fetched', 'next_refresh'),
+                                                  ('valid_until', 'local_copy'),
+                                                  ('etag', 'last_modified'),
+                                                  'refresh_error',
+                                                  'changes_report',
+                                                 ),
+                                       'classes': ('collapse',),
+                                      }),
+                (_('Validation'), {'fields': ('validation_report',),
+                                   'classes': ('collapse',),
+                                  }),
                 )
 
     class Media:
@@ -74,6 +112,79 @@ class MetadataStoreAdmin(admin.ModelAdmin):
         return  mark_safe(dumps.replace('\n', '<br>').replace('\s', '&nbsp'))
     metadata_element_preview.short_description = 'Metadata element preview'
 
+    def changes_report(self, obj):
+        if not obj.changes:
+            return
+        try:
+            report = json.loads(obj.changes)
+        except ValueError:
+            return obj.changes
+        # entityIDs come from remote metadata
+        dumps = escape(json.dumps(report, indent=4))
+        return  mark_safe(dumps.replace('\n', '<br>').replace(' ', '&nbsp'))
+    changes_report.short_description = 'Last refresh changes'
+
+    def validation_report(self, obj):
+        report = obj.validation_report()
+        files = report.get('files')
+        if not files:
+            return
+        invalid = [i for i in files if i['error']]
+        summary = format_html('{} files, {} invalid, {} unchanged since the previous '
+                              'validation, checked in {}s on {}',
+                              len(files), len(invalid), report.get('cached', 0),
+                              report.get('seconds'), report.get('date'))
+        # invalid files first
+        rows = format_html_join('\n', '<tr><td>{}</td><td>{}</td><td>{}</td></tr>',
+                                ((i['path'], i.get('entities', ''),
+                                  i['error'] or 'OK')
+                                 for i in invalid + [i for i in files if not i['error']]))
+        return format_html('<p>{}</p><table><tr><th>{}</th><th>{}</th><th>{}</th></tr>'
+                           '{}</table>', summary, _('File'), _('Entities'),
+                           _('Result'), rows)
+    validation_report.short_description = 'Last validation'
+
+    def entities_link(self, obj):
+        if not obj.pk:
+            return
+        return format_html('<a href="{}">{}</a>',
+                           reverse('admin:uniauth_metadatastore_entities', args=(obj.pk,)),
+                           _('Browse the loaded entities'))
+    entities_link.short_description = 'Entities'
+
+    def get_urls(self):
+        urls = [path('<int:object_id>/entities/',
+                     self.admin_site.admin_view(self.entities_view),
+                     name='uniauth_metadatastore_entities')]
+        return urls + super().get_urls()
+
+    def entities_view(self, request, object_id):
+        """ Paginated entities loaded from this store, searchable
+        """
+        from . entity_search import entity_search_cache
+
+        store = get_object_or_404(MetadataStore, pk=object_id)
+        query = request.GET.get('q', '')
+        index = entity_search_cache.get()
+        sources = {key for key in index.sources() if key and store.provides_source(key)}
+        records = index.search(query, limit=None, sources=sources)
+        page = Paginator(records, 50).get_page(request.GET.get('p'))
+        context = dict(self.admin_site.each_context(request),
+                       opts=self.model._meta,
+                       original=store,
+                       title=_('Entities of {}').format(store.name),
+                       query=query,
+                       page=page,
+                       total=len(records))
+        return TemplateResponse(request,
+                                'admin/uniauth/metadatastore/entities.html',
+                                context)
+
+    def is_stale(self, obj):
+        return obj.is_stale
+    is_stale.boolean = True
+    is_stale.short_description = 'Stale'
+
     def save_model(self, request, obj, form, change):
         res = False
         msg = ''
@@ -113,6 +224,7 @@ class ServiceProviderAdmin(admin.ModelAdmin):
     search_fields = ('entity_id', 'display_name', 'metadata_url')
     readonly_fields = ('created', 'updated',
                        'as_idpspconfig_dict_element_html',
+                       'effective_policy_html',
                        'is_valid')
     actions = (valida_elemento,)
     list_editable = ('is_active',)
@@ -136,6 +248,7 @@ class ServiceProviderAdmin(admin.ModelAdmin):
                                     }),
                 (_('Attributes preview'), {'fields': (
                                                         ('as_idpspconfig_dict_element_html',),
+                                                        ('effective_policy_html',),
                                                      ),
                                            'classes': ('collapse',),
                                             }),
@@ -143,13 +256,55 @@ class ServiceProviderAdmin(admin.ModelAdmin):
                 )
 
     class Media:
-        js = ('textarea_autosize.js',)
+        js = ('textarea_autosize.js', 'entity_search.js')
+
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name == 'entity_id':
+            kwargs['widget'] = forms.TextInput(attrs={
+                'class': 'vTextField entity-search',
+                'autocomplete': 'off',
+                'data-entity-search': reverse('admin:uniauth_serviceprovider_entity_search')})
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
+    def get_urls(self):
+        urls = [path('entity_search/',
+                     self.admin_site.admin_view(self.entity_search_view),
+                     name='uniauth_serviceprovider_entity_search')]
+        return urls + super().get_urls()
+
+    def entity_search_view(self, request):
+        """ SPs of the loaded metadata matching q, as JSON
+        """
+        from . entity_search import entity_search_cache
+
+        records = entity_search_cache.get().search(request.GET.get('q', ''),
+                                                   role='spsso_descriptor')
+        results = [{'id': record['entity_id'],
+                    'text': record['display_name'] or record['organization']}
+                   for record in records]
+        return JsonResponse({'results': results})
 
     def as_idpspconfig_dict_element_html(self, obj):
         return  mark_safe(json.dumps(obj.as_idpspconfig_dict_element(),
                                      indent=4).replace('\n', '<br>').replace('\s', '&nbsp'))
     as_idpspconfig_dict_element_html.short_description = 'SP config preview'
 
+    def effective_policy_html(self, obj):
+        if not obj.entity_id:
+            return
+        try:
+            policy = compile_policy(get_idp_config(), obj.entity_id)
+        except Exception as e:
+            return '{}'.format(e)
+        preview = policy.as_dict()
+        if policy.allowed is not None:
+            preview['attribute_names'] = {attr: converter_registry.lookup(attr)
+                                          for attr in sorted(policy.allowed)}
+        # entity categories come from remote metadata
+        dumps = escape(json.dumps(preview, indent=4))
+        return  mark_safe(dumps.replace('\n', '<br>').replace(' ', '&nbsp'))
+    effective_policy_html.short_description = 'Effective release policy'
+
     def save_model(self, request, obj, form, change):
         try:
             obj.validate()
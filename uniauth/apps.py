@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class UniauthConfig(AppConfig):
+    name = 'uniauth'
+    verbose_name = "uniAuth"
+
+    def ready(self):
+        from . import signals
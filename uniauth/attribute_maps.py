@@ -0,0 +1,221 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# eduPersonTargetedID, its values are NameIDs
+EPTID = 'urn:oid:1.3.6.1.4.1.5923.1.1.1.10'
+
+
+class AttributeConverterRegistry(object):
+    """ pysaml2 AttributeConverters of an attribute_map_dir,
+        built once per process and shared by every IdPConfig.load.
+        If SAML_IDP_ATTRIBUTE_MAP_CACHE is a file path the compiled
+        maps are also saved there, as JSON, and reused at the next startup
+        as long as the map files and pysaml2 version are the same.
+        The responses convert the released attributes with its
+        name -> URI tables, see from_local.
+    """
+
+    def __init__(self):
+        self._converters = {}
+        self._lookup = {}
+        # id(converter): (converter, {local name: attribute name})
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache_file(self):
+        return getattr(settings, 'SAML_IDP_ATTRIBUTE_MAP_CACHE', None)
+
+    def fingerprint(self, path):
+        """ Digest of the map files (name, size, mtime) and pysaml2 version
+        """
+        import saml2
+        digest = hashlib.sha256(getattr(saml2, '__version__', '').encode())
+        digest.update(path.encode())
+        if path:
+            for fname in sorted(os.listdir(path)):
+                if not fname.endswith('.py'):
+                    continue
+                stat = os.stat(os.path.join(path, fname))
+                digest.update('{}:{}:{}'.format(fname, stat.st_size,
+                                                stat.st_mtime_ns).encode())
+        return digest.hexdigest()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error('Unable to read attribute map cache {}: {}'.format(self.cache_file, e))
+            return {}
+        return cached if isinstance(cached, dict) else {}
+
+    def _store_cache(self, path, fingerprint, converters):
+        from saml2.attribute_converter import AttributeConverter
+
+        # only the maps are saved, as the dicts the map files define
+        maps = []
+        for converter in converters:
+            if type(converter) is not AttributeConverter:
+                return
+            maps.append({'identifier': converter.name_format,
+                         'to': converter._to,
+                         'fro': converter._fro})
+        cached = self._load_cache()
+        cached[path] = {'fingerprint': fingerprint, 'maps': maps}
+        tmp = '{}.{}'.format(self.cache_file, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp, self.cache_file)
+        except Exception as e:
+            logger.error('Unable to write attribute map cache {}: {}'.format(self.cache_file, e))
+
+    def _from_cache(self, cached):
+        from saml2.attribute_converter import AttributeConverter
+
+        converters = []
+        for mapdict in cached['maps']:
+            converter = AttributeConverter()
+            converter.from_dict(mapdict)
+            converters.append(converter)
+        return converters
+
+    def _build(self, path):
+        fingerprint = None
+        if self.cache_file:
+            fingerprint = self.fingerprint(path)
+            cached = self._load_cache().get(path)
+            if isinstance(cached, dict) and cached.get('fingerprint') == fingerprint:
+                try:
+                    converters = self._from_cache(cached)
+                except Exception as e:
+                    logger.error('Invalid attribute maps in {}: {}'.format(self.cache_file, e))
+                else:
+                    logger.debug('Attribute maps of {} loaded from {}'.format(path or 'pysaml2',
+                                                                             self.cache_file))
+                    return converters
+        from saml2.attribute_converter import ac_factory
+        converters = ac_factory(path)
+        if self.cache_file:
+            self._store_cache(path, fingerprint, converters)
+        return converters
+
+    def converters(self, path=""):
+        """ Same as saml2.attribute_converter.ac_factory(path)
+        """
+        path = os.path.abspath(path) if path else ""
+        converters = self._converters.get(path)
+        if converters is None:
+            with self._lock:
+                converters = self._converters.get(path)
+                if converters is None:
+                    converters = self._converters[path] = self._build(path)
+        # Config stores the list, the converters are shared
+        return list(converters)
+
+    def lookup(self, name, path=None, name_format=None):
+        """ (attribute name, name format) of a local attribute name,
+            eg: 'mail' -> ('urn:oid:0.9.2342.19200300.100.1.3',
+                           'urn:oasis:names:tc:SAML:2.0:attrname-format:uri')
+            None if no converter knows it
+        """
+        if path is None:
+            path = settings.SAML_IDP_CONFIG.get('attribute_map_dir', "")
+        key = (path, name.lower(), name_format)
+        try:
+            return self._lookup[key]
+        except KeyError:
+            pass
+        found = None
+        for converter in self.converters(path):
+            if name_format and converter.name_format != name_format:
+                continue
+            # friendly_name is set only if the converter knows the name
+            attr = converter.to_format(name.lower())
+            if attr.friendly_name:
+                found = (attr.name, converter.name_format)
+                break
+        self._lookup[key] = found
+        return found
+
+    def table(self, converter):
+        """ Local name -> attribute name table of a plain AttributeConverter,
+            None for the subclasses, that convert in their own way
+        """
+        from saml2.attribute_converter import AttributeConverter
+
+        entry = self._tables.get(id(converter))
+        if entry is not None and entry[0] is converter:
+            return entry[1]
+        if type(converter) is not AttributeConverter:
+            return
+        table = {k.lower(): v for k, v in (converter._to or {}).items()}
+        self._tables[id(converter)] = (converter, table)
+        return table
+
+    def from_local(self, acs, ava, name_format):
+        """ Same as saml2.attribute_converter.from_local, the Attributes
+            of the AttributeStatement of a response: the names are
+            taken from the precomputed tables and the Attributes are
+            built directly, not through saml2.s_utils.factory
+        """
+        from saml2 import saml
+        from saml2.s_utils import do_ava
+
+        for converter in acs:
+            if converter.name_format != name_format:
+                continue
+            table = self.table(converter)
+            if table is None:
+                return converter.to_(ava)
+            attributes = []
+            for key, value in ava.items():
+                name = table.get(key.lower())
+                if not name:
+                    attributes.append(saml.Attribute(name=key,
+                                                     attribute_value=do_ava(value)))
+                    continue
+                if name == EPTID:
+                    attr_value = converter.to_eptid_value(value)
+                else:
+                    attr_value = do_ava(value)
+                attributes.append(saml.Attribute(name=name,
+                                                 name_format=converter.name_format,
+                                                 friendly_name=key,
+                                                 attribute_value=attr_value))
+            return attributes
+
+    def clear(self):
+        with self._lock:
+            self._converters = {}
+            self._lookup = {}
+            self._tables = {}
+
+
+converter_registry = AttributeConverterRegistry()
+
+
+def install():
+    """ Makes pysaml2 Config.load_complex (and Policy, when it
+        has no converters) get the attribute converters from the registry,
+        and the Assertions convert the attributes with its tables.
+        Called before loading an IdPConfig, so that pysaml2 is
+        not imported at startup.
+    """
+    import saml2.assertion
+    import saml2.config
+    saml2.config.ac_factory = converter_registry.converters
+    if hasattr(saml2.assertion, 'ac_factory'):
+        saml2.assertion.ac_factory = converter_registry.converters
+    saml2.assertion.from_local = converter_registry.from_local
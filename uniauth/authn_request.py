@@ -0,0 +1,120 @@
+import hashlib
+import logging
+
+from . verification import verify_request_signature
+
+
+logger = logging.getLogger(__name__)
+
+
+def saml_request_digest(saml_request):
+    return hashlib.sha256(saml_request.encode()).hexdigest()
+
+
+def is_force_authn(message):
+    return str(message.force_authn).lower() in ('true', '1')
+
+
+class ParsedAuthnRequest(object):
+    """ What uniAuth needs of an AuthnRequest, parsed and verified
+        once in sso_entry and then stored in the session,
+        it only contains JSON serializable values.
+    """
+    session_key = 'authn_request'
+    fields = ('saml_request_digest',
+              'id',
+              'issuer',
+              'issue_instant',
+              'force_authn',
+              'name_id_policy',
+              'destination',
+              'binding',
+              'verified')
+
+    def __init__(self, **kwargs):
+        for field in self.fields:
+            setattr(self, field, kwargs.get(field))
+
+    @classmethod
+    def from_req_info(cls, IDP, req_info, saml_request):
+        """ Builds it from a pysaml2 AuthnRequest already parsed by
+            IDP.parse_authn_request, checks its signature and
+            computes the response arguments
+        """
+        try:
+            verified = verify_request_signature(IDP, req_info)
+        except Exception as e:
+            logger.debug('AuthnRequest signature check failed: {}'.format(e))
+            verified = False
+
+        message = req_info.message
+        resp_args = IDP.response_args(message)
+        name_id_policy = None
+        if message.name_id_policy:
+            name_id_policy = {'format': message.name_id_policy.format,
+                              'sp_name_qualifier': message.name_id_policy.sp_name_qualifier,
+                              'allow_create': message.name_id_policy.allow_create}
+        return cls(saml_request_digest=saml_request_digest(saml_request),
+                   id=message.id,
+                   issuer=message.issuer.text,
+                   issue_instant=message.issue_instant,
+                   force_authn=is_force_authn(message),
+                   name_id_policy=name_id_policy,
+                   destination=resp_args['destination'],
+                   binding=resp_args['binding'],
+                   verified=verified)
+
+    @classmethod
+    def parse(cls, IDP, saml_request, binding):
+        req_info = IDP.parse_authn_request(saml_request, binding)
+        return cls.from_req_info(IDP, req_info, saml_request)
+
+    @classmethod
+    def from_session(cls, request):
+        """ Returns the parsed request of the current SAML transaction,
+            None if missing or if it belongs to another SAMLRequest
+        """
+        data = request.session.get(cls.session_key)
+        saml_request = request.session.get('SAMLRequest')
+        if not data or not saml_request:
+            return None
+        if data.get('saml_request_digest') != saml_request_digest(saml_request):
+            return None
+        return cls(**data)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def store(self, request):
+        request.session[self.session_key] = self.as_dict()
+
+    @property
+    def resp_args(self):
+        """ The same dict that IDP.response_args would return
+        """
+        name_id_policy = None
+        if self.name_id_policy:
+            from saml2.samlp import NameIDPolicy
+            name_id_policy = NameIDPolicy(**self.name_id_policy)
+        return {'in_response_to': self.id,
+                'sp_entity_id': self.issuer,
+                'name_id_policy': name_id_policy,
+                'binding': self.binding,
+                'destination': self.destination}
+
+
+def get_authn_request(request, IDP):
+    """ Parsed AuthnRequest of this SAML transaction,
+        parses it only if it was not stored in sso_entry
+    """
+    from saml2 import BINDING_HTTP_POST
+
+    authn_request = ParsedAuthnRequest.from_session(request)
+    if authn_request:
+        return authn_request
+    binding = request.session.get('Binding', BINDING_HTTP_POST)
+    authn_request = ParsedAuthnRequest.parse(IDP,
+                                             request.session['SAMLRequest'],
+                                             binding)
+    authn_request.store(request)
+    return authn_request
@@ -0,0 +1,161 @@
+import sys
+import weakref
+
+from collections.abc import Mapping
+
+from django.conf import settings
+from saml2.mdstore import classnames
+
+
+# keys of the pysaml2 metadata dicts that are read when
+# an IdP answers an AuthnRequest, everything else is dropped
+KEPT_KEYS = frozenset(('__class__',
+                       'entity_id',
+                       # checked again when an entity is reused, see mdstore
+                       'valid_until',
+                       # roles
+                       'spsso_descriptor',
+                       'idpsso_descriptor',
+                       'attribute_authority_descriptor',
+                       'protocol_support_enumeration',
+                       'want_assertions_signed',
+                       'authn_requests_signed',
+                       # endpoints
+                       'assertion_consumer_service',
+                       'single_logout_service',
+                       'single_sign_on_service',
+                       'artifact_resolution_service',
+                       'binding',
+                       'location',
+                       'response_location',
+                       'index',
+                       'is_default',
+                       # certificates
+                       'key_descriptor',
+                       'use',
+                       'key_info',
+                       'key_name',
+                       'x509_data',
+                       'x509_certificate',
+                       # NameID and requested attributes
+                       'name_id_format',
+                       'attribute_consuming_service',
+                       'requested_attribute',
+                       'is_required',
+                       'name',
+                       'name_format',
+                       'friendly_name',
+                       # entity attributes, algorithms and registration
+                       'extensions',
+                       'extension_elements',
+                       'attribute',
+                       'attribute_value',
+                       'algorithm',
+                       'registration_authority',
+                       'registration_instant',
+                       'registration_policy',
+                       # names, for the entity search and the auto federation
+                       'organization',
+                       'organization_name',
+                       'organization_display_name',
+                       'display_name',
+                       'lang',
+                       'text'))
+
+KEPT_EXTENSIONS = frozenset((classnames['mdattr_entityattributes'],
+                             classnames['algsupport_signing_method'],
+                             classnames['algsupport_digest_method'],
+                             classnames['mdrpi_registration_info'],
+                             classnames['mdui_uiinfo']))
+
+# the nodes with the same keys share the same keys tuple
+_shapes = {}
+# identical nodes (certificates, requested attributes, entity categories...)
+# are stored once, while they are in use
+_nodes = weakref.WeakValueDictionary()
+
+
+def metadata_compact_enabled():
+    return getattr(settings, 'SAML_IDP_METADATA_COMPACT', False)
+
+
+class CompactNode(Mapping):
+    """ Read-only replacement of a pysaml2 metadata dict:
+        a keys tuple, shared by all the nodes of the same shape,
+        and a values tuple instead of a hash table.
+        Lists become tuples, strings are interned and identical
+        nodes are shared, so the bindings, the certificates and
+        the requested attributes are stored once
+    """
+    __slots__ = ('_keys', '_values', '__weakref__')
+    # nodes are unique, see compact()
+    __hash__ = object.__hash__
+
+    def __init__(self, keys, values):
+        self._keys = keys
+        self._values = values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return 'CompactNode({})'.format(dict(self))
+
+
+def compact(value):
+    """ Compact copy of a pysaml2 metadata value,
+        with only the KEPT_KEYS and KEPT_EXTENSIONS
+    """
+    if isinstance(value, dict):
+        keys, values = [], []
+        for key, item in value.items():
+            if key not in KEPT_KEYS:
+                continue
+            if key == 'extensions':
+                elements = [elem for elem in item.get('extension_elements', [])
+                            if elem.get('__class__') in KEPT_EXTENSIONS]
+                if not elements:
+                    continue
+                item = dict(item, extension_elements=elements)
+            keys.append(sys.intern(key))
+            values.append(compact(item))
+        keys = _shapes.setdefault(tuple(keys), tuple(keys))
+        values = tuple(values)
+        node = _nodes.get((keys, values))
+        if node is None:
+            node = CompactNode(keys, values)
+            _nodes[(keys, values)] = node
+        return node
+    elif isinstance(value, (list, tuple)):
+        return tuple(compact(item) for item in value)
+    elif isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def compact_metadata(md):
+    """ Compacts in place the entities already loaded
+        in a pysaml2 MetaData source
+    """
+    if type(md.entity) is not dict:
+        # lazy sources compact their entities when they load them
+        return
+    for entity_id, entity in md.entity.items():
+        md.entity[entity_id] = compact(entity)
+
+
+def compact_store(mds):
+    for md in mds.metadata.values():
+        compact_metadata(md)
@@ -0,0 +1,326 @@
+import copy
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from saml2.saml import SamlBase
+from saml2.sigver import (ASSERT_XPATH,
+                          CryptoBackend,
+                          EncryptError,
+                          RSACrypto,
+                          SecurityContext,
+                          SignatureError,
+                          XmlsecError,
+                          import_rsa_key_from_file,
+                          pre_encrypt_assertion)
+from saml2.sigver import security_context as pysaml2_security_context
+
+from . ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+# SAML_IDP_CONFIG['crypto_backend'] values handled by uniAuth,
+# the others ('xmlsec1', 'XMLSecurity') are left to pysaml2
+PYTHON_XMLSEC = 'python-xmlsec'
+
+DSIG_NS = 'http://www.w3.org/2000/09/xmldsig#'
+XENC_NS = 'http://www.w3.org/2001/04/xmlenc#'
+
+
+def crypto_key_cache_size():
+    return getattr(settings, 'SAML_IDP_CRYPTO_KEY_CACHE_SIZE', 256)
+
+
+def _xmlsec():
+    try:
+        import xmlsec
+        from lxml import etree
+    except ImportError as e:
+        raise ImproperlyConfigured('crypto_backend {} needs python-xmlsec and lxml: '
+                                   '{}'.format(PYTHON_XMLSEC, e))
+    return xmlsec, etree
+
+
+def _clark(node_name):
+    """ 'urn:oasis:names:tc:SAML:2.0:assertion:Assertion' ->
+        '{urn:oasis:names:tc:SAML:2.0:assertion}Assertion'
+    """
+    ns, _, name = node_name.rpartition(':')
+    return '{{{}}}{}'.format(ns, name) if ns else name
+
+
+class CryptoBackendPythonXmlSec(CryptoBackend):
+    """ pysaml2 CryptoBackend that signs, verifies and encrypts in this
+        process through python-xmlsec (libxmlsec1 bindings), with the same
+        semantics of the xmlsec1 command line used by CryptoBackendXmlSec1,
+        without forking it and without writing temporary files.
+        Keys and certificates are parsed once and kept in memory,
+        by content: pysaml2 passes the metadata certificates
+        in temporary files with a different name every time.
+    """
+
+    def __init__(self, key_cache_size=None):
+        CryptoBackend.__init__(self)
+        self.xmlsec, self.etree = _xmlsec()
+        self.keys = TTLCache(maxsize=key_cache_size or crypto_key_cache_size(),
+                             ttl=3600)
+        self.managers = TTLCache(maxsize=key_cache_size or crypto_key_cache_size(),
+                                 ttl=3600)
+
+    @property
+    def version(self):
+        return '.'.join(str(i) for i in self.xmlsec.get_libxmlsec_version())
+
+    def load_key(self, key_file, key_format):
+        """ xmlsec.Key of a PEM/DER file, parsed only the first time.
+            The contexts copy the key they use, the same Key is shared
+            by all the threads
+        """
+        with open(key_file, 'rb') as f:
+            data = f.read()
+        cache_key = (hashlib.sha256(data).digest(), key_format)
+        key = self.keys.get(cache_key)
+        if key is None:
+            key = self.xmlsec.Key.from_memory(data, key_format)
+            self.keys.set(cache_key, key)
+        return key
+
+    def keys_manager(self, key_file, key_format, name=None):
+        """ (KeysManager, Lock) with the key of key_file, named name,
+            for the EncryptedKey. A KeysManager costs much more than the
+            encryption, it's built once and used by a thread at a time
+        """
+        key = self.load_key(key_file, key_format)
+        cache_key = (key, name)
+        item = self.managers.get(cache_key)
+        if item is None:
+            if name:
+                # the cached key is shared
+                key = copy.copy(key)
+                key.name = name
+            manager = self.xmlsec.KeysManager()
+            manager.add_key(key)
+            item = (manager, threading.Lock())
+            self.managers.set(cache_key, item)
+        return item
+
+    def parse(self, xml):
+        if isinstance(xml, SamlBase):
+            xml = str(xml)
+        if not isinstance(xml, bytes):
+            xml = xml.encode('utf-8')
+        parser = self.etree.XMLParser(resolve_entities=False, no_network=True,
+                                      remove_comments=False)
+        return self.etree.fromstring(xml, parser=parser)
+
+    def serialize(self, root):
+        return self.etree.tostring(root.getroottree(), encoding='UTF-8',
+                                   xml_declaration=True).decode('utf-8')
+
+    def start_node(self, root, node_name, node_id):
+        """ The element node_id, of type node_name, with its ID registered,
+            as xmlsec1 --id-attr:ID node_name --node-id node_id does.
+            A duplicated ID is refused, it's a signature wrapping attempt
+        """
+        tag = _clark(node_name)
+        if not node_id:
+            # the first Signature of the document
+            for node in root.iter(tag):
+                self.xmlsec.tree.add_ids(node, ['ID'])
+            return root
+        nodes = [i for i in root.iter(tag) if i.get('ID') == node_id]
+        if len(nodes) != 1:
+            raise XmlsecError('{} {} elements with ID {}'.format(len(nodes), node_name, node_id))
+        node = nodes[0]
+        self.xmlsec.tree.add_ids(node, ['ID'])
+        return node
+
+    def signature_node(self, node):
+        signature = self.xmlsec.tree.find_node(node, self.xmlsec.constants.NodeSignature)
+        if signature is None:
+            raise XmlsecError('Signature not found')
+        return signature
+
+    def sign_statement(self, statement, node_name, key_file, node_id):
+        """ Fills the Signature template of the node_id element
+        """
+        try:
+            root = self.parse(statement)
+            signature = self.signature_node(self.start_node(root, node_name, node_id))
+            ctx = self.xmlsec.SignatureContext()
+            ctx.key = self.load_key(key_file, self.xmlsec.constants.KeyDataFormatPem)
+            ctx.sign(signature)
+        except (XmlsecError, self.xmlsec.Error, self.etree.XMLSyntaxError) as e:
+            raise SignatureError('{} {}: {}'.format(node_name, node_id, e))
+        return self.serialize(root)
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name, node_id):
+        """ True if the signature of the node_id element is valid for
+            cert_file, only same document references and only the given
+            certificate are allowed, as with xmlsec1
+            --enabled-reference-uris empty,same-doc --enabled-key-data raw-x509-cert.
+            XmlsecError if not valid, so that pysaml2 tries the next certificate
+        """
+        if cert_type == 'pem':
+            key_format = self.xmlsec.constants.KeyDataFormatCertPem
+        elif cert_type == 'der':
+            key_format = self.xmlsec.constants.KeyDataFormatCertDer
+        else:
+            raise SignatureError('Unsupported certificate type {}'.format(cert_type))
+        try:
+            root = self.parse(signedtext)
+        except self.etree.XMLSyntaxError as e:
+            raise SignatureError('{}'.format(e))
+        signature = self.signature_node(self.start_node(root, node_name, node_id))
+        for reference in signature.iter('{{{}}}Reference'.format(DSIG_NS)):
+            uri = reference.get('URI')
+            if uri and not uri.startswith('#'):
+                raise XmlsecError('Reference URI {} not allowed'.format(uri))
+        ctx = self.xmlsec.SignatureContext()
+        try:
+            ctx.key = self.load_key(cert_file, key_format)
+            ctx.verify(signature)
+        except self.xmlsec.Error as e:
+            raise XmlsecError('{} {}: {}'.format(node_name, node_id, e))
+        return True
+
+    def session_key(self, key_type):
+        """ A new session key, key_type as xmlsec1 --session-key: des-192, aes-256...
+        """
+        klass, _, size = key_type.partition('-')
+        key_data = {'des': self.xmlsec.constants.KeyDataDes,
+                    'aes': self.xmlsec.constants.KeyDataAes}.get(klass)
+        if key_data is None or not size.isdigit():
+            raise EncryptError('Unsupported session key {}'.format(key_type))
+        return self.xmlsec.Key.generate(key_data, int(size),
+                                        self.xmlsec.constants.KeyDataTypeSession)
+
+    def encrypt_assertion(self, statement, enc_key, template, key_type='des-192',
+                          node_xpath=None, node_id=None):
+        """ Replaces the element found by node_xpath (the Assertion
+            in the EncryptedAssertion) with the EncryptedData template,
+            the session key is encrypted with the certificate in enc_key
+        """
+        if isinstance(statement, SamlBase):
+            statement = pre_encrypt_assertion(statement)
+        try:
+            root = self.parse(statement)
+            start = root
+            if node_id:
+                nodes = [i for i in root.iter() if i.get('ID') == node_id]
+                start = nodes[0] if len(nodes) == 1 else None
+            nodes = start.xpath(node_xpath or ASSERT_XPATH) if start is not None else []
+            if not nodes:
+                raise EncryptError('Nothing to encrypt at {}'.format(node_xpath or ASSERT_XPATH))
+            node = nodes[0]
+            # the template has to be part of the same document
+            enc_data = self.parse(template)
+            node.addnext(enc_data)
+
+            key_name = enc_data.find('.//{{{0}}}EncryptedKey/{{{1}}}KeyInfo/{{{1}}}KeyName'.format(XENC_NS, DSIG_NS))
+            manager, lock = self.keys_manager(enc_key, self.xmlsec.constants.KeyDataFormatCertPem,
+                                              key_name.text if key_name is not None else None)
+            with lock:
+                ctx = self.xmlsec.EncryptionContext(manager)
+                ctx.key = self.session_key(key_type)
+                ctx.encrypt_xml(enc_data, node)
+        except EncryptError:
+            raise
+        except (self.xmlsec.Error, self.etree.XMLSyntaxError, OSError) as e:
+            raise EncryptError('{}'.format(e))
+        return self.serialize(root)
+
+    def decrypt(self, enctext, key_file):
+        """ Decrypts the first EncryptedData with the private key in key_file
+        """
+        try:
+            root = self.parse(enctext)
+            enc_data = self.xmlsec.tree.find_node(root, self.xmlsec.constants.NodeEncryptedData,
+                                                  self.xmlsec.constants.EncNs)
+            if enc_data is None:
+                raise XmlsecError('EncryptedData not found')
+            manager, lock = self.keys_manager(key_file, self.xmlsec.constants.KeyDataFormatPem)
+            with lock:
+                ctx = self.xmlsec.EncryptionContext(manager)
+                decrypted = ctx.decrypt(enc_data)
+        except (self.xmlsec.Error, self.etree.XMLSyntaxError) as e:
+            raise XmlsecError('{}'.format(e))
+        if decrypted.getparent() is None:
+            # the whole document was encrypted
+            return self.serialize(decrypted)
+        return self.serialize(root)
+
+
+def security_context(conf):
+    """ pysaml2 security_context that builds the in process backends,
+        the others are created by pysaml2
+    """
+    if not conf or getattr(conf, 'crypto_backend', None) != PYTHON_XMLSEC:
+        return pysaml2_security_context(conf)
+
+    try:
+        metadata = conf.metadata
+    except AttributeError:
+        metadata = None
+
+    sec_backend = None
+    key_file = conf.getattr('key_file', '')
+    if key_file:
+        # used by pysaml2 for the HTTP-Redirect binding signatures
+        try:
+            sec_backend = RSACrypto(import_rsa_key_from_file(key_file))
+        except Exception as e:
+            logger.error('Cannot import key from {}: {}'.format(key_file, e))
+            raise
+
+    enc_key_files = [i['key_file'] for i in conf.encryption_keypairs or []
+                     if 'key_file' in i]
+
+    return SecurityContext(
+        crypto_backend(),
+        conf.key_file,
+        cert_file=conf.cert_file,
+        metadata=metadata,
+        only_use_keys_in_metadata=conf.only_use_keys_in_metadata,
+        cert_handler_extra_class=conf.cert_handler_extra_class,
+        generate_cert_info=conf.generate_cert_info,
+        tmp_cert_file=conf.tmp_cert_file,
+        tmp_key_file=conf.tmp_key_file,
+        validate_certificate=conf.validate_certificate,
+        enc_key_files=enc_key_files,
+        encryption_keypairs=conf.encryption_keypairs,
+        sec_backend=sec_backend,
+        delete_tmpfiles=conf.delete_tmpfiles,
+    )
+
+
+_crypto_backend = None
+
+
+def crypto_backend():
+    """ One CryptoBackendPythonXmlSec per process, with its key cache
+    """
+    global _crypto_backend
+    if _crypto_backend is None:
+        _crypto_backend = CryptoBackendPythonXmlSec()
+    return _crypto_backend
+
+
+def install():
+    """ Makes pysaml2 Server, MetadataStore and metadata signing get
+        their SecurityContext from security_context, so that
+        SAML_IDP_CONFIG['crypto_backend'] can be 'python-xmlsec'.
+        Called before loading an IdPConfig, as attribute_maps.install
+    """
+    import saml2.entity
+    import saml2.mdstore
+    import saml2.metadata
+    import saml2.response
+    import saml2.sigver
+    for module in (saml2.sigver, saml2.entity, saml2.mdstore,
+                   saml2.metadata, saml2.response):
+        module.security_context = security_context
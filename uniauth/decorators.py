@@ -8,6 +8,7 @@ from django.utils.translation import gettext as _
 from django.shortcuts import render_to_response
 from saml2 import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
 
+from .authn_request import ParsedAuthnRequest, is_force_authn
 from .utils import repr_saml, get_idp_config
 
 
@@ -45,23 +46,29 @@ def store_params_in_session(request):
                                    'extra_message': _not_valid_saml_msg},
                                    status=403)
 
-    # try to parse an authn request to get force_authn if available
+    # parse and verify the authn request once, views will reuse it
+    authn_request = None
     try:
-        # force_authn check
         IDP = get_idp_config(settings.SAML_IDP_CONFIG)
         req_info = IDP.parse_authn_request(saml_request,
                                            binding)
-        if req_info.message.force_authn:
+        # force_authn check
+        if is_force_authn(req_info.message):
             logout(request)
 
         logger.info("SSO AuthnRequest: {} [{}]".format(req_info.message.issuer.text,
                                                        req_info.message.id))
         request.session['message_id'] = req_info.message.id
+        authn_request = ParsedAuthnRequest.from_req_info(IDP, req_info,
+                                                         saml_request)
     except Exception as e:
         # it's a SLO request...
         pass
     # end force_authn check
 
+    request.session.pop(ParsedAuthnRequest.session_key, None)
+    if authn_request:
+        authn_request.store(request)
     request.session['SAMLRequest'] = saml_request
     request.session['Binding'] = binding
     request.session['RelayState'] = passed_data.get('RelayState', '')
@@ -0,0 +1,406 @@
+import calendar
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+import time
+
+from collections.abc import MutableMapping
+from xml.parsers import expat
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT = '2'
+
+MD_NS = 'urn:oasis:names:tc:SAML:2.0:metadata'
+DS_NS = 'http://www.w3.org/2000/09/xmldsig#'
+SAML_NS = 'urn:oasis:names:tc:SAML:2.0:assertion'
+MDATTR_NS = 'urn:oasis:names:tc:SAML:metadata:attribute'
+MDUI_NS = 'urn:oasis:names:tc:SAML:metadata:ui'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+SCHEMA = ('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+          'CREATE TABLE entities (entity_id TEXT PRIMARY KEY, '
+          'sha256 TEXT, xml BLOB, summary TEXT)')
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def entity_index_enabled():
+    return getattr(settings, 'SAML_IDP_METADATA_INDEX', False)
+
+
+def entity_index_dir():
+    from . metadata_refresh import metadata_cache_dir
+    return getattr(settings, 'SAML_IDP_METADATA_INDEX_DIR',
+                   os.path.join(metadata_cache_dir(), 'index'))
+
+
+def entity_index_path(source):
+    name = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()
+    return os.path.join(entity_index_dir(), '{}.sqlite'.format(name))
+
+
+def source_fingerprint(source):
+    st = os.stat(source)
+    return '{}:{}'.format(st.st_size, st.st_mtime_ns)
+
+
+def _tag(ns, name):
+    return '{{{}}}{}'.format(ns, name)
+
+
+def entity_summary(xml):
+    """ Fields of an EntityDescriptor that can be read
+        without materializing it as a pysaml2 object
+    """
+    from defusedxml.ElementTree import fromstring
+
+    root = fromstring(xml)
+    summary = {'roles': [],
+               'acs': [],
+               'slo': [],
+               'certs': [],
+               'name_id_formats': [],
+               'entity_categories': [],
+               'requested_attributes': [],
+               'display_names': [],
+               'organization': []}
+    for child in root:
+        if child.tag.startswith(_tag(MD_NS, '')) and child.tag.endswith('Descriptor'):
+            summary['roles'].append(child.tag[len(MD_NS) + 2:])
+    for acs in root.iter(_tag(MD_NS, 'AssertionConsumerService')):
+        summary['acs'].append([acs.get('Binding'), acs.get('Location'), acs.get('index')])
+    for slo in root.iter(_tag(MD_NS, 'SingleLogoutService')):
+        summary['slo'].append([slo.get('Binding'), slo.get('Location')])
+    for kd in root.iter(_tag(MD_NS, 'KeyDescriptor')):
+        for cert in kd.iter(_tag(DS_NS, 'X509Certificate')):
+            summary['certs'].append([kd.get('use'), ''.join((cert.text or '').split())])
+    for spsso in root.iter(_tag(MD_NS, 'SPSSODescriptor')):
+        for fmt in spsso.iter(_tag(MD_NS, 'NameIDFormat')):
+            summary['name_id_formats'].append((fmt.text or '').strip())
+    for attrs in root.iter(_tag(MDATTR_NS, 'EntityAttributes')):
+        for value in attrs.iter(_tag(SAML_NS, 'AttributeValue')):
+            summary['entity_categories'].append((value.text or '').strip())
+    for name in root.iter(_tag(MDUI_NS, 'DisplayName')):
+        summary['display_names'].append([name.get(XML_LANG),
+                                         (name.text or '').strip()])
+    # of the entity, not of its roles, the last one as in pysaml2
+    for org in root.findall(_tag(MD_NS, 'Organization'))[-1:]:
+        for tag in ('OrganizationDisplayName', 'OrganizationName'):
+            for name in org.findall(_tag(MD_NS, tag)):
+                summary['organization'].append([name.get(XML_LANG),
+                                                (name.text or '').strip()])
+    for req in root.iter(_tag(MD_NS, 'RequestedAttribute')):
+        summary['requested_attributes'].append([req.get('Name'),
+                                                req.get('FriendlyName'),
+                                                req.get('isRequired') in ('true', '1')])
+    return summary
+
+
+class EntitySlicer(object):
+    """ Finds the EntityDescriptors of a metadata document with expat,
+        without building a tree, and returns their exact bytes
+        with the namespace declarations inherited from the ancestors.
+        If wanted is given, only those entityIDs are returned
+    """
+
+    def __init__(self, data, wanted=None):
+        self.data = data
+        self.wanted = wanted
+        self.valid_until = None
+        self.signed = False
+        # entityIDs of the whole document, in order
+        self.entity_ids = []
+        self.entities = []
+        self._ns = [{}]
+        self._depth = 0
+        self._start = None
+
+    def _refuse(self, *args):
+        raise ValueError('DTDs and entities are not allowed in metadata')
+
+    def _resolve(self, qname, ns):
+        prefix, _, local = qname.rpartition(':')
+        return ns.get(prefix), local
+
+    def start(self, name, attrs):
+        ns = self._ns[-1]
+        declared = {k[6:] if k.startswith('xmlns:') else '': v
+                    for k, v in attrs.items() if k == 'xmlns' or k.startswith('xmlns:')}
+        if declared:
+            ns = dict(ns, **declared)
+        self._ns.append(ns)
+        self._depth += 1
+        if self._start is not None:
+            return
+        uri, local = self._resolve(name, ns)
+        if uri == DS_NS and local == 'Signature' and self._depth == 2:
+            self.signed = True
+        if uri != MD_NS:
+            return
+        if local == 'EntitiesDescriptor' and self._depth == 1:
+            self.valid_until = attrs.get('validUntil')
+        elif local == 'EntityDescriptor':
+            self.entity_ids.append(attrs.get('entityID'))
+            if self.wanted is not None and attrs.get('entityID') not in self.wanted:
+                return
+            inherited = {k: v for k, v in self._ns[-2].items() if k not in declared}
+            self._start = (self.parser.CurrentByteIndex, self._depth, name,
+                           attrs.get('entityID'), inherited)
+
+    def end(self, name):
+        if self._start is not None and self._start[1] == self._depth:
+            offset, depth, qname, entity_id, inherited = self._start
+            end = self.data.find(b'>', self.parser.CurrentByteIndex) + 1
+            xml = bytes(self.data[offset:end])
+            if inherited:
+                decls = ''.join(' xmlns:{}="{}"'.format(k, v) if k else ' xmlns="{}"'.format(v)
+                                for k, v in inherited.items())
+                pos = 1 + len(qname.encode())
+                xml = xml[:pos] + decls.encode() + xml[pos:]
+            self.entities.append((entity_id, xml))
+            self._start = None
+        self._ns.pop()
+        self._depth -= 1
+
+    def parse(self):
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.StartDoctypeDeclHandler = self._refuse
+        self.parser.EntityDeclHandler = self._refuse
+        self.parser.Parse(self.data, True)
+        return self.entities
+
+
+def select_entities(data, wanted):
+    """ A metadata document with only the wanted EntityDescriptors.
+        Returns the document, whether the source was signed,
+        the entityIDs of the source and how many entities were kept
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    slicer = EntitySlicer(data, wanted)
+    slicer.parse()
+    head = '<md:EntitiesDescriptor xmlns:md="{}"'.format(MD_NS)
+    if slicer.valid_until:
+        head += ' validUntil="{}"'.format(slicer.valid_until)
+    xml = b''.join([head.encode(), b'>'] +
+                   [entity for entity_id, entity in slicer.entities] +
+                   [b'</md:EntitiesDescriptor>'])
+    return xml, slicer.signed, slicer.entity_ids, len(slicer.entities)
+
+
+class EntityIndex(object):
+    """ SQLite index of a metadata file, keyed by entityID.
+        It holds the raw bytes of each EntityDescriptor
+        and a summary of the fields used by uniAuth
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # sqlite connections are neither shared between threads
+        # nor inherited by forked workers
+        if getattr(self._local, 'pid', None) != os.getpid():
+            uri = 'file:{}?mode=ro'.format(self.path)
+            self._local.connection = sqlite3.connect(uri, uri=True)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key=?',
+                                      (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def valid_until(self):
+        value = self.meta('valid_until')
+        return float(value) if value else None
+
+    def raw(self, entity_id):
+        row = self.connection.execute('SELECT xml FROM entities WHERE entity_id=?',
+                                      (entity_id,)).fetchone()
+        return row[0] if row else None
+
+    def summary(self, entity_id):
+        row = self.connection.execute('SELECT summary FROM entities WHERE entity_id=?',
+                                      (entity_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def summaries(self):
+        """ (entity_id, summary) of all the entities, in document order
+        """
+        for entity_id, summary in self.connection.execute('SELECT entity_id, summary '
+                                                          'FROM entities ORDER BY rowid'):
+            yield entity_id, json.loads(summary)
+
+    def hashes(self):
+        return dict(self.connection.execute('SELECT entity_id, sha256 FROM entities'))
+
+    def entity_ids(self):
+        return [row[0] for row in
+                self.connection.execute('SELECT entity_id FROM entities ORDER BY rowid')]
+
+    def __contains__(self, entity_id):
+        return self.connection.execute('SELECT 1 FROM entities WHERE entity_id=?',
+                                       (entity_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+
+    def is_current(self, source):
+        try:
+            return self.meta('format') == INDEX_FORMAT and \
+                   self.meta('source_fingerprint') == source_fingerprint(source)
+        except (sqlite3.Error, OSError):
+            return False
+
+    @classmethod
+    def build(cls, source, path):
+        """ Writes the index of source in a temporary file,
+            then moves it in place
+        """
+        from saml2 import time_util
+
+        start = time.time()
+        fingerprint = source_fingerprint(source)
+        with open(source, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                slicer = EntitySlicer(data)
+                entities = slicer.parse()
+            finally:
+                data.close()
+
+        valid_until = None
+        if slicer.valid_until:
+            valid_until = calendar.timegm(time_util.str_to_time(slicer.valid_until))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}'.format(path, os.getpid())
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp)
+        try:
+            for statement in SCHEMA:
+                db.execute(statement)
+            rows = ((entity_id, hashlib.sha256(xml).hexdigest(), xml,
+                     json.dumps(entity_summary(xml)))
+                    for entity_id, xml in entities)
+            # the first occurrence wins, as in pysaml2
+            db.executemany('INSERT OR IGNORE INTO entities VALUES (?, ?, ?, ?)', rows)
+            db.executemany('INSERT INTO meta VALUES (?, ?)',
+                           (('format', INDEX_FORMAT),
+                            ('source', os.path.abspath(source)),
+                            ('source_fingerprint', fingerprint),
+                            ('valid_until', valid_until),
+                            ('built', time.time())))
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp, path)
+        logger.info('Metadata index of {}: {} entities in {:.2f}s'.format(source,
+                                                                        len(entities),
+                                                                        time.time() - start))
+        return cls(path)
+
+
+def get_entity_index(source, rebuild=False):
+    """ EntityIndex of a metadata file, built if missing or outdated.
+        Concurrent builders (uwsgi workers) are serialized by a file lock
+    """
+    path = entity_index_path(source)
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is not None and not rebuild and index.is_current(source):
+            return index
+        index = EntityIndex(path)
+        if rebuild or not index.is_current(source):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open('{}.lock'.format(path), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # another process may have built it meanwhile
+                    index = EntityIndex(path)
+                    if rebuild or not index.is_current(source):
+                        index = EntityIndex.build(source, path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        _indexes[path] = index
+    return index
+
+
+class LazyEntities(MutableMapping):
+    """ MetaData.entity of an indexed metadata: an EntityDescriptor
+        becomes a pysaml2 dict the first time it's requested
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        # entityID -> pysaml2 dict, None if it's not usable
+        self.materialized = {}
+        # entityIDs looked up but not in this metadata
+        self.absent = set()
+
+    def __getitem__(self, entity_id):
+        try:
+            entity = self.materialized[entity_id]
+        except KeyError:
+            if entity_id in self.absent:
+                raise
+            try:
+                entity = self.metadata.materialize(entity_id)
+            except KeyError:
+                self.absent.add(entity_id)
+                raise
+            self.materialized[entity_id] = entity
+        if entity is None:
+            raise KeyError(entity_id)
+        return entity
+
+    def __setitem__(self, entity_id, entity):
+        self.materialized[entity_id] = entity
+
+    def __delitem__(self, entity_id):
+        self[entity_id]
+        self.materialized[entity_id] = None
+
+    def __contains__(self, entity_id):
+        try:
+            self[entity_id]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        if self.metadata.index is None:
+            return iter(())
+        return iter([entity_id for entity_id in self.metadata.index.entity_ids()
+                     if entity_id in self])
+
+    def __len__(self):
+        # entities not yet parsed are counted as valid
+        if self.metadata.index is None:
+            return 0
+        if self.metadata.selection is not None:
+            return len([entity_id for entity_id in self.metadata.selection
+                        if entity_id in self])
+        dropped = sum(1 for entity in self.materialized.values() if entity is None)
+        return len(self.metadata.index) - dropped
+
+    def clear(self):
+        self.materialized = {}
+        self.absent = set()
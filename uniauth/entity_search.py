@@ -0,0 +1,232 @@
+import logging
+import threading
+import time
+
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+
+from saml2.mdstore import classnames
+
+from . mdq import CachingMetaDataMDX
+from . mdstore import MetaDataIndexed
+from . metadata_sidecar import MetaDataSidecar
+
+
+logger = logging.getLogger(__name__)
+
+UIINFO = classnames['mdui_uiinfo']
+ENTITY_ATTRIBUTES = classnames['mdattr_entityattributes']
+
+# EntityIndex summary roles as pysaml2 names them
+ROLES = {'SPSSODescriptor': 'spsso_descriptor',
+         'IDPSSODescriptor': 'idpsso_descriptor',
+         'AttributeAuthorityDescriptor': 'attribute_authority_descriptor',
+         'AuthnAuthorityDescriptor': 'authn_authority_descriptor',
+         'PDPDescriptor': 'pdp_descriptor',
+         'RoleDescriptor': 'role_descriptor'}
+
+
+def _pick(names, langpref='en'):
+    """ the text in langpref, or the first one, of [(lang, text)]
+    """
+    for lang, text in names:
+        if lang == langpref and text:
+            return text
+    for lang, text in names:
+        if text:
+            return text
+    return ''
+
+
+def _elements(node):
+    if not isinstance(node, Mapping):
+        return ()
+    return (node.get('extensions') or {}).get('extension_elements') or ()
+
+
+def entity_record(entity_id, entity, source=None):
+    """ What the search needs of a pysaml2 (or compacted) entity
+    """
+    roles = [key for key in entity if key.endswith('_descriptor') and entity[key]]
+    display_names = []
+    for role in roles:
+        for descriptor in entity[role]:
+            for elem in _elements(descriptor):
+                if elem.get('__class__') == UIINFO:
+                    display_names.extend((i.get('lang'), i.get('text'))
+                                         for i in elem.get('display_name') or ())
+    organization = []
+    org = entity.get('organization') or {}
+    for key in ('organization_display_name', 'organization_name'):
+        organization.extend((i.get('lang'), i.get('text')) for i in org.get(key) or ())
+    categories = []
+    for elem in _elements(entity):
+        if elem.get('__class__') == ENTITY_ATTRIBUTES:
+            for attr in elem.get('attribute') or ():
+                categories.extend(v.get('text') for v in attr.get('attribute_value') or ()
+                                  if v.get('text'))
+    return {'entity_id': entity_id,
+            'display_name': _pick(display_names),
+            'organization': _pick(organization),
+            'entity_categories': categories,
+            'roles': roles,
+            'source': source}
+
+
+def summary_record(entity_id, summary, source=None):
+    """ The same from an EntityIndex summary, without parsing the entity
+    """
+    return {'entity_id': entity_id,
+            'display_name': _pick(summary.get('display_names', [])),
+            'organization': _pick(summary.get('organization', [])),
+            'entity_categories': summary.get('entity_categories', []),
+            'roles': [ROLES.get(role, role.lower()) for role in summary.get('roles', [])],
+            'source': source}
+
+
+def bare_record(entity_id, source=None):
+    """ An entity not parsed, roles None as they are unknown
+    """
+    return {'entity_id': entity_id,
+            'display_name': '',
+            'organization': '',
+            'entity_categories': [],
+            'roles': None,
+            'source': source}
+
+
+def metadata_records(mds):
+    """ Records of the entities of a MetadataStore, the first occurrence
+        of an entityID wins as in pysaml2. The MDQ sources can't be
+        listed, indexed files are read from their summaries
+    """
+    records = []
+    seen = set()
+    for key, _md in mds.metadata.items():
+        if isinstance(_md, MetaDataSidecar):
+            items = _md.records()
+        elif isinstance(_md, CachingMetaDataMDX):
+            continue
+        elif isinstance(_md, MetaDataIndexed):
+            if _md.index is None:
+                continue
+            # also the entities left out by the selection, they can be federated
+            items = (summary_record(entity_id, summary, key)
+                     for entity_id, summary in _md.index.summaries())
+        else:
+            items = [entity_record(entity_id, entity, key)
+                     for entity_id, entity in _md.items()]
+            source_entities = getattr(_md, 'source_entities', None)
+            if source_entities:
+                # left out by the selection, only their entityID is known
+                items.extend(bare_record(entity_id, key) for entity_id in source_entities
+                             if entity_id not in _md.entity)
+        for record in items:
+            if record['entity_id'] in seen:
+                continue
+            seen.add(record['entity_id'])
+            records.append(record)
+    return records
+
+
+class EntitySearchIndex(object):
+    """ Prefix and substring search over entityID, display name,
+        organization and entity categories of the loaded entities.
+        entityIDs starting with the query come first, in order,
+        then the entities that contain it in any field.
+    """
+
+    def __init__(self, records):
+        self.records = sorted(records, key=lambda r: r['entity_id'].lower())
+        self._keys = [r['entity_id'].lower() for r in self.records]
+        # one line per entity, searched with str.find
+        lines = []
+        self._starts = []
+        offset = 0
+        for r in self.records:
+            line = '\t'.join([r['entity_id'], r['display_name'] or '',
+                              r['organization'] or ''] + r['entity_categories'])
+            line = line.lower().replace('\n', ' ')
+            self._starts.append(offset)
+            lines.append(line)
+            offset += len(line) + 1
+        self._text = '\n'.join(lines)
+
+    def __len__(self):
+        return len(self.records)
+
+    def sources(self):
+        return {r['source'] for r in self.records}
+
+    def search(self, query, limit=20, sources=None, role=None):
+        """ Records matching query, at most limit (None: all of them),
+            only of the given source keys if sources is not None
+            and only the entities with role (spsso_descriptor...) if given
+        """
+        query = (query or '').strip().lower()
+        results = []
+
+        def add(i):
+            record = self.records[i]
+            if (sources is None or record['source'] in sources) and \
+               (role is None or record['roles'] is None or role in record['roles']):
+                results.append(record)
+            return limit is not None and len(results) >= limit
+
+        if not query:
+            for i in range(len(self.records)):
+                if add(i):
+                    break
+            return results
+
+        found = set()
+        i = bisect_left(self._keys, query)
+        while i < len(self._keys) and self._keys[i].startswith(query):
+            found.add(i)
+            if add(i):
+                return results
+            i += 1
+
+        pos = self._text.find(query)
+        while pos != -1:
+            i = bisect_right(self._starts, pos) - 1
+            if i not in found and add(i):
+                break
+            # next entity
+            if i + 1 >= len(self._starts):
+                break
+            pos = self._text.find(query, self._starts[i + 1])
+        return results
+
+
+class EntitySearchCache(object):
+    """ Search index of the metadata served by the IdP Server of
+        this process, built the first time it's queried and again
+        when the metadata is reloaded or updated in place
+    """
+
+    def __init__(self):
+        self.index = None
+        self._mds = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get(self, IDP=None):
+        if IDP is None:
+            from . utils import get_idp_config
+            IDP = get_idp_config()
+        mds = IDP.metadata
+        generation = getattr(mds, 'generation', None)
+        if self._mds is mds and self._generation == generation:
+            return self.index
+        with self._lock:
+            if self._mds is not mds or self._generation != generation:
+                start = time.time()
+                self.index = EntitySearchIndex(metadata_records(mds))
+                self._mds, self._generation = mds, generation
+                logger.info('Entity search index: {} entities in '
+                            '{:.2f}s'.format(len(self.index), time.time() - start))
+        return self.index
+
+
+entity_search_cache = EntitySearchCache()
@@ -0,0 +1,79 @@
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from . models import ServiceProvider
+from . registry import get_sp_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+def auto_federate_entity_categories():
+    return getattr(settings, 'SAML_IDP_AUTO_FEDERATE_ENTITY_CATEGORIES', [])
+
+
+def auto_federation_reason(IDP, entity_id, registry):
+    """ Why entity_id can be federated on first use: the MetadataStore
+        with auto_federate or the entity category it comes from,
+        None if it can't
+    """
+    categories = auto_federate_entity_categories()
+    if not registry.auto_federate_stores and not categories:
+        return
+    try:
+        if not IDP.metadata.service(entity_id, 'spsso_descriptor',
+                                    'assertion_consumer_service'):
+            return
+    except Exception:
+        return
+    if registry.auto_federate_stores:
+        source = IDP.metadata.source(entity_id)
+        for store in registry.auto_federate_stores:
+            if source and store.provides_source(source):
+                return 'MetadataStore {}'.format(store.name)
+    if categories:
+        try:
+            entity_categories = IDP.metadata.entity_categories(entity_id)
+        except Exception:
+            entity_categories = []
+        for category in categories:
+            if category in entity_categories:
+                return 'entity category {}'.format(category)
+
+
+def auto_federate(IDP, entity_id):
+    """ Creates the ServiceProvider of a SP found in trusted metadata
+        the first time it sends a request, with the default processor
+        and attribute mapping. Returns True if entity_id is federated.
+        An existing row disabled by the administrators is not enabled again.
+    """
+    registry = get_sp_registry()
+    if entity_id in registry:
+        return True
+    reason = auto_federation_reason(IDP, entity_id, registry)
+    if reason is None:
+        return False
+
+    sp = ServiceProvider.objects.filter(entity_id=entity_id).first()
+    if sp is None:
+        sp = ServiceProvider(entity_id=entity_id,
+                             display_name=IDP.metadata.name(entity_id) or entity_id,
+                             description='Federated on first use from {}'.format(reason),
+                             is_active=True,
+                             is_valid=True)
+        # only this SP changed: no need to rebuild the IdP Server,
+        # the other workers add it to their registry on its first request
+        sp.auto_federated = True
+        try:
+            with transaction.atomic():
+                sp.save()
+            logger.info('SP {} federated on first use from {}'.format(entity_id, reason))
+        except IntegrityError:
+            # created meanwhile by another worker
+            sp = ServiceProvider.objects.filter(entity_id=entity_id).first()
+    if sp is None or not sp.is_active:
+        return False
+    registry.add(sp)
+    return True
@@ -0,0 +1,207 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.http import http_date
+from six import text_type
+
+from . attribute_maps import install as install_attribute_maps
+from . versioning import config_version
+
+
+logger = logging.getLogger(__name__)
+
+
+def idp_metadata_max_age():
+    return getattr(settings, 'SAML_IDP_METADATA_MAX_AGE', 3600)
+
+
+def idp_metadata_sign():
+    return getattr(settings, 'SAML_IDP_METADATA_SIGN', False)
+
+
+def idp_metadata_document_dir():
+    return getattr(settings, 'SAML_IDP_METADATA_DOCUMENT_DIR', None)
+
+
+class IdPMetadataDocument(object):
+    """ The serialized metadata of this IdP for a configuration version
+    """
+
+    def __init__(self, content, version, generated, valid_until=None, key=None):
+        self.content = content
+        self.version = version
+        # configuration version and digest of what the document is built from
+        self.key = key
+        self.generated = generated
+        # unix time, when the document has a validUntil
+        self.valid_until = valid_until
+        self.etag = '"{}"'.format(hashlib.sha256(content).hexdigest()[:32])
+        self.last_modified = http_date(generated)
+
+    def expired(self, now=None):
+        """ A document with a validUntil is generated again
+            when half of its validity has passed
+        """
+        if self.valid_until is None:
+            return False
+        now = now or time.time()
+        return now > self.generated + (self.valid_until - self.generated) / 2
+
+    def max_age(self, now=None):
+        max_age = idp_metadata_max_age()
+        if self.valid_until is not None:
+            # never kept by the clients beyond its validUntil
+            max_age = min(max_age, int(self.valid_until - (now or time.time())))
+        return max(max_age, 0)
+
+
+def idp_metadata_digest(idp_config, sign):
+    """ sha256 of the serialized SAML_IDP_CONFIG and of the signing flag:
+        a document built from another configuration is not served
+    """
+    data = json.dumps([idp_config, bool(sign)], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def build_idp_metadata(version=0, key=None):
+    """ Builds the EntityDescriptor of this IdP from SAML_IDP_CONFIG,
+        signed if SAML_IDP_METADATA_SIGN
+    """
+    from saml2.config import IdPConfig
+    from saml2.metadata import entity_descriptor, sign_entity_descriptor
+    from . crypto_backend import install as install_crypto_backend, security_context
+
+    install_attribute_maps()
+    install_crypto_backend()
+    conf = IdPConfig()
+    conf.load(copy.deepcopy(settings.SAML_IDP_CONFIG))
+    generated = time.time()
+    metadata = entity_descriptor(conf)
+    if idp_metadata_sign():
+        secc = security_context(conf)
+        metadata, xmldoc = sign_entity_descriptor(metadata, None, secc,
+                                                  conf.signing_algorithm,
+                                                  conf.digest_algorithm)
+        content = text_type(xmldoc).encode('utf-8')
+    else:
+        content = text_type(metadata).encode('utf-8')
+    valid_until = None
+    if conf.valid_for:
+        valid_until = generated + int(conf.valid_for) * 3600
+    return IdPMetadataDocument(content, version, generated, valid_until, key)
+
+
+class IdPMetadataCache(object):
+    """ Metadata of this IdP, generated once per configuration version
+        and served from memory. With SAML_IDP_METADATA_DOCUMENT_DIR the
+        document is also written on disk and shared by all the workers,
+        that serve the same bytes, ETag and Last-Modified.
+    """
+
+    prefix = 'idp-metadata-'
+
+    def __init__(self):
+        self.document = None
+        self._lock = threading.Lock()
+        # (SAML_IDP_CONFIG, signing flag, digest) of the last key
+        self._digest = None
+
+    def key(self, version):
+        idp_config, sign = settings.SAML_IDP_CONFIG, idp_metadata_sign()
+        digest = self._digest
+        if digest is None or digest[0] is not idp_config or digest[1] != sign:
+            digest = (idp_config, sign, idp_metadata_digest(idp_config, sign))
+            self._digest = digest
+        return '{}-{}'.format(version, digest[2][:16])
+
+    def path(self, key):
+        directory = idp_metadata_document_dir()
+        if directory:
+            return os.path.join(directory, '{}{}.xml'.format(self.prefix, key))
+
+    def read(self, version, key):
+        path = self.path(key)
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            generated = os.path.getmtime(path)
+        except OSError as e:
+            logger.error('IdP metadata {} not readable: {}'.format(path, e))
+            return
+        valid_until = None
+        valid_for = settings.SAML_IDP_CONFIG.get('valid_for')
+        if valid_for:
+            valid_until = generated + int(valid_for) * 3600
+        document = IdPMetadataDocument(content, version, generated, valid_until, key)
+        if not document.expired():
+            return document
+
+    def write(self, document):
+        path = self.path(document.key)
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(document.content)
+            os.utime(tmp, (document.generated, document.generated))
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error('IdP metadata {} not written: {}'.format(path, e))
+            return
+        self.prune(path)
+
+    def prune(self, path):
+        """ Removes the documents of the previous versions and configurations
+        """
+        directory = os.path.dirname(path)
+        for name in os.listdir(directory):
+            superseded = os.path.join(directory, name)
+            if not name.startswith(self.prefix) or not name.endswith('.xml') \
+               or superseded == path:
+                continue
+            try:
+                os.remove(superseded)
+            except FileNotFoundError:
+                # removed by another worker
+                pass
+            except OSError as e:
+                logger.error('IdP metadata {} not removed: {}'.format(superseded, e))
+
+    def get(self):
+        version = config_version.current()
+        key = self.key(version)
+        document = self.document
+        if document is not None and document.key == key \
+           and not document.expired():
+            return document
+        with self._lock:
+            document = self.document
+            if document is not None and document.key == key \
+               and not document.expired():
+                return document
+            document = self.read(version, key)
+            if document is None:
+                start = time.time()
+                document = build_idp_metadata(version, key)
+                logger.info('IdP metadata generated in {:.2f}s '
+                            '[version {}]'.format(time.time() - start, version))
+                self.write(document)
+            self.document = document
+        return document
+
+    def invalidate(self):
+        self.document = None
+
+
+idp_metadata_cache = IdPMetadataCache()
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from uniauth.versioning import config_version
+
+
+class Command(BaseCommand):
+    help = 'Shows the shared IdP configuration version and the one served by each node'
+
+    def add_arguments(self, parser):
+        parser.epilog = 'Example: ./manage.py idp_config_version --bump'
+        parser.add_argument('--bump', action='store_true',
+                            help="increments the version, all the workers will reload")
+
+    def handle(self, *args, **options):
+        if options['bump']:
+            config_version.bump()
+        current = config_version.backend.get()
+        self.stdout.write('Current configuration version: {}'.format(current))
+        for node, version, updated in config_version.nodes():
+            status = 'up to date' if version == current else 'outdated'
+            self.stdout.write('  {}: {} ({}, last reload {})'.format(node, version,
+                                                                    status, updated))
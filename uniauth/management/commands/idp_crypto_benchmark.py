@@ -0,0 +1,167 @@
+import copy
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from uniauth.attribute_maps import install as install_attribute_maps
+from uniauth.crypto_backend import PYTHON_XMLSEC
+
+
+BACKENDS = ('xmlsec1', PYTHON_XMLSEC)
+
+
+def cpu_time():
+    """ user + system time of this process and of its terminated children,
+        the xmlsec1 processes
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Command(BaseCommand):
+    help = ('Signs, verifies and encrypts a Response with the IdP key, '
+            'with the xmlsec1 subprocess backend and with the in process one, '
+            'and shows wall and CPU time per operation')
+
+    def add_arguments(self, parser):
+        parser.epilog = 'Example: ./manage.py idp_crypto_benchmark --rounds 200'
+        parser.add_argument('--rounds', type=int, default=50,
+                            help="operations of each kind, default: 50")
+        parser.add_argument('--backend', action='append', choices=BACKENDS,
+                            help="backend to measure, repeatable, default: all")
+        parser.add_argument('--attributes', type=int, default=10,
+                            help="attributes in the Assertion, default: 10")
+
+    def security_context(self, backend):
+        from saml2.config import IdPConfig
+        from uniauth.crypto_backend import security_context
+
+        idp_config = copy.deepcopy(settings.SAML_IDP_CONFIG)
+        idp_config.pop('metadata', None)
+        idp_config['crypto_backend'] = backend
+        conf = IdPConfig()
+        conf.load(idp_config)
+        return conf, security_context(conf)
+
+    def response(self, conf, sec, attributes):
+        from saml2 import saml, samlp, xmldsig
+        from saml2.s_utils import sid
+        from saml2.saml import NAME_FORMAT_URI
+        from saml2.sigver import pre_signature_part
+        from saml2.time_util import instant
+
+        sign_alg = conf.signing_algorithm or xmldsig.SIG_RSA_SHA256
+        digest_alg = conf.digest_algorithm or xmldsig.DIGEST_SHA256
+        issuer = saml.Issuer(text=conf.entityid, format=saml.NAMEID_FORMAT_ENTITY)
+
+        assertion = saml.Assertion(
+            id=sid(), version='2.0', issue_instant=instant(), issuer=issuer,
+            subject=saml.Subject(name_id=saml.NameID(format=saml.NAMEID_FORMAT_TRANSIENT,
+                                                     text=sid())),
+            attribute_statement=saml.AttributeStatement(attribute=[
+                saml.Attribute(name='urn:oid:1.3.6.1.4.1.5923.1.1.1.{}'.format(i),
+                               name_format=NAME_FORMAT_URI,
+                               attribute_value=[saml.AttributeValue(text='value-{}'.format(i))])
+                for i in range(attributes)]))
+        assertion.signature = pre_signature_part(assertion.id, sec.my_cert, 1,
+                                                 sign_alg=sign_alg, digest_alg=digest_alg)
+        response = samlp.Response(
+            id=sid(), version='2.0', issue_instant=instant(), issuer=copy.copy(issuer),
+            status=samlp.Status(status_code=samlp.StatusCode(value=samlp.STATUS_SUCCESS)),
+            assertion=assertion)
+        response.signature = pre_signature_part(response.id, sec.my_cert, 1,
+                                                sign_alg=sign_alg, digest_alg=digest_alg)
+        return response
+
+    def measure(self, rounds, func):
+        func()
+        wall, cpu = time.perf_counter(), cpu_time()
+        for i in range(rounds):
+            func()
+        return ((time.perf_counter() - wall) * 1000 / rounds,
+                (cpu_time() - cpu) * 1000 / rounds)
+
+    def run(self, backend, rounds, attributes):
+        from saml2 import class_name
+        from saml2.saml import Assertion
+        from saml2.samlp import Response
+        from saml2.sigver import pre_encrypt_assertion, pre_encryption_part
+
+        conf, sec = self.security_context(backend)
+        response = self.response(conf, sec, attributes)
+        assertion_id, response_id = response.assertion.id, response.id
+        unsigned = str(response)
+
+        def sign():
+            signed = sec.sign_statement(unsigned, class_name(Assertion()),
+                                        node_id=assertion_id)
+            return sec.sign_statement(signed, class_name(Response()),
+                                      node_id=response_id)
+
+        signed = sign()
+
+        def verify():
+            return sec.verify_signature(signed, conf.cert_file, node_name=class_name(Response()),
+                                        node_id=response_id)
+
+        # as pysaml2 Server does, the Assertion is moved in the EncryptedAssertion first
+        to_encrypt = str(pre_encrypt_assertion(copy.deepcopy(response)))
+
+        def encrypt():
+            return sec.encrypt_assertion(to_encrypt, conf.cert_file,
+                                         pre_encryption_part(encrypt_cert=sec.my_cert))
+
+        results = {}
+        for name, func in (('sign response and assertion', sign),
+                           ('verify', verify),
+                           ('encrypt assertion', encrypt)):
+            try:
+                results[name] = self.measure(rounds, func)
+            except Exception as e:
+                self.stderr.write('{} {} failed: {}'.format(backend, name, e))
+        return results, signed, response_id
+
+    def handle(self, *args, **options):
+        install_attribute_maps()
+        rounds = options['rounds']
+        results = {}
+        signed = {}
+        for backend in options['backend'] or BACKENDS:
+            try:
+                results[backend], xml, node_id = self.run(backend, rounds,
+                                                          options['attributes'])
+            except Exception as e:
+                self.stderr.write('{} not available: {}'.format(backend, e))
+                continue
+            signed[backend] = (xml, node_id)
+        if not results:
+            raise CommandError('No crypto backend available')
+
+        self.stdout.write('{} rounds, ms per operation\n'.format(rounds))
+        self.stdout.write('{:<14} {:<28} {:>9} {:>9} {:>9}'.format('backend', 'operation',
+                                                                 'wall', 'cpu', 'speedup'))
+        for backend, measures in results.items():
+            for name, (wall, cpu) in measures.items():
+                base = results.get('xmlsec1', {}).get(name)
+                speedup = '{:.1f}x'.format(base[0] / wall) if base and wall else '-'
+                self.stdout.write('{:<14} {:<28} {:>9.2f} {:>9.2f} {:>9}'.format(backend, name,
+                                                                             wall, cpu, speedup))
+
+        # each backend must accept what the other one signed
+        if len(signed) == len(BACKENDS):
+            from saml2 import class_name
+            from saml2.samlp import Response
+
+            for signer, verifier in (BACKENDS, BACKENDS[::-1]):
+                xml, node_id = signed[signer]
+                conf, sec = self.security_context(verifier)
+                try:
+                    sec.verify_signature(xml, conf.cert_file, node_name=class_name(Response()),
+                                         node_id=node_id)
+                    status = 'OK'
+                except Exception as e:
+                    status = 'FAILED: {}'.format(e)
+                self.stdout.write('Signed by {}, verified by {}: {}'.format(signer, verifier,
+                                                                            status))
@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Imports Django and the given modules in a new interpreter '
+            'with -X importtime and shows the most expensive imports')
+
+    def add_arguments(self, parser):
+        parser.epilog = ('Example: ./manage.py idp_import_time uniauth.views '
+                         '--filter uniauth --filter saml2 --limit 20')
+        parser.add_argument('modules', nargs='*',
+                            help="modules to import after django.setup(), "
+                                 "default: ROOT_URLCONF")
+        parser.add_argument('--limit', type=int, default=30,
+                            help="how many modules to show, default: 30")
+        parser.add_argument('--filter', action='append', default=[],
+                            help="only modules starting with this prefix, repeatable")
+        parser.add_argument('--sort-self', action='store_true',
+                            help="sort by self time instead of cumulative time")
+
+    def handle(self, *args, **options):
+        modules = options['modules'] or [settings.ROOT_URLCONF]
+        code = 'import django; django.setup()\n'
+        code += ''.join('import {}\n'.format(m) for m in modules)
+
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE)
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                              env=env, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            raise CommandError(proc.stderr.splitlines()[-1] if proc.stderr else
+                               'import failed')
+
+        # import time: self [us] | cumulative | imported package
+        rows = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            try:
+                self_us, cumulative, name = line[len('import time:'):].split('|')
+                rows.append((int(self_us), int(cumulative), name.strip()))
+            except ValueError:
+                # header
+                continue
+
+        total = sum(i[0] for i in rows)
+        self.stdout.write('Total import time: {:.1f} ms, '
+                          '{} modules'.format(total / 1000, len(rows)))
+        if options['filter']:
+            rows = [i for i in rows if i[2].startswith(tuple(options['filter']))]
+        rows.sort(key=lambda i: i[0] if options['sort_self'] else i[1], reverse=True)
+
+        self.stdout.write('{:>10} {:>12}  {}'.format('self ms', 'cumulative', 'module'))
+        for self_us, cumulative, name in rows[:options['limit']]:
+            self.stdout.write('{:>10.1f} {:>12.1f}  {}'.format(self_us / 1000,
+                                                              cumulative / 1000,
+                                                              name))
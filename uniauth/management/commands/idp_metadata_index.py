@@ -0,0 +1,42 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from uniauth.entity_index import entity_index_path, get_entity_index
+from uniauth.models import MetadataStore
+
+
+class Command(BaseCommand):
+    help = ('Builds the entity index of the local metadata files, '
+            'see SAML_IDP_METADATA_INDEX')
+
+    def add_arguments(self, parser):
+        parser.epilog = 'Example: ./manage.py idp_metadata_index --rebuild'
+        parser.add_argument('files', nargs='*',
+                            help="metadata files, default: the local metadata of "
+                                 "SAML_IDP_CONFIG and of the active MetadataStores")
+        parser.add_argument('--rebuild', action='store_true',
+                            help="rebuild also the indexes that are up to date")
+
+    def handle(self, *args, **options):
+        files = options['files']
+        if not files:
+            rows = list(settings.SAML_IDP_CONFIG['metadata'].get('local', []))
+            rows.extend(MetadataStore.as_pysaml_mdstore_dict().get('local', []))
+            for row in rows:
+                if os.path.isdir(row):
+                    files.extend(os.path.join(row, f) for f in sorted(os.listdir(row)))
+                else:
+                    files.append(row)
+
+        for fil in files:
+            if not os.path.isfile(fil):
+                continue
+            try:
+                index = get_entity_index(fil, rebuild=options['rebuild'])
+            except Exception as e:
+                self.stderr.write('{}: {}'.format(fil, e))
+                continue
+            self.stdout.write('{}: {} entities in {}'.format(fil, len(index),
+                                                             entity_index_path(fil)))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from uniauth.metadata_refresh import metadata_refresher
+
+
+class Command(BaseCommand):
+    help = 'Downloads the remote MetadataStores that are due and keeps a verified local copy'
+
+    def add_arguments(self, parser):
+        parser.epilog = 'Example: ./manage.py idp_metadata_refresh --daemon'
+        parser.add_argument('--force', action='store_true',
+                            help="refresh all the remote stores, without conditional requests")
+        parser.add_argument('--store', action='append', default=[],
+                            help="only the store with this name, repeatable")
+        parser.add_argument('--daemon', action='store_true',
+                            help="keep running, checking every SAML_IDP_METADATA_REFRESH_CHECK seconds")
+
+    def handle(self, *args, **options):
+        if options['daemon']:
+            self.stdout.write('Metadata refresher started')
+            metadata_refresher.run()
+            return
+
+        stores = metadata_refresher.due(force=options['force'])
+        if options['store']:
+            stores = stores.filter(name__in=options['store'])
+        for store in stores:
+            outcome = metadata_refresher.refresh(store, force=options['force'])
+            msg = '{}: {}'.format(store.name, outcome)
+            if store.refresh_error:
+                msg += ' ({})'.format(store.refresh_error)
+            self.stdout.write(msg)
+            self.stdout.write('  valid until: {}, next refresh: {}'.format(store.valid_until,
+                                                                          store.next_refresh))
@@ -0,0 +1,59 @@
+import json
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from uniauth.metadata_refresh import metadata_refresher
+from uniauth.metadata_sidecar import (MetadataSidecar,
+                                      MetadataSidecarClient,
+                                      SidecarError,
+                                      metadata_sidecar_socket)
+
+
+class Command(BaseCommand):
+    help = ('Loads the metadata once and serves the lookups of the workers '
+            'on a Unix socket, see SAML_IDP_METADATA_SIDECAR')
+
+    def add_arguments(self, parser):
+        parser.epilog = 'Example: ./manage.py idp_metadata_sidecar --socket /run/uniauth/metadata.sock'
+        parser.add_argument('--socket',
+                            help="Unix socket path, default: SAML_IDP_METADATA_SIDECAR")
+        parser.add_argument('--no-refresh', action='store_true',
+                            help="do not refresh the remote MetadataStores, "
+                                 "idp_metadata_refresh --daemon runs elsewhere")
+        parser.add_argument('--query', metavar='ENTITY_ID',
+                            help="asks a running sidecar for an entity and exits")
+
+    def handle(self, *args, **options):
+        path = options['socket'] or metadata_sidecar_socket()
+        if not path:
+            raise CommandError('Set SAML_IDP_METADATA_SIDECAR or --socket')
+
+        if options['query']:
+            client = MetadataSidecarClient(path)
+            try:
+                version, status = client.ping()
+                entity = client.entity(options['query'])
+            except SidecarError as e:
+                raise CommandError(e)
+            self.stdout.write('Sidecar {} [version {}]: {} entities'.format(path, version,
+                                                                           status['entities']))
+            self.stdout.write(json.dumps(entity, indent=2, default=dict))
+            return
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+        if not options['no_refresh']:
+            refresher = threading.Thread(target=metadata_refresher.run,
+                                         kwargs={'stop_event': stop_event},
+                                         name='uniauth-metadata-refresh',
+                                         daemon=True)
+            refresher.start()
+        self.stdout.write('Metadata sidecar starting on {}'.format(path))
+        try:
+            MetadataSidecar(path).serve(stop_event)
+        except KeyboardInterrupt:
+            stop_event.set()
+        except SidecarError as e:
+            raise CommandError(e)
@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from saml2.mdstore import InMemoryMetaData, MetaDataMDX
+
+from . compact_metadata import compact, metadata_compact_enabled
+from . ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+SAML_METADATA_CONTENT_TYPE = 'application/samlmetadata+xml'
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def mdq_session():
+    """ requests Session shared by all the MDQ clients of the process,
+        keeps the connections to the MDQ servers alive.
+        The one created in the uwsgi master, while warming up, is not
+        used by the forked workers: their requests would interleave
+        on the same sockets
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                pool_size = getattr(settings, 'SAML_IDP_MDQ_POOL_SIZE', 10)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size,
+                                      pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+
+class CachingMetaDataMDX(MetaDataMDX):
+    """ pysaml2 MDQ client with a LRU+TTL cache of the fetched entities,
+        a cache of the entities that the MDQ server doesn't know
+        and persistent HTTP connections
+    """
+
+    def __init__(self, url=None, security=None, cert=None,
+                 entity_transform=None, freshness_period=None,
+                 http_client_timeout=None, **kwargs):
+        super().__init__(url, security, cert, entity_transform,
+                         freshness_period=freshness_period, **kwargs)
+        self.http_client_timeout = http_client_timeout or \
+                                   getattr(settings, 'SAML_IDP_METADATA_TIMEOUT', 10)
+        self.entity = TTLCache(maxsize=getattr(settings, 'SAML_IDP_MDQ_CACHE_SIZE', 10000),
+                               ttl=getattr(settings, 'SAML_IDP_MDQ_CACHE_TTL', 3600))
+        self.missing = TTLCache(maxsize=getattr(settings, 'SAML_IDP_MDQ_CACHE_SIZE', 10000),
+                                ttl=getattr(settings, 'SAML_IDP_MDQ_NEGATIVE_TTL', 300))
+
+    def _fetch_metadata(self, item):
+        mdx_url = "{}/entities/{}".format(self.url, self.entity_transform(item))
+        response = mdq_session().get(mdx_url,
+                                     headers={"Accept": SAML_METADATA_CONTENT_TYPE},
+                                     timeout=self.http_client_timeout)
+        if response.status_code == 404:
+            self.missing.set(item, True)
+            raise KeyError('{} not found on {}'.format(item, self.url))
+        elif response.status_code != 200:
+            # server errors are not cached
+            msg = 'Fetching {}: got response status {}'.format(item, response.status_code)
+            logger.warning(msg)
+            raise KeyError(msg)
+
+        # parsed and verified apart, the cache gets only verified entities
+        fetched = InMemoryMetaData(self.attrc, node_name=self.node_name,
+                                   check_validity=self.check_validity,
+                                   security=self.security, filter=self.filter)
+        fetched.cert = self.cert
+        try:
+            verified = fetched.parse_and_check_signature(response.text)
+        except Exception as e:
+            verified = False
+            logger.error('Fetching {}: {}'.format(item, e))
+        if not verified:
+            msg = 'Fetching {}: invalid signature'.format(item)
+            logger.error(msg)
+            raise KeyError(msg)
+        try:
+            entity = fetched[item]
+        except KeyError:
+            # the MDQ server answered with another entity
+            self.missing.set(item, True)
+            raise
+        if metadata_compact_enabled():
+            entity = compact(entity)
+        self.entity[item] = entity
+        return entity
+
+    def __getitem__(self, item):
+        entity = self.entity.get(item)
+        if entity is not None:
+            return entity
+        if item in self.missing:
+            raise KeyError(item)
+        try:
+            return self._fetch_metadata(item)
+        except KeyError:
+            self.entity.pop(item)
+            raise
+        except Exception as e:
+            self.entity.pop(item)
+            logger.error('MDQ {} lookup of {} failed: {}'.format(self.url, item, e))
+            raise KeyError(item)
+
+    def __contains__(self, item):
+        try:
+            self[item]
+        except KeyError:
+            return False
+        return True
+
+    def prefetch(self, entity_ids):
+        """ Fetches the entities in parallel, returns how many were found
+        """
+        entity_ids = [i for i in entity_ids if i not in self.entity]
+        if not entity_ids:
+            return 0
+        workers = getattr(settings, 'SAML_IDP_MDQ_PREFETCH_WORKERS', 8)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            found = list(executor.map(self.__contains__, entity_ids))
+        logger.info('MDQ {}: prefetched {} of {} entities'.format(self.url,
+                                                                  sum(found),
+                                                                  len(entity_ids)))
+        return sum(found)
+
+
+def prefetch_mdq(mdstore):
+    """ Fetches from the MDQ sources every active ServiceProvider
+    """
+    from . models import ServiceProvider
+
+    if not getattr(settings, 'SAML_IDP_MDQ_PREFETCH', True):
+        return
+    sources = [md for md in mdstore.metadata.values()
+               if isinstance(md, CachingMetaDataMDX)]
+    if not sources:
+        return
+    entity_ids = list(ServiceProvider.objects.filter(is_active=True).\
+                                              values_list('entity_id', flat=True))
+    entity_ids.extend(settings.SAML_IDP_SPCONFIG.keys())
+    for source in sources:
+        try:
+            source.prefetch(entity_ids)
+        except Exception as e:
+            logger.error('MDQ {} prefetch failed: {}'.format(source.url, e))
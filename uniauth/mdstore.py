@@ -0,0 +1,636 @@
+import copy
+import hashlib
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from saml2 import md
+from saml2.config import IdPConfig
+from saml2.mdstore import (InMemoryMetaData,
+                           MetaDataExtern,
+                           MetaDataFile,
+                           MetadataStore,
+                           TooOld)
+from saml2.time_util import valid
+
+from . compact_metadata import (compact,
+                               compact_store,
+                               metadata_compact_enabled)
+from . entity_index import (EntitySlicer,
+                            LazyEntities,
+                            entity_index_enabled,
+                            get_entity_index,
+                            select_entities)
+from . mdq import CachingMetaDataMDX
+from . metadata_changes import (changed_entities,
+                                diff_hashes,
+                                metadata_changes,
+                                metadata_incremental_enabled)
+from . metadata_loader import (PreparsedMetaDataFile,
+                               metadata_load_timeout,
+                               metadata_load_workers,
+                               parse_metadata_file,
+                               pool_parsed_files,
+                               process_pool)
+from . metadata_sidecar import MetaDataSidecar, metadata_sidecar_enabled
+from . metadata_watch import directory_snapshot
+from . verification import invalidate_signatures
+from . versioning import config_version
+
+
+logger = logging.getLogger(__name__)
+
+
+def metadata_selective_enabled():
+    return getattr(settings, 'SAML_IDP_METADATA_SELECTIVE', False)
+
+
+def selected_entity_ids():
+    """ entityIDs loaded when SAML_IDP_METADATA_SELECTIVE is enabled:
+        the federated SPs plus SAML_IDP_METADATA_ALLOWLIST
+    """
+    from . registry import get_sp_registry
+
+    selection = set(get_sp_registry())
+    selection.update(getattr(settings, 'SAML_IDP_METADATA_ALLOWLIST', []))
+    return frozenset(selection)
+
+
+def materialize_entity(attrc, xml, entity_id, check_validity=True, _filter=None):
+    """ pysaml2 dict of a single EntityDescriptor, with the same checks
+        and conversion of a whole document. None if it's not usable
+    """
+    scratch = InMemoryMetaData(attrc, check_validity=check_validity,
+                               filter=_filter)
+    scratch.do_entity_descriptor(md.entity_descriptor_from_string(xml))
+    entity = scratch.entity.get(entity_id)
+    if entity is not None and metadata_compact_enabled():
+        entity = compact(entity)
+    return entity
+
+
+def entity_expired(entity):
+    """ True if the validUntil of a parsed EntityDescriptor has passed:
+        an entity reused from a previous load is checked again,
+        as pysaml2 does when it parses it
+    """
+    valid_until = entity.get('valid_until')
+    return bool(valid_until) and not valid(valid_until)
+
+
+class SlicedParseMixin(object):
+    """ Parses the EntityDescriptors one by one:
+        only the ones in selection, if set, and, if incremental,
+        only the ones that changed since the previous load
+        of the same source in this process.
+        The signature is still verified on the whole document
+    """
+    selection = None
+    incremental = False
+    source_signed = False
+    # entityIDs of the source, selected or not, None if not sliced
+    source_entities = None
+    # entityIDs added, changed or removed, None if unknown
+    changes = None
+    report = None
+    _pending = None
+
+    @property
+    def source(self):
+        return getattr(self, 'filename', None) or getattr(self, 'url', '')
+
+    def parse(self, xmlstr):
+        if self.incremental:
+            return self.parse_incremental(xmlstr)
+        elif self.selection is not None:
+            xmlstr, self.source_signed, entity_ids, selected = select_entities(xmlstr,
+                                                                               self.selection)
+            self.source_entities = frozenset(entity_ids)
+            logger.info('Metadata {}: selected {} of {} entities'.format(self.source,
+                                                                        selected,
+                                                                        len(entity_ids)))
+        return super().parse(xmlstr)
+
+    def parse_incremental(self, xmlstr):
+        if isinstance(xmlstr, str):
+            xmlstr = xmlstr.encode()
+        digest = hashlib.sha256(xmlstr).hexdigest()
+        previous = metadata_changes.state(self.source) or {}
+        if previous.get('sha256') == digest and \
+           previous.get('selection') == self.selection:
+            # same document, same entities, if still valid
+            self.check_document_validity(previous.get('valid_until'))
+            self.source_signed = previous['signed']
+            self.source_entities = frozenset(previous['hashes'])
+            self.changes = set()
+            for entity_id, entity in previous['entities'].items():
+                if self.check_validity and entity_expired(entity):
+                    logger.error('Entity descriptor (entity id:{}) too old'.format(entity_id))
+                    self.changes.add(entity_id)
+                    continue
+                self.entity[entity_id] = entity
+            self._pending = dict(previous, entities=dict(self.entity))
+            return
+
+        slicer = EntitySlicer(xmlstr)
+        slicer.parse()
+        self.source_signed = slicer.signed
+        self.check_document_validity(slicer.valid_until)
+
+        old_hashes = previous.get('hashes', {})
+        old_entities = previous.get('entities', {})
+        hashes = {}
+        parsed = 0
+        for entity_id, xml in slicer.entities:
+            if entity_id in hashes:
+                # the first occurrence wins, as in pysaml2
+                continue
+            hashes[entity_id] = hashlib.sha256(xml).hexdigest()
+            if self.selection is not None and entity_id not in self.selection:
+                continue
+            entity = old_entities.get(entity_id)
+            if entity is not None and self.check_validity and entity_expired(entity):
+                # parsed again, pysaml2 logs and skips it
+                entity = None
+            if entity is None or old_hashes.get(entity_id) != hashes[entity_id]:
+                entity = materialize_entity(self.attrc, xml, entity_id,
+                                            self.check_validity, self.filter)
+                parsed += 1
+            if entity is not None:
+                self.entity[entity_id] = entity
+
+        self.source_entities = frozenset(hashes)
+        if previous:
+            self.report = diff_hashes(old_hashes, hashes)
+            self.changes = changed_entities(self.report)
+            # entities expired since the previous load
+            self.changes.update(set(old_entities) - set(self.entity))
+            if previous.get('selection') != self.selection:
+                # entities entering or leaving the selection
+                self.changes.update(set(self.entity) ^ set(old_entities))
+            logger.info('Metadata {}: {added} added, {changed} changed, '
+                        '{removed} removed, {parsed} parsed'.format(self.source,
+                                                                    parsed=parsed,
+                                                                    **{k: len(v) for k, v in
+                                                                       self.report.items()
+                                                                       if k != 'entities'}))
+        self._pending = {'sha256': digest,
+                         'selection': self.selection,
+                         'valid_until': slicer.valid_until,
+                         'signed': slicer.signed,
+                         'hashes': hashes,
+                         'entities': dict(self.entity)}
+
+    def check_document_validity(self, valid_until):
+        if self.check_validity and valid_until and not valid(valid_until):
+            raise TooOld("Metadata not valid anymore, it's only valid "
+                         "until {}".format(valid_until))
+
+    def parse_and_check_signature(self, txt):
+        res = super().parse_and_check_signature(txt)
+        # the next load starts from here only if the signature is valid
+        if self._pending is not None:
+            metadata_changes.save_state(self.source, self._pending)
+        return res
+
+    def signed(self):
+        return self.source_signed or super().signed()
+
+
+class SlicedMetaDataFile(SlicedParseMixin, MetaDataFile):
+    pass
+
+
+class SlicedMetaDataExtern(SlicedParseMixin, MetaDataExtern):
+    pass
+
+
+class MetaDataIndexed(MetaDataFile):
+    """ Metadata file served from its EntityIndex:
+        an entity is parsed only the first time it's requested.
+        If selection is set the other entities are ignored.
+        If incremental, the entities already parsed by the previous
+        load are kept, if their EntityDescriptor didn't change
+    """
+
+    def __init__(self, attrc, filename=None, cert=None, **kwargs):
+        super().__init__(attrc, filename, cert, **kwargs)
+        self.index = None
+        self.selection = None
+        self.incremental = False
+        self.changes = None
+        self.report = None
+        self.entity = LazyEntities(self)
+
+    def load(self, *args, **kwargs):
+        self.index = get_entity_index(self.filename)
+        valid_until = self.index.valid_until
+        if self.check_validity and valid_until and valid_until < time.time():
+            raise TooOld("Metadata not valid anymore, it's only valid "
+                         "until {}".format(time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                         time.gmtime(valid_until))))
+        self.entity.clear()
+        if not self.incremental:
+            return
+
+        hashes = self.index.hashes()
+        previous = metadata_changes.state(self.filename)
+        if previous:
+            old_hashes = previous['hashes']
+            expired = set()
+            for entity_id, entity in previous['entities'].items():
+                if entity is None or old_hashes.get(entity_id) != hashes.get(entity_id):
+                    continue
+                if self.check_validity and entity_expired(entity):
+                    expired.add(entity_id)
+                    continue
+                self.entity[entity_id] = entity
+            self.report = diff_hashes(old_hashes, hashes)
+            self.changes = changed_entities(self.report) | expired
+            if previous['selection'] != self.selection:
+                self.changes.update(set(previous['entities']) ^ set(self.entity.materialized))
+        # the entities parsed from now on will be found by the next load
+        metadata_changes.save_state(self.filename,
+                                    {'hashes': hashes,
+                                     'selection': self.selection,
+                                     'entities': self.entity.materialized})
+
+    def materialize(self, entity_id):
+        """ pysaml2 dict of entity_id, None if it's not usable.
+            KeyError if it's not in this metadata
+        """
+        if self.index is None:
+            raise KeyError(entity_id)
+        if self.selection is not None and entity_id not in self.selection:
+            raise KeyError(entity_id)
+        xml = self.index.raw(entity_id)
+        if xml is None:
+            raise KeyError(entity_id)
+        entity = materialize_entity(self.attrc, xml, entity_id,
+                                    self.check_validity, self.filter)
+        return entity
+
+    def summary(self, entity_id):
+        return self.index.summary(entity_id) if self.index else None
+
+    @property
+    def source_entities(self):
+        """ entityIDs of the file, selected or not
+        """
+        return self.index if self.index is not None else ()
+
+
+class UniAuthMetadataStore(MetadataStore):
+    """ pysaml2 MetadataStore where the 'mdq' sources
+        are served by the uniAuth caching MDQ client and,
+        if SAML_IDP_METADATA_INDEX is enabled, the 'local' files
+        by their EntityIndex.
+        If selection is set, 'local' and 'remote' sources
+        keep only the entities it contains, except the sources of
+        whole_stores. If incremental, they
+        reuse what the previous load in this process already parsed.
+        Each load is a generation of metadata_changes.
+        The sources are loaded concurrently, see imp().
+        directories keeps the files found in each local directory,
+        see update_directory()
+    """
+    selection = None
+    # MetadataStores whose sources are loaded whole
+    # even if selection is set, see source_selection
+    whole_stores = ()
+    incremental = False
+    generation = None
+    directories = None
+    # False when the caller records the changes itself
+    track_changes = True
+
+    def record_changes(self, _md):
+        if not self.track_changes:
+            return
+        changes = getattr(_md, 'changes', None)
+        metadata_changes.record(self.generation, changes)
+        if changes:
+            # signers whose certificates could have changed
+            invalidate_signatures(changes)
+
+    def source(self, entity_id):
+        """ key of the first source that has entity_id, None if missing
+        """
+        for key, _md in self.metadata.items():
+            if isinstance(_md, MetaDataSidecar):
+                return _md.source(entity_id)
+            try:
+                _md[entity_id]
+            except KeyError:
+                continue
+            return key
+
+    def source_selection(self, key):
+        """ selection of the source key, None if it's loaded whole
+        """
+        for store in self.whole_stores:
+            if store.provides_source(key):
+                return None
+        return self.selection
+
+    def in_sources(self, entity_id):
+        """ True if entity_id is in a source, loaded or left out
+            by the selection
+        """
+        for _md in self.metadata.values():
+            source_entities = getattr(_md, 'source_entities', None)
+            if source_entities is not None:
+                if entity_id in source_entities:
+                    return True
+            elif entity_id in _md:
+                return True
+        return False
+
+    def load_indexed(self, path):
+        _filter = getattr(self, 'filter', None)
+        kwargs = {'filter': _filter} if _filter else {}
+        if os.path.isdir(path):
+            files = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+        else:
+            files = [path]
+        for fil in files:
+            if not os.path.isfile(fil):
+                continue
+            _md = MetaDataIndexed(self.attrc, fil, **kwargs)
+            _md.selection = self.source_selection(fil)
+            _md.incremental = self.incremental
+            _md.load()
+            self.metadata[fil] = _md
+            self.record_changes(_md)
+
+    def load_sliced(self, *args, **kwargs):
+        """ the same of pysaml2 for 'local' and 'remote',
+            with the sliced classes
+        """
+        _filter = getattr(self, 'filter', None)
+        _args = {'filter': _filter} if _filter else {}
+        if args[0] == 'local':
+            path = args[1]
+            if os.path.isdir(path):
+                files = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+            else:
+                files = [path]
+            sources = [(fil, SlicedMetaDataFile(self.attrc, fil, **_args))
+                       for fil in files if os.path.isfile(fil)]
+        else:
+            if 'url' not in kwargs:
+                raise ValueError("Remote metadata must be structured "
+                                 "as a dict containing the key 'url'")
+            for _key in ('node_name', 'check_validity'):
+                if _key in kwargs:
+                    _args[_key] = kwargs[_key]
+            sources = [(kwargs['url'],
+                        SlicedMetaDataExtern(self.attrc, kwargs['url'],
+                                             self.security,
+                                             kwargs.get('cert', ''),
+                                             self.http, **_args))]
+        for key, _md in sources:
+            _md.selection = self.source_selection(key)
+            _md.incremental = self.incremental
+            _md.load()
+            self.metadata[key] = _md
+            self.record_changes(_md)
+
+    def sources(self, spec):
+        """ (type, args, kwargs) of each source of a pysaml2 metadata
+            spec, in order, with the local directories expanded
+        """
+        for typ, vals in spec.items():
+            for val in vals:
+                if isinstance(val, dict):
+                    if not self.check_validity:
+                        val['check_validity'] = False
+                    yield typ, (), val
+                elif typ == 'local' and os.path.isdir(val):
+                    snapshot = directory_snapshot(val)
+                    if self.directories is None:
+                        self.directories = {}
+                    self.directories[val] = snapshot
+                    for fil in snapshot:
+                        yield typ, (fil,), {}
+                else:
+                    yield typ, (val,), {}
+
+    def load_source(self, typ, args, kwargs, ii=0, pool=None, track_changes=True):
+        """ Loads a source in a copy of the store, returns the copy.
+            If pool is set the local file is parsed there
+        """
+        store = copy.copy(self)
+        store.metadata = {}
+        store.to_old = {}
+        store.ii = ii
+        store.track_changes = track_changes
+        if pool is not None:
+            parsed = pool.submit(parse_metadata_file, self.attrc,
+                                 args[0], self.check_validity).result()
+            _md = PreparsedMetaDataFile(self.attrc, args[0], parsed=parsed)
+            _md.load()
+            store.metadata[args[0]] = _md
+            metadata_changes.record(self.generation)
+        else:
+            store.load(typ, *args, **kwargs)
+        return store
+
+    def update_directory(self, directory, snapshot):
+        """ Reloads in place the files of a local directory
+            added or changed since the last load and drops the removed ones.
+            A file that fails to load is still served in its previous version.
+            Returns the reloaded and the removed files
+        """
+        previous = self.directories[directory]
+        changed = [fil for fil, stat in snapshot.items() if previous.get(fil) != stat]
+        removed = [fil for fil in previous if fil not in snapshot]
+        generation = metadata_changes.begin()
+        loaded, entity_ids = {}, set()
+        for fil in changed:
+            store = copy.copy(self)
+            store.generation = generation
+            try:
+                store = store.load_source('local', (fil,), {}, track_changes=False)
+            except Exception as e:
+                logger.error('Metadata {} not reloaded: {}'.format(fil, e))
+                continue
+            if metadata_compact_enabled():
+                compact_store(store)
+            _md = store.metadata[fil]
+            changes = getattr(_md, 'changes', None)
+            if changes is None:
+                changes = set(_md.keys())
+                if fil in self.metadata:
+                    changes.update(self.metadata[fil].keys())
+            entity_ids.update(changes)
+            loaded[fil] = _md
+        for fil in removed:
+            if fil in self.metadata:
+                entity_ids.update(self.metadata[fil].keys())
+
+        # the directory files stay where they were, in name order
+        metadata, placed = {}, False
+        for key, _md in self.metadata.items():
+            if key in previous or key in snapshot:
+                if not placed:
+                    metadata.update(self._directory_sources(snapshot, loaded))
+                    placed = True
+                continue
+            metadata[key] = _md
+        if not placed:
+            metadata.update(self._directory_sources(snapshot, loaded))
+
+        metadata_changes.record(generation, entity_ids)
+        if entity_ids:
+            invalidate_signatures(entity_ids)
+        self.metadata = metadata
+        self.directories[directory] = snapshot
+        self.generation = generation
+        return list(loaded), removed
+
+    def _directory_sources(self, snapshot, loaded):
+        for fil in snapshot:
+            _md = loaded.get(fil, self.metadata.get(fil))
+            if _md is not None:
+                yield fil, _md
+
+    def imp(self, spec):
+        """ Loads the sources concurrently, SAML_IDP_METADATA_LOAD_WORKERS
+            at a time, and the big local files in
+            SAML_IDP_METADATA_LOAD_PROCESSES parser processes.
+            The sources are merged in the configuration order
+        """
+        if type(spec) is not dict:
+            return super().imp(spec)
+        sources = list(self.sources(spec))
+        workers = metadata_load_workers()
+        if workers <= 1 or len(sources) <= 1:
+            for typ, args, kwargs in sources:
+                self.load(typ, *args, **kwargs)
+            return
+
+        parsed_files = []
+        if not (entity_index_enabled() or self.incremental or
+                self.selection is not None or getattr(self, 'filter', None)):
+            parsed_files = pool_parsed_files([args[0] for typ, args, kwargs
+                                              in sources if typ == 'local'])
+        pool = process_pool(len(parsed_files))
+        executor = ThreadPoolExecutor(max_workers=min(workers, len(sources)),
+                                      thread_name_prefix='uniauth-metadata')
+        timeout = metadata_load_timeout()
+        # the sources load concurrently, they share the same deadline
+        deadline = time.monotonic() + timeout
+        try:
+            futures, ii = [], self.ii
+            for typ, args, kwargs in sources:
+                _pool = pool if typ == 'local' and args[0] in parsed_files else None
+                # inline sources are numbered in order
+                futures.append(executor.submit(self.load_source, typ, args,
+                                               kwargs, ii, _pool))
+                if typ == 'inline':
+                    ii += 1
+            for (typ, args, kwargs), future in zip(sources, futures):
+                try:
+                    store = future.result(timeout=max(deadline - time.monotonic(), 0))
+                except TimeoutError:
+                    source = args[0] if args else kwargs.get('url')
+                    raise TimeoutError('Metadata {} {} not loaded '
+                                       'in {} seconds'.format(typ, source, timeout))
+                self.metadata.update(store.metadata)
+                self.to_old.update(store.to_old)
+            self.ii = ii
+        finally:
+            for future in futures:
+                future.cancel()
+            # a source still loading is abandoned
+            executor.shutdown(wait=False)
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+    def load(self, *args, **kwargs):
+        if args[0] == 'local' and entity_index_enabled():
+            return self.load_indexed(args[1])
+        elif args[0] in ('local', 'remote') and \
+             (self.incremental or self.selection is not None):
+            return self.load_sliced(*args, **kwargs)
+        elif args[0] != 'mdq':
+            super().load(*args, **kwargs)
+            if self.track_changes:
+                # untracked sources, every entity could have changed
+                metadata_changes.record(self.generation)
+            return
+
+        if 'url' in kwargs:
+            key = kwargs['url']
+            _md = CachingMetaDataMDX(kwargs['url'],
+                                     self.security,
+                                     kwargs.get('cert'),
+                                     kwargs.get('entity_transform'),
+                                     freshness_period=kwargs.get('freshness_period'),
+                                     http_client_timeout=getattr(self, 'http_client_timeout', None))
+        else:
+            key = args[1]
+            _md = CachingMetaDataMDX(args[1], self.security)
+        _md.load()
+        self.metadata[key] = _md
+        if self.track_changes:
+            # MDQ entities are fetched again by the new client
+            metadata_changes.record(self.generation)
+
+
+class UniAuthIdPConfig(IdPConfig):
+    """ IdPConfig that loads metadata in a UniAuthMetadataStore,
+        only the federated SPs if SAML_IDP_METADATA_SELECTIVE is enabled,
+        incrementally if SAML_IDP_METADATA_INCREMENTAL is enabled
+        and compacted if SAML_IDP_METADATA_COMPACT is enabled.
+        If SAML_IDP_METADATA_SIDECAR is set the metadata is not loaded,
+        it's looked up in the sidecar
+    """
+
+    def load_metadata(self, metadata_conf):
+        acs = self.attribute_converters
+        try:
+            ca_certs = self.ca_certs
+        except Exception:
+            ca_certs = None
+        try:
+            disable_validation = self.disable_ssl_certificate_validation
+        except Exception:
+            disable_validation = False
+
+        # remote and mdq downloads must not outlive the load:
+        # a source abandoned by imp() would keep waiting
+        http_client_timeout = getattr(self, 'http_client_timeout', None) or \
+                              getattr(settings, 'SAML_IDP_METADATA_TIMEOUT', 10)
+        mds = UniAuthMetadataStore(acs, self, ca_certs,
+                                   disable_ssl_certificate_validation=disable_validation,
+                                   http_client_timeout=http_client_timeout)
+        mds.generation = metadata_changes.begin()
+        if metadata_sidecar_enabled():
+            _md = MetaDataSidecar(acs, version=config_version.current())
+            _md.load()
+            mds.metadata['sidecar'] = _md
+            # the sidecar could have loaded anything
+            metadata_changes.record(mds.generation)
+            return mds
+        mds.incremental = metadata_incremental_enabled()
+        if metadata_selective_enabled():
+            from . federation import auto_federate_entity_categories
+            from . registry import get_sp_registry
+
+            if auto_federate_entity_categories():
+                # any entity could be federated on its first request
+                raise ImproperlyConfigured('SAML_IDP_AUTO_FEDERATE_ENTITY_CATEGORIES '
+                                           'needs all the metadata entities, '
+                                           'disable SAML_IDP_METADATA_SELECTIVE')
+            mds.selection = selected_entity_ids()
+            # the SPs of auto_federate stores are federated on first use
+            mds.whole_stores = get_sp_registry().auto_federate_stores
+        mds.imp(metadata_conf)
+        if metadata_compact_enabled():
+            compact_store(mds)
+        return mds
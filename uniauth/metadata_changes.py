@@ -0,0 +1,99 @@
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+
+from . entity_index import EntitySlicer
+
+
+logger = logging.getLogger(__name__)
+
+
+def metadata_incremental_enabled():
+    return getattr(settings, 'SAML_IDP_METADATA_INCREMENTAL', False)
+
+
+def entity_hashes(data):
+    """ entityID -> sha256 of its EntityDescriptor
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    hashes = {}
+    for entity_id, xml in EntitySlicer(data).parse():
+        hashes.setdefault(entity_id, hashlib.sha256(xml).hexdigest())
+    return hashes
+
+
+def diff_hashes(old, new):
+    """ Change report between two entity_hashes
+    """
+    return {'added': sorted(set(new) - set(old)),
+            'changed': sorted(entity_id for entity_id, sha in new.items()
+                              if entity_id in old and old[entity_id] != sha),
+            'removed': sorted(set(old) - set(new)),
+            'entities': len(new)}
+
+
+def changed_entities(report):
+    return set(report['added']) | set(report['changed']) | set(report['removed'])
+
+
+class MetadataChanges(object):
+    """ Per-process memory of the loaded metadata sources.
+        Each IdP metadata load is a generation: sources that reload
+        incrementally record which entities they changed, the others
+        record a full reload. Per-SP caches compiled at a generation
+        stay valid until their entity changes.
+        states keeps, for each source, the hashes and the parsed
+        entities of its last load, to be reused by the next one.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.last_full = 0
+        self.changed = {}
+        self.states = {}
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.generation += 1
+            return self.generation
+
+    def record(self, generation, entity_ids=None):
+        """ entity_ids None means that every entity could have changed
+        """
+        with self._lock:
+            if entity_ids is None:
+                self.last_full = max(self.last_full, generation)
+                # older changes are covered by the full reload
+                self.changed = {}
+                return
+            for entity_id in entity_ids:
+                self.changed[entity_id] = max(self.changed.get(entity_id, 0),
+                                              generation)
+
+    def unchanged_since(self, entity_id, generation):
+        """ True if entity_id is the same in every load after generation
+        """
+        if generation is None:
+            return False
+        return self.last_full <= generation and \
+               self.changed.get(entity_id, 0) <= generation
+
+    def state(self, source):
+        return self.states.get(source)
+
+    def save_state(self, source, state):
+        with self._lock:
+            self.states[source] = state
+
+    def clear(self):
+        with self._lock:
+            self.last_full = self.generation
+            self.changed = {}
+            self.states = {}
+
+
+metadata_changes = MetadataChanges()
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from saml2.mdstore import InMemoryMetaData, MetaDataFile
+
+
+# this module is imported by the parser processes too:
+# it must not import Django models
+
+
+logger = logging.getLogger(__name__)
+
+
+def metadata_load_workers():
+    return getattr(settings, 'SAML_IDP_METADATA_LOAD_WORKERS', 8)
+
+
+def metadata_load_timeout():
+    return getattr(settings, 'SAML_IDP_METADATA_LOAD_TIMEOUT', 120)
+
+
+def metadata_load_processes():
+    return getattr(settings, 'SAML_IDP_METADATA_LOAD_PROCESSES', 0)
+
+
+def metadata_process_min_size():
+    return getattr(settings, 'SAML_IDP_METADATA_PROCESS_MIN_SIZE', 5 * 1024 * 1024)
+
+
+def pool_parsed_files(files):
+    """ Local files big enough to be parsed in a parser process,
+        none if SAML_IDP_METADATA_LOAD_PROCESSES is 0
+    """
+    if not metadata_load_processes():
+        return []
+    min_size = metadata_process_min_size()
+    return [fil for fil in files if os.path.getsize(fil) >= min_size]
+
+
+def process_pool(files_count):
+    """ Pool of parser processes, None if there's nothing to parse
+    """
+    if not files_count:
+        return
+    if 'uwsgi' in sys.modules and \
+       os.path.basename(sys.executable).startswith('uwsgi'):
+        # the processes would run uWSGI, not Python
+        logger.error('SAML_IDP_METADATA_LOAD_PROCESSES needs the py-executable '
+                     'uWSGI option, the metadata files are parsed by threads')
+        return
+    # not forked: the loading process runs other threads
+    return ProcessPoolExecutor(max_workers=min(metadata_load_processes(), files_count),
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def parse_metadata_file(attrc, filename, check_validity=True):
+    """ pysaml2 entities of a metadata file, runs in the parser processes
+    """
+    with open(filename, 'rb') as f:
+        xml = f.read()
+    _md = InMemoryMetaData(attrc, check_validity=check_validity)
+    _md.parse(xml)
+    return hashlib.sha256(xml).hexdigest(), _md.entity, _md.to_old, _md.signed()
+
+
+class PreparsedMetaDataFile(MetaDataFile):
+    """ Metadata file parsed by a parser process:
+        load() only checks its signature
+    """
+    source_signed = False
+
+    def __init__(self, attrc, filename=None, cert=None, parsed=None, **kwargs):
+        super().__init__(attrc, filename, cert, **kwargs)
+        self.parsed = parsed
+
+    def parse(self, xmlstr):
+        parsed, self.parsed = self.parsed, None
+        if isinstance(xmlstr, str):
+            xmlstr = xmlstr.encode()
+        if parsed is None or parsed[0] != hashlib.sha256(xmlstr).hexdigest():
+            # the file changed in the meantime
+            return super().parse(xmlstr)
+        digest, entity, self.to_old, self.source_signed = parsed
+        self.entity.update(entity)
+
+    def signed(self):
+        return self.source_signed or super().signed()
@@ -0,0 +1,267 @@
+import calendar
+import copy
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+from . entity_index import entity_index_enabled, get_entity_index
+from . metadata_changes import diff_hashes, entity_hashes
+from . models import MetadataStore
+from . signals import invalidate_idp_server
+
+
+logger = logging.getLogger(__name__)
+
+
+def metadata_cache_dir():
+    return getattr(settings, 'SAML_IDP_METADATA_CACHE_DIR',
+                   os.path.join(settings.MEDIA_ROOT, 'metadata', 'cache'))
+
+
+def epoch_to_datetime(epoch):
+    dt = datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc)
+    return dt if settings.USE_TZ else timezone.make_naive(dt)
+
+
+def datetime_to_epoch(dt):
+    # naive datetimes are in the current time zone, see epoch_to_datetime
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt.timestamp()
+
+
+def metadata_lifetime(xml):
+    """ validUntil (epoch) and cacheDuration (seconds)
+        of the root element, None if not present
+    """
+    from defusedxml.ElementTree import fromstring
+    from saml2 import time_util
+
+    root = fromstring(xml)
+    valid_until = root.get('validUntil')
+    if valid_until:
+        valid_until = calendar.timegm(time_util.str_to_time(valid_until))
+    cache_duration = root.get('cacheDuration')
+    if cache_duration:
+        now = time.gmtime()
+        later = time_util.add_duration(now, cache_duration)
+        cache_duration = calendar.timegm(later) - calendar.timegm(now)
+    return valid_until or None, cache_duration or None
+
+
+class MetadataRefresher(object):
+    """ Downloads the active remote MetadataStores when they are due,
+        with conditional requests (ETag, If-Modified-Since) over a pooled
+        HTTP session. A document is saved as local copy only if its
+        signature is valid, then the IdP loads it from there.
+        When a refresh fails the previous copy is still served
+        and the error is stored in the MetadataStore.
+    """
+
+    def __init__(self):
+        self._session = None
+        self._config = None
+
+    @property
+    def interval(self):
+        return getattr(settings, 'SAML_IDP_METADATA_REFRESH_INTERVAL', 3600)
+
+    @property
+    def retry(self):
+        return getattr(settings, 'SAML_IDP_METADATA_REFRESH_RETRY', 300)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'SAML_IDP_METADATA_TIMEOUT', 10)
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10,
+                                  max_retries=1)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def config(self):
+        """ IdPConfig without metadata, for signature verification
+        """
+        if self._config is None:
+            from saml2.config import IdPConfig
+
+            idp_config = copy.deepcopy(settings.SAML_IDP_CONFIG)
+            idp_config.pop('metadata', None)
+            conf = IdPConfig()
+            conf.load(idp_config)
+            self._config = conf
+        return self._config
+
+    def verify(self, store, xml):
+        """ Parses the document and checks its signature with the
+            store certificate, the same way pysaml2 does for remote metadata
+        """
+        from saml2.mdstore import MetaDataExtern
+        from . crypto_backend import security_context
+
+        cert = store.file.path if store.file else None
+        md = MetaDataExtern(self.config.attribute_converters, store.url,
+                            security_context(self.config), cert, None)
+        md.parse_and_check_signature(xml)
+        return md
+
+    def local_copy_name(self, store):
+        return 'metadata_store_{}.xml'.format(store.pk)
+
+    def next_refresh(self, valid_until=None, cache_duration=None):
+        delay = self.interval
+        if cache_duration:
+            delay = min(delay, cache_duration)
+        if valid_until:
+            # refresh well before expiration
+            delay = min(delay, max((valid_until - time.time()) / 2, self.retry))
+        return timezone.now() + datetime.timedelta(seconds=delay)
+
+    def changes_report(self, previous, content):
+        """ JSON report of the entities added, changed and removed
+            since the previous copy
+        """
+        try:
+            old = entity_hashes(previous) if previous else {}
+            report = diff_hashes(old, entity_hashes(content))
+        except Exception as e:
+            logger.error('Metadata changes report failed: {}'.format(e))
+            return None
+        report['date'] = timezone.now().isoformat()
+        return json.dumps(report)
+
+    def _update(self, store, **fields):
+        """ Updates the refresh state without signals:
+            it doesn't change what the IdP serves
+        """
+        for k, v in fields.items():
+            setattr(store, k, v)
+        MetadataStore.objects.filter(pk=store.pk).update(**fields)
+
+    def refresh(self, store, force=False):
+        """ Returns 'updated', 'not modified' or 'failed'
+        """
+        headers = {}
+        if not force and store.has_local_copy:
+            if store.etag:
+                headers['If-None-Match'] = store.etag
+            if store.last_modified:
+                headers['If-Modified-Since'] = store.last_modified
+        try:
+            kwargs = json.loads(store.kwargs or '{}')
+        except ValueError:
+            kwargs = {}
+        verify_tls = not kwargs.get('disable_ssl_certificate_validation', False)
+
+        try:
+            response = self.session.get(store.url, headers=headers,
+                                        timeout=self.timeout, verify=verify_tls)
+            if response.status_code == 304:
+                valid_until = datetime_to_epoch(store.valid_until) \
+                              if store.valid_until else None
+                self._update(store, fetched=timezone.now(), refresh_error=None,
+                             next_refresh=self.next_refresh(valid_until))
+                return 'not modified'
+            response.raise_for_status()
+            content = response.content
+            self.verify(store, response.text)
+            valid_until, cache_duration = metadata_lifetime(content)
+        except Exception as e:
+            logger.error('Metadata refresh of {} failed: {}'.format(store.name, e))
+            self._update(store, refresh_error='{}'.format(e),
+                         next_refresh=timezone.now() + \
+                                      datetime.timedelta(seconds=self.retry))
+            return 'failed'
+
+        fields = dict(etag=response.headers.get('ETag'),
+                      last_modified=response.headers.get('Last-Modified'),
+                      fetched=timezone.now(),
+                      valid_until=epoch_to_datetime(valid_until) if valid_until else None,
+                      next_refresh=self.next_refresh(valid_until, cache_duration),
+                      refresh_error=None)
+
+        previous = None
+        if store.has_local_copy:
+            with open(store.local_copy_path, 'rb') as f:
+                previous = f.read()
+            if previous == content:
+                self._update(store, **fields)
+                return 'not modified'
+        fields['changes'] = self.changes_report(previous, content)
+        # a file name, SAML_IDP_METADATA_CACHE_DIR may differ on each node
+        fields['local_copy'] = self.local_copy_name(store)
+
+        path = os.path.join(metadata_cache_dir(), fields['local_copy'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        # only the refresh fields, and only if the url is still the
+        # downloaded one: the admin could have changed the store meanwhile
+        if not MetadataStore.objects.filter(pk=store.pk, url=store.url).update(**fields):
+            os.remove(tmp)
+            logger.error('Metadata refresh of {} discarded: '
+                         'the store changed during the download'.format(store.name))
+            return 'failed'
+        os.replace(tmp, path)
+        for k, v in fields.items():
+            setattr(store, k, v)
+        if entity_index_enabled():
+            # workers will find it ready when they reload
+            try:
+                get_entity_index(path)
+            except Exception as e:
+                logger.error('Metadata index of {} failed: {}'.format(store.name, e))
+
+        # all the workers load the new copy
+        invalidate_idp_server(MetadataStore, instance=store)
+        logger.info('Metadata {} refreshed from {}'.format(store.name, store.url))
+        return 'updated'
+
+    def due(self, force=False):
+        stores = MetadataStore.objects.filter(type='remote', is_active=True).\
+                                       exclude(url__isnull=True).exclude(url='')
+        if not force:
+            stores = stores.filter(Q(next_refresh__isnull=True) |
+                                   Q(next_refresh__lte=timezone.now()))
+        return stores
+
+    def refresh_due(self, force=False):
+        return [(store, self.refresh(store, force=force))
+                for store in self.due(force=force)]
+
+    def run(self, check_interval=None, stop_event=None):
+        """ Refreshes the stores when they are due, until stop_event is set
+        """
+        check_interval = check_interval or \
+                         getattr(settings, 'SAML_IDP_METADATA_REFRESH_CHECK', 60)
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                self.refresh_due()
+            except Exception as e:
+                logger.error('Metadata refresher error: {}'.format(e))
+            finally:
+                connections.close_all()
+            stop_event.wait(check_interval)
+
+
+metadata_refresher = MetadataRefresher()
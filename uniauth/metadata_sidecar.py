@@ -0,0 +1,408 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from collections.abc import Mapping
+
+from django.conf import settings
+from django.db import connections
+from saml2.mdstore import InMemoryMetaData
+
+from . compact_metadata import compact, metadata_compact_enabled
+from . ttl_cache import TTLCache
+from . versioning import config_version
+
+
+logger = logging.getLogger(__name__)
+
+# set in the sidecar process, that loads the metadata itself
+_serving = False
+
+
+def metadata_sidecar_socket():
+    return getattr(settings, 'SAML_IDP_METADATA_SIDECAR', None)
+
+
+def metadata_sidecar_mode():
+    return getattr(settings, 'SAML_IDP_METADATA_SIDECAR_MODE', 0o660)
+
+
+def metadata_sidecar_enabled():
+    """ True if the metadata must be looked up in the sidecar
+    """
+    return bool(metadata_sidecar_socket()) and not _serving
+
+
+def _json_default(value):
+    # compacted metadata
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+
+class SidecarError(Exception):
+    pass
+
+
+class MetadataSidecarClient(object):
+    """ Lookups in the metadata sidecar, one connection per thread,
+        with a LRU of the answers in front.
+        Each answer carries the configuration version loaded by the
+        sidecar: a cached answer is used only if it is not older
+        than the version the caller asks for.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self.cache = TTLCache(maxsize=getattr(settings,
+                                              'SAML_IDP_METADATA_SIDECAR_CACHE_SIZE',
+                                              1000),
+                              ttl=getattr(settings,
+                                          'SAML_IDP_METADATA_SIDECAR_CACHE_TTL',
+                                          300))
+        self._local = threading.local()
+
+    @property
+    def path(self):
+        return self._path or metadata_sidecar_socket()
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'SAML_IDP_METADATA_SIDECAR_TIMEOUT', 5)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except Exception:
+            sock.close()
+            raise
+        self._local.stream = sock.makefile('rwb')
+        self._local.sock = sock
+        self._local.pid = os.getpid()
+        return self._local.stream
+
+    def close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            try:
+                self._local.stream.close()
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+        self._local.stream = None
+
+    def _stream(self):
+        stream = getattr(self._local, 'stream', None)
+        # connections are not inherited by forked workers
+        if stream is None or self._local.pid != os.getpid():
+            stream = self._connect()
+        return stream
+
+    def request(self, op, **params):
+        """ Sends a request, returns (version, result)
+        """
+        params['op'] = op
+        line = json.dumps(params).encode() + b'\n'
+        for attempt in (1, 2):
+            try:
+                stream = self._stream()
+                stream.write(line)
+                stream.flush()
+                answer = stream.readline()
+                if not answer:
+                    raise ConnectionError('connection closed by the sidecar')
+                break
+            except OSError as e:
+                self.close()
+                if attempt == 2:
+                    raise SidecarError('Metadata sidecar {} unreachable: '
+                                       '{}'.format(self.path, e))
+        answer = json.loads(answer.decode())
+        if 'error' in answer:
+            raise SidecarError(answer['error'])
+        return answer['version'], answer['result']
+
+    def lookup(self, key, version=0, **params):
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] >= version:
+            return cached[1]
+        answer_version, result = self.request(key[0], version=version, **params)
+        self.cache.set(key, (answer_version, result))
+        return result
+
+    def entity(self, entity_id, version=0):
+        """ pysaml2 dict of entity_id, None if the sidecar doesn't know it
+        """
+        key = ('entity', entity_id)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] >= version:
+            return cached[1]
+        answer_version, entity = self.request('entity', entity_id=entity_id,
+                                              version=version)
+        if entity is not None and metadata_compact_enabled():
+            entity = compact(entity)
+        self.cache.set(key, (answer_version, entity))
+        return entity
+
+    def service(self, entity_id, typ, service, binding=None, version=0):
+        return self.lookup(('service', entity_id, typ, service, binding), version,
+                           entity_id=entity_id, typ=typ, service=service,
+                           binding=binding)
+
+    def certs(self, entity_id, descriptor, use='signing', version=0):
+        certs = self.lookup(('certs', entity_id, descriptor, use), version,
+                            entity_id=entity_id, descriptor=descriptor, use=use)
+        return [tuple(i) for i in certs]
+
+    def source(self, entity_id, version=0):
+        return self.lookup(('source', entity_id), version, entity_id=entity_id)
+
+    def keys(self, version=0):
+        return self.lookup(('keys',), version)
+
+    def records(self, version=0):
+        return self.lookup(('records',), version)
+
+    def ping(self):
+        return self.request('ping')
+
+
+metadata_sidecar_client = MetadataSidecarClient()
+
+
+class MetaDataSidecar(InMemoryMetaData):
+    """ pysaml2 metadata source that looks up the entities,
+        their endpoints and certificates in the metadata sidecar.
+        version is the configuration version of the IdP Server
+        this source belongs to.
+    """
+
+    def __init__(self, attrc, path=None, version=0, **kwargs):
+        super().__init__(attrc, **kwargs)
+        self.client = MetadataSidecarClient(path) if path else metadata_sidecar_client
+        self.version = version
+
+    def load(self, *args, **kwargs):
+        version, status = self.client.ping()
+        logger.info('Metadata sidecar {}: {} entities '
+                    '[version {}]'.format(self.client.path,
+                                          status['entities'], version))
+
+    def __getitem__(self, item):
+        try:
+            entity = self.client.entity(item, self.version)
+        except SidecarError as e:
+            logger.error('Metadata sidecar lookup of {} failed: {}'.format(item, e))
+            raise KeyError(item)
+        if entity is None:
+            raise KeyError(item)
+        return entity
+
+    def __contains__(self, item):
+        try:
+            self[item]
+        except KeyError:
+            return False
+        return True
+
+    def service(self, entity_id, typ, service, binding=None):
+        try:
+            return self.client.service(entity_id, typ, service, binding,
+                                       version=self.version)
+        except SidecarError as e:
+            logger.error('Metadata sidecar lookup of {} failed: {}'.format(entity_id, e))
+            return None
+
+    def certs(self, entity_id, descriptor, use='signing'):
+        try:
+            return self.client.certs(entity_id, descriptor, use,
+                                     version=self.version)
+        except SidecarError as e:
+            logger.error('Metadata sidecar lookup of {} failed: {}'.format(entity_id, e))
+            raise KeyError(entity_id)
+
+    def source(self, entity_id):
+        """ key of the sidecar source that has entity_id
+        """
+        try:
+            return self.client.source(entity_id, self.version)
+        except SidecarError as e:
+            logger.error('Metadata sidecar lookup of {} failed: {}'.format(entity_id, e))
+
+    def keys(self):
+        try:
+            return self.client.keys(self.version)
+        except SidecarError as e:
+            logger.error('Metadata sidecar lookup failed: {}'.format(e))
+            return []
+
+    def records(self):
+        """ entity search records, see uniauth.entity_search
+        """
+        try:
+            return self.client.records(self.version)
+        except SidecarError as e:
+            logger.error('Metadata sidecar lookup failed: {}'.format(e))
+            return []
+
+    def items(self):
+        return [(entity_id, self[entity_id]) for entity_id in self.keys()]
+
+    def values(self):
+        return [entity for entity_id, entity in self.items()]
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class SidecarRequestHandler(socketserver.StreamRequestHandler):
+    """ One JSON request per line, one JSON answer per line
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                version, result = self.server.sidecar.answer(request)
+                answer = {'version': version, 'result': result}
+            except Exception as e:
+                answer = {'error': '{}'.format(e)}
+            self.wfile.write(json.dumps(answer, default=_json_default).encode() + b'\n')
+            self.wfile.flush()
+
+
+class SidecarServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetadataSidecar(object):
+    """ Loads the metadata once and answers the lookups of the workers
+        on a Unix socket. The metadata is loaded again, in background,
+        when the shared configuration version moves or when a worker
+        asks for a newer version; the previous one is served meanwhile.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or metadata_sidecar_socket()
+        self.mds = None
+        self.version = None
+        self.requested = 0
+        self.server = None
+        self._wakeup = threading.Event()
+
+    def load(self):
+        from . utils import build_idp_server
+
+        version = max(config_version.current(), self.requested)
+        start = time.time()
+        try:
+            mds = build_idp_server().metadata
+        finally:
+            connections.close_all()
+        self.mds, self.version = mds, version
+        logger.info('Metadata sidecar loaded {} entities in {:.2f}s '
+                    '[version {}]'.format(len(mds.keys()),
+                                          time.time() - start, version))
+
+    def watch(self, stop_event):
+        while not stop_event.is_set():
+            self._wakeup.wait(config_version.interval)
+            self._wakeup.clear()
+            if max(config_version.current(), self.requested) == self.version:
+                continue
+            try:
+                self.load()
+            except Exception as e:
+                logger.error('Metadata sidecar reload failed, '
+                             'still serving the previous metadata: {}'.format(e))
+
+    def answer(self, request):
+        mds, version = self.mds, self.version
+        op = request['op']
+        if request.get('version', 0) > version:
+            # a worker already knows about a newer configuration
+            self.requested = max(self.requested, request['version'])
+            self._wakeup.set()
+        if op == 'ping':
+            return version, {'entities': len(mds.keys()), 'pid': os.getpid()}
+        elif op == 'entity':
+            try:
+                return version, mds[request['entity_id']]
+            except KeyError:
+                return version, None
+        elif op == 'service':
+            for _md in mds.metadata.values():
+                srvs = _md.service(request['entity_id'], request['typ'],
+                                   request['service'], request.get('binding'))
+                if srvs is not None:
+                    return version, srvs
+            return version, None
+        elif op == 'certs':
+            try:
+                return version, mds.certs(request['entity_id'],
+                                          request['descriptor'],
+                                          request.get('use', 'signing'))
+            except KeyError:
+                raise SidecarError('Unknown entity: {}'.format(request['entity_id']))
+        elif op == 'source':
+            return version, mds.source(request['entity_id'])
+        elif op == 'keys':
+            return version, list(mds.keys())
+        elif op == 'records':
+            from . entity_search import metadata_records
+            return version, metadata_records(mds)
+        raise SidecarError('Unknown request: {}'.format(op))
+
+    def bind(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # left by a previous run
+                os.unlink(self.path)
+            else:
+                raise SidecarError('Metadata sidecar already '
+                                   'running on {}'.format(self.path))
+            finally:
+                probe.close()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # the socket is created with its final mode, it's never
+        # reachable with the permissions of the process umask
+        umask = os.umask(0o777 & ~metadata_sidecar_mode())
+        try:
+            self.server = SidecarServer(self.path, SidecarRequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.sidecar = self
+
+    def serve(self, stop_event=None):
+        """ Loads the metadata, then serves until stop_event is set
+        """
+        global _serving
+        _serving = True
+        stop_event = stop_event or threading.Event()
+        self.load()
+        self.bind()
+        watcher = threading.Thread(target=self.watch, args=(stop_event,),
+                                   name='uniauth-sidecar-watch', daemon=True)
+        watcher.start()
+        server = threading.Thread(target=self.server.serve_forever,
+                                  name='uniauth-sidecar', daemon=True)
+        server.start()
+        logger.info('Metadata sidecar listening on {}'.format(self.path))
+        try:
+            stop_event.wait()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            self._wakeup.set()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
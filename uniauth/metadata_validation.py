@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from defusedxml.ElementTree import iterparse
+from django.conf import settings
+from django.utils import timezone
+
+
+# this module is imported by the validation processes too:
+# it must not import Django models
+
+ENTITY_DESCRIPTOR = '{urn:oasis:names:tc:SAML:2.0:metadata}EntityDescriptor'
+CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def metadata_validation_workers():
+    return getattr(settings, 'SAML_IDP_METADATA_VALIDATION_WORKERS', 8)
+
+
+def metadata_validation_processes():
+    return getattr(settings, 'SAML_IDP_METADATA_VALIDATION_PROCESSES', 0)
+
+
+class HashingReader(object):
+    """ File wrapper that updates the sha256 with what the parser reads
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        # what the parser didn't read, after an error
+        for data in iter(lambda: self.read(CHUNK_SIZE), b''):
+            pass
+        return self.sha256.hexdigest()
+
+
+def validate_metadata_file(path, previous=None):
+    """ Checks that a metadata file is a well formed XML, stream parsing
+        it from the file, without building its tree, and computes its sha256
+        in the same pass. previous is the result of the last validation
+        of the same path: it's reused if size, mtime and sha256 didn't change,
+        only hashing the file
+    """
+    result = {'path': path, 'error': None}
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            result.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+            reader = HashingReader(f)
+            if previous and all(previous.get(k) == result[k]
+                                for k in ('size', 'mtime')):
+                result['sha256'] = reader.hexdigest()
+                if previous.get('sha256') == result['sha256']:
+                    return dict(previous, cached=True)
+                f.seek(0)
+                reader = HashingReader(f)
+
+            entities = 0
+            try:
+                for event, elem in iterparse(reader, events=('end',)):
+                    if elem.tag == ENTITY_DESCRIPTOR:
+                        entities += 1
+                        elem.clear()
+            except OSError:
+                raise
+            except Exception as e:
+                result['error'] = '{}'.format(e)
+            result.update(entities=entities, sha256=reader.hexdigest())
+    except OSError as e:
+        result['error'] = '{}'.format(e)
+    return result
+
+
+def validate_metadata_files(paths, previous=None):
+    """ Validates the files in parallel, returns the report:
+        the result of each file, in paths order.
+        previous is the last report of the same files
+    """
+    start = time.time()
+    previous = {i['path']: i for i in (previous or {}).get('files', [])}
+    processes = metadata_validation_processes()
+    if processes and len(paths) > processes and \
+       'uwsgi' in sys.modules and \
+       os.path.basename(sys.executable).startswith('uwsgi'):
+        # the processes would run uWSGI, not Python
+        logger.error('SAML_IDP_METADATA_VALIDATION_PROCESSES needs the py-executable '
+                     'uWSGI option, the metadata files are validated by threads')
+        processes = 0
+    if processes and len(paths) > processes:
+        # not forked: the admin process runs other threads
+        executor = ProcessPoolExecutor(max_workers=processes,
+                                       mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(max_workers=metadata_validation_workers(),
+                                      thread_name_prefix='uniauth-validation')
+    with executor:
+        files = list(executor.map(validate_metadata_file, paths,
+                                  [previous.get(path) for path in paths],
+                                  chunksize=50))
+    return {'date': timezone.now().isoformat(),
+            'seconds': round(time.time() - start, 3),
+            'cached': sum(1 for i in files if i.get('cached')),
+            'files': files}
@@ -0,0 +1,174 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+                IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def metadata_watch_enabled():
+    return getattr(settings, 'SAML_IDP_METADATA_WATCH', False)
+
+
+def directory_snapshot(directory):
+    """ path -> (size, mtime) of the files in a directory
+    """
+    snapshot = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if os.path.isfile(path):
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+class Inotify(object):
+    """ Minimal inotify through libc, Linux only:
+        wait() returns as soon as a watched directory changes
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = set()
+
+    def add(self, path):
+        if path in self.watches:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch {} failed'.format(path))
+        self.watches.add(path)
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout, settle=0.5):
+        """ True if something changed before timeout
+        """
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return False
+        # let the writer finish
+        select.select([], [], [], settle)
+        self.drain()
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher(object):
+    """ Checks the local metadata directories of the IdP Server of this
+        process every SAML_IDP_METADATA_WATCH_INTERVAL seconds, or as soon
+        as inotify reports a change, and reloads in place only the
+        files added, changed or removed, see
+        UniAuthMetadataStore.update_directory
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    @property
+    def interval(self):
+        return getattr(settings, 'SAML_IDP_METADATA_WATCH_INTERVAL', 10)
+
+    def start(self, get_store):
+        """ get_store returns the MetadataStore currently served
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self.stop_event.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run,
+                                            args=(get_store, self.stop_event),
+                                            name='uniauth-metadata-watch',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self._lock:
+            self._thread = None
+
+    def check(self, store):
+        """ Returns the number of files reloaded
+        """
+        updated = 0
+        for directory, previous in list((getattr(store, 'directories', None) or {}).items()):
+            try:
+                snapshot = directory_snapshot(directory)
+            except OSError as e:
+                logger.error('Metadata directory {} not readable: {}'.format(directory, e))
+                continue
+            if snapshot == previous:
+                continue
+            reloaded, removed = store.update_directory(directory, snapshot)
+            logger.info('Metadata directory {}: {} files reloaded, '
+                        '{} removed'.format(directory, len(reloaded), len(removed)))
+            updated += len(reloaded) + len(removed)
+        return updated
+
+    def run(self, get_store, stop_event):
+        try:
+            inotify = Inotify()
+        except Exception as e:
+            logger.info('inotify not available, metadata directories polled '
+                        'every {} seconds: {}'.format(self.interval, e))
+            inotify = None
+        try:
+            while not stop_event.is_set():
+                store = get_store()
+                if store is not None:
+                    for directory in list(getattr(store, 'directories', None) or ()):
+                        if inotify is not None:
+                            try:
+                                inotify.add(directory)
+                            except OSError as e:
+                                logger.error('{}'.format(e))
+                    try:
+                        self.check(store)
+                    except Exception as e:
+                        logger.error('Metadata directory watcher error: {}'.format(e))
+                if inotify is not None:
+                    inotify.wait(self.interval)
+                else:
+                    stop_event.wait(self.interval)
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+
+metadata_watcher = DirectoryWatcher()
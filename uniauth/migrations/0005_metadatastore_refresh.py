@@ -0,0 +1,48 @@
+# Generated by Django 2.2.2 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniauth', '0004_configversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadatastore',
+            name='local_copy',
+            field=models.CharField(blank=True, help_text='last verified copy of a remote metadata, served in place of the url', max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='metadatastore',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='metadatastore',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='metadatastore',
+            name='fetched',
+            field=models.DateTimeField(blank=True, help_text='last successful download or check', null=True),
+        ),
+        migrations.AddField(
+            model_name='metadatastore',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, help_text='validUntil of the local copy', null=True),
+        ),
+        migrations.AddField(
+            model_name='metadatastore',
+            name='next_refresh',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='metadatastore',
+            name='refresh_error',
+            field=models.TextField(blank=True, help_text='last refresh failure, the previous copy is still served', null=True),
+        ),
+    ]
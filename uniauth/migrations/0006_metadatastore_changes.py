@@ -0,0 +1,18 @@
+# Generated by Django 2.2.2 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniauth', '0005_metadatastore_refresh'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadatastore',
+            name='changes',
+            field=models.TextField(blank=True, help_text='entities added, changed and removed by the last refresh', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.2 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniauth', '0006_metadatastore_changes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadatastore',
+            name='validation',
+            field=models.TextField(blank=True, help_text='result of the last validation of each local file', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.2 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniauth', '0007_metadatastore_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadatastore',
+            name='auto_federate',
+            field=models.BooleanField(default=False, help_text='federate on first use the SPs found in this metadata'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.2 on 2026-10-18 19:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniauth', '0008_metadatastore_auto_federate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='configversionnode',
+            name='updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='configversionnode',
+            name='last_seen',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,8 +1,5 @@
-import defusedxml
 import os
 import json
-import requests
-import saml2.xmldsig
 
 from datetime import timedelta
 from django.conf import settings
@@ -12,7 +9,21 @@ from django.utils import timezone
 from django.utils.translation import gettext as _
 from django.utils.module_loading import import_string
 
+from django_idp.lazy_choices import LazyChoices
+
 from . exceptions import NotYetImplemented
+from . metadata_validation import validate_metadata_files
+from . metadata_watch import directory_snapshot
+
+
+def signing_algorithm_choices():
+    from saml2.xmldsig import SIG_ALLOWED_ALG
+    return [(y,x) for x,y in SIG_ALLOWED_ALG]
+
+
+def digest_algorithm_choices():
+    from saml2.xmldsig import DIGEST_ALLOWED_ALG
+    return [(y,x) for x,y in DIGEST_ALLOWED_ALG]
 
 
 class AgreementRecord(models.Model):
@@ -52,10 +63,10 @@ class ServiceProvider(models.Model):
     agreement_screen = models.BooleanField(default=settings.SAML_IDP_SHOW_USER_AGREEMENT_SCREEN)
     agreement_consent_form = models.BooleanField(default=settings.SAML_IDP_SHOW_CONSENT_FORM)
     agreement_message = models.TextField(blank=True, default='')
-    signing_algorithm = models.CharField(choices=[(y,x) for x,y in saml2.xmldsig.SIG_ALLOWED_ALG],
+    signing_algorithm = models.CharField(choices=LazyChoices(signing_algorithm_choices),
                                          default=settings.SAML_AUTHN_SIGN_ALG,
                                          max_length=256)
-    digest_algorithm = models.CharField(choices=[(y,x) for x,y in saml2.xmldsig.DIGEST_ALLOWED_ALG],
+    digest_algorithm = models.CharField(choices=LazyChoices(digest_algorithm_choices),
                                         default=settings.SAML_AUTHN_DIGEST_ALG,
                                         max_length=256)
     encrypt_saml_responses = models.BooleanField(default=False)
@@ -104,12 +115,14 @@ class ServiceProvider(models.Model):
             error = 'Attribute Mapping is not a valid JSON format: {}'.format(e)
             self.is_active = False
 
-        # test if its entityID is available in metadatastore
+        # test if its entityID is available in metadatastore,
+        # also if SAML_IDP_METADATA_SELECTIVE didn't load it yet
         try:
+            from saml2.s_utils import UnknownSystemEntity
+
             get_idp_config = import_string('uniauth.utils.get_idp_config')
-            get_idp_config().metadata.service(self.entity_id,
-                                              "spsso_descriptor",
-                                              'assertion_consumer_service')
+            if not get_idp_config().metadata.in_sources(self.entity_id):
+                raise UnknownSystemEntity(self.entity_id)
         except Exception as e:
             error = '{} is not present in any Metadata'.format(e)
             self.is_active = False
@@ -168,6 +181,30 @@ class MetadataStore(models.Model):
     updated = models.DateTimeField(auto_now=True,null=True, blank=True,
                                    help_text=_('when last download/validation occourred'))
 
+    # remote metadata refresh, see uniauth.metadata_refresh
+    local_copy = models.CharField(max_length=512, blank=True, null=True,
+                                  help_text=_('last verified copy of a remote '
+                                              'metadata, served in place of the url'))
+    etag = models.CharField(max_length=255, blank=True, null=True)
+    last_modified = models.CharField(max_length=255, blank=True, null=True)
+    fetched = models.DateTimeField(blank=True, null=True,
+                                   help_text=_('last successful download or check'))
+    valid_until = models.DateTimeField(blank=True, null=True,
+                                       help_text=_('validUntil of the local copy'))
+    next_refresh = models.DateTimeField(blank=True, null=True)
+    refresh_error = models.TextField(blank=True, null=True,
+                                     help_text=_('last refresh failure, '
+                                                 'the previous copy is still served'))
+    changes = models.TextField(blank=True, null=True,
+                               help_text=_('entities added, changed and removed '
+                                           'by the last refresh'))
+    validation = models.TextField(blank=True, null=True,
+                                  help_text=_('result of the last validation '
+                                              'of each local file'))
+    auto_federate = models.BooleanField(default=False,
+                                        help_text=_('federate on first use the SPs '
+                                                    'found in this metadata'))
+
     class Meta:
         verbose_name = _('Metadata Store')
         verbose_name_plural = _('Metadatas Store')
@@ -195,13 +232,58 @@ class MetadataStore(models.Model):
         stores = cls.objects.filter(is_active=True, is_valid=True)
         d = {}
         for store in stores:
-            if not d.get(store.type):
-                d[store.type] = []
-            d[store.type].append(store.as_pysaml2_mdstore_row())
+            if not d.get(store.pysaml2_type):
+                d[store.pysaml2_type] = []
+            d[store.pysaml2_type].append(store.as_pysaml2_mdstore_row())
         return d
 
+    def save(self, *args, **kwargs):
+        # the local copy and the conditional request headers
+        # belong to the previous url, download the new one at the next refresh
+        update_fields = kwargs.get('update_fields')
+        if self.pk and (update_fields is None or 'url' in update_fields) and \
+           MetadataStore.objects.filter(pk=self.pk).exclude(url=self.url).exists():
+            self.local_copy = None
+            self.etag = None
+            self.last_modified = None
+            self.valid_until = None
+            self.next_refresh = None
+        super().save(*args, **kwargs)
+
+    @property
+    def local_copy_path(self):
+        """ local_copy is a file name in SAML_IDP_METADATA_CACHE_DIR,
+            resolved on each node
+        """
+        if not self.local_copy:
+            return
+        from . metadata_refresh import metadata_cache_dir
+        return os.path.join(metadata_cache_dir(), self.local_copy)
+
+    @property
+    def has_local_copy(self):
+        # a node that doesn't see the copy loads the url
+        return self.type == 'remote' and bool(self.local_copy) and \
+               os.path.exists(self.local_copy_path)
+
+    @property
+    def pysaml2_type(self):
+        """ a refreshed remote metadata is loaded from its local copy
+        """
+        return 'local' if self.has_local_copy else self.type
+
+    @property
+    def is_stale(self):
+        """ the last refresh failed or the local copy is expired
+        """
+        if self.valid_until and self.valid_until < timezone.now():
+            return True
+        return bool(self.refresh_error)
+
     def as_pysaml2_mdstore_row(self):
-        if self.type in ('remote', 'mdq'):
+        if self.has_local_copy:
+            return self.local_copy_path
+        elif self.type in ('remote', 'mdq'):
             d = dict(url=self.url)
             if self.file: d['cert'] = self.file.path
             if self.kwargs:
@@ -212,12 +294,42 @@ class MetadataStore(models.Model):
             return (self.url) if not self.file else (self.file.path)
         raise NotYetImplemented('see models.MetadataStore.as_pysaml2_mdstore_row')
 
+    def provides_source(self, key):
+        """ True if the pysaml2 metadata source key belongs to this store
+        """
+        row = self.as_pysaml2_mdstore_row()
+        if isinstance(row, dict):
+            row = row['url']
+        return key == row or key.startswith(os.path.join(row, ''))
+
+    def local_files(self):
+        """ metadata files of a local store
+        """
+        files = []
+        if self.file:
+            files.append(self.file.path)
+        if self.url and os.path.isdir(self.url):
+            files.extend(directory_snapshot(self.url))
+        elif self.url:
+            files.append(self.url)
+        return files
+
+    def validation_report(self):
+        try:
+            return json.loads(self.validation or '{}')
+        except ValueError:
+            return {}
+
     def validate(self):
         error = None
         if self.type in ('remote', 'mdq'):
             if self.url:
+                import requests
                 try:
-                    r = requests.get(self.url)
+                    r = requests.get(self.url,
+                                     timeout=getattr(settings,
+                                                     'SAML_IDP_METADATA_TIMEOUT',
+                                                     10))
                     if r.status_code != 200:
                         self.is_active = False
                 except Exception as e:
@@ -227,12 +339,15 @@ class MetadataStore(models.Model):
         elif self.type == 'local':
             # check that is a valid XML file, avoids: pysaml2 Exception on parse
             try:
-                if self.file:
-                    defusedxml.ElementTree.fromstring(open(self.file.path).read())
-                if self.url:
-                    files = [os.path.join(self.url, f) for f in os.listdir(self.url)]
-                    for f in files:
-                        defusedxml.ElementTree.fromstring(open(f).read())
+                report = validate_metadata_files(self.local_files(),
+                                                 self.validation_report())
+                self.validation = json.dumps(report)
+                invalid = [i for i in report['files'] if i['error']]
+                if invalid:
+                    raise Exception('{}: {}{}'.format(invalid[0]['path'],
+                                                      invalid[0]['error'],
+                                                      ' and {} more files'.format(len(invalid) - 1)
+                                                      if len(invalid) > 1 else ''))
             except Exception as e:
                 self.is_active = False
                 error = 'found an invalid XML: {}'.format(e)
@@ -263,3 +378,37 @@ class MetadataStore(models.Model):
 
     def __str__(self):
         return '{} [{}]'.format(self.name, self.is_valid)
+
+
+class ConfigVersion(models.Model):
+    """ Shared configuration version, incremented on every change
+        that needs all the IdP workers to reload their configuration
+    """
+    name = models.CharField(max_length=64, unique=True)
+    version = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _('Configuration Version')
+        verbose_name_plural = _('Configuration Versions')
+
+    def __str__(self):
+        return '{} [{}]'.format(self.name, self.version)
+
+
+class ConfigVersionNode(models.Model):
+    """ Configuration version served by each IdP worker (hostname:pid)
+    """
+    node = models.CharField(max_length=255, unique=True)
+    version = models.PositiveIntegerField(default=0)
+    # last reload
+    updated = models.DateTimeField(default=timezone.now)
+    # last report, nodes not seen for SAML_IDP_CONFIG_VERSION_NODE_TTL are removed
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = _('Configuration Version Node')
+        verbose_name_plural = _('Configuration Version Nodes')
+
+    def __str__(self):
+        return '{} [{}]'.format(self.node, self.version)
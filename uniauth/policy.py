@@ -0,0 +1,87 @@
+import copy
+import logging
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledPolicy(object):
+    """ Outcome of the pysaml2 Policy (entity categories and
+        attribute restrictions) for a single SP, computed once.
+        allowed is the set of releasable attribute names (lowercase),
+        None means no restriction. value_filters contains, for each
+        attribute, the lists of compiled regexes its values must match.
+    """
+    __slots__ = ('entity_id', 'entity_categories', 'allowed', 'value_filters')
+
+    def __init__(self, entity_id, entity_categories=None,
+                 allowed=None, value_filters=None):
+        self.entity_id = entity_id
+        self.entity_categories = entity_categories or []
+        self.allowed = allowed
+        self.value_filters = value_filters or {}
+
+    def restrict(self, restrictions):
+        """ Adds a pysaml2 restrictions dict,
+            applied after the previous ones
+        """
+        if not restrictions:
+            return
+        keys = frozenset(restrictions.keys())
+        self.allowed = keys if self.allowed is None else self.allowed & keys
+        for attr, regexes in restrictions.items():
+            if regexes is not None:
+                self.value_filters.setdefault(attr, []).append(regexes)
+
+    def filter(self, ava):
+        """ Same result of saml2.assertion.Policy.filter, for
+            unrestricted attributes it's a set membership test
+        """
+        released = {}
+        for attr, vals in ava.items():
+            lattr = attr.lower()
+            if self.allowed is not None and lattr not in self.allowed:
+                continue
+            filters = self.value_filters.get(lattr)
+            if filters:
+                if isinstance(vals, str):
+                    vals = [vals]
+                for regexes in filters:
+                    vals = [val for val in vals
+                            if any(regex.match(val) for regex in regexes)]
+                # unique values, in their original order
+                vals = list(dict.fromkeys(vals))
+                if not vals:
+                    continue
+            released[attr] = vals
+        return released
+
+    def as_dict(self):
+        return {'entity_id': self.entity_id,
+                'entity_categories': self.entity_categories,
+                'released_attributes': sorted(self.allowed) \
+                                       if self.allowed is not None else 'all',
+                'value_restrictions': {attr: [[r.pattern for r in regexes]
+                                              for regexes in filters]
+                                       for attr, filters in self.value_filters.items()}}
+
+
+def compile_policy(IDP, entity_id):
+    """ Evaluates SAML_IDP_CONFIG policy against the metadata of entity_id
+    """
+    from saml2.assertion import Policy
+    restrictions = settings.SAML_IDP_CONFIG['service']['idp'].get('policy')
+    # Policy compiles the restrictions in place
+    policy = Policy(restrictions=copy.deepcopy(restrictions))
+    compiled = CompiledPolicy(entity_id)
+    try:
+        compiled.entity_categories = list(IDP.metadata.entity_categories(entity_id))
+    except Exception:
+        pass
+    compiled.restrict(policy.get_entity_categories(entity_id,
+                                                   IDP.config.metadata,
+                                                   []))
+    compiled.restrict(policy.get_attribute_restrictions(entity_id))
+    return compiled
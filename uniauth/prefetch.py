@@ -0,0 +1,75 @@
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+from . profiles import get_sp_profile
+
+
+logger = logging.getLogger(__name__)
+
+
+def sp_prefetch_workers():
+    return getattr(settings, 'SAML_IDP_SP_PREFETCH_WORKERS', 2)
+
+
+class SPProfilePrefetcher(object):
+    """ Resolves the metadata and compiles the runtime profile of a SP
+        in background, while the user is on the login form, so that
+        they are already in the caches when LoginProcessView runs.
+        A SP already being prefetched is not submitted again.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._pid = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # threads are not inherited by forked workers
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=sp_prefetch_workers(),
+                                                        thread_name_prefix='uniauth-prefetch')
+                    self._pid = os.getpid()
+                    self._pending = set()
+        return self._executor
+
+    def prefetch(self, IDP, entity_id):
+        """ Non blocking, returns the Future or None if not submitted
+        """
+        if not sp_prefetch_workers() or not entity_id:
+            return
+        executor = self.executor
+        with self._lock:
+            if entity_id in self._pending:
+                return
+            self._pending.add(entity_id)
+        try:
+            return executor.submit(self.run, IDP, entity_id)
+        except RuntimeError as e:
+            # interpreter shutting down
+            logger.debug('SP prefetch of {} not submitted: {}'.format(entity_id, e))
+            with self._lock:
+                self._pending.discard(entity_id)
+
+    def run(self, IDP, entity_id):
+        try:
+            return get_sp_profile(IDP, entity_id)
+        except Exception as e:
+            logger.debug('SP prefetch of {} failed: {}'.format(entity_id, e))
+        finally:
+            with self._lock:
+                self._pending.discard(entity_id)
+            # the registry may have queried the database from this thread
+            connections.close_all()
+
+
+sp_prefetcher = SPProfilePrefetcher()
@@ -0,0 +1,262 @@
+import logging
+import threading
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext as _
+
+from . federation import auto_federate
+from . metadata_changes import metadata_changes
+from . policy import compile_policy
+from . processors import BaseProcessor
+from . registry import get_sp_registry
+from . versioning import config_version
+
+
+logger = logging.getLogger(__name__)
+
+
+def encryption_certificate(IDP, entity_id):
+    """ The first encryption certificate of entity_id in the metadata
+        that can be loaded, parsed once: the one pysaml2 would pick trying
+        each of them. None if there's none, pysaml2 then looks for them.
+    """
+    from cryptography import x509
+    from saml2.sigver import get_pem_wrapped_unwrapped
+
+    try:
+        certs = IDP.metadata.certs(entity_id, "any", "encryption")
+    except Exception:
+        return
+    for name, cert in certs:
+        wrapped, unwrapped = get_pem_wrapped_unwrapped(cert)
+        try:
+            x509.load_pem_x509_certificate(wrapped.encode('ascii'))
+        except Exception as e:
+            logger.error('Encryption certificate of {} skipped: {}'.format(entity_id, e))
+            continue
+        return cert
+
+
+class SPRuntimeProfile(object):
+    """ Everything a SSO response needs to know about a SP,
+        resolved once per SP and configuration version
+        from SAML_IDP_SPCONFIG, settings and metadata.
+        Views only read it.
+    """
+    __slots__ = ('entity_id',
+                 '_server',
+                 'version',
+                 'generation',
+                 'config',
+                 'processor_class',
+                 'processor_error',
+                 'endpoints',
+                 'default_endpoint',
+                 'sign_response',
+                 'sign_assertion',
+                 'sign_alg',
+                 'digest_alg',
+                 'encrypt_assertion',
+                 'encrypt_advice_attributes',
+                 'encrypt_cert',
+                 'idp_name_id_formats',
+                 'attrs_to_exclude',
+                 'policy',
+                 'authn_broker')
+
+    def __init__(self, IDP, entity_id, config):
+        self.entity_id = entity_id
+        self.server = IDP
+        self.version = None
+        # metadata load the profile was resolved from
+        self.generation = getattr(IDP.metadata, 'generation', None)
+        self.config = config
+
+        # attribute processor
+        self.processor_class = BaseProcessor
+        self.processor_error = None
+        processor_string = config.get('processor', None)
+        if processor_string:
+            try:
+                self.processor_class = import_string(processor_string)
+            except Exception as e:
+                self.processor_error = e
+
+        # AssertionConsumerService endpoints by binding
+        self.endpoints = {}
+        try:
+            acs = IDP.metadata.service(entity_id, 'spsso_descriptor',
+                                       'assertion_consumer_service') or {}
+        except Exception:
+            acs = {}
+        for binding, srvs in acs.items():
+            self.endpoints[binding] = [srv['location'] for srv in srvs]
+        try:
+            self.default_endpoint = IDP.pick_binding(service="assertion_consumer_service",
+                                                     entity_id=entity_id)
+        except Exception:
+            self.default_endpoint = None
+
+        # signature
+        self.sign_response = config.get("sign_response") or \
+                             IDP.config.getattr("sign_response", "idp") or \
+                             False
+        self.sign_assertion = config.get("sign_assertion") or \
+                              IDP.config.getattr("sign_assertion", "idp") or \
+                              False
+        # default will be sha1 in pySAML2
+        self.sign_alg = config.get("signing_algorithm") or \
+                        getattr(settings, 'SAML_AUTHN_SIGN_ALG', False)
+        self.digest_alg = config.get("digest_algorithm") or \
+                          getattr(settings, 'SAML_AUTHN_DIGEST_ALG', False)
+
+        # encryption
+        self.encrypt_assertion = config.get('encrypt_saml_responses',
+                                            getattr(settings,
+                                                    'SAML_ENCRYPT_AUTHN_RESPONSE',
+                                                    False))
+        self.encrypt_advice_attributes = config.get('encrypt_advice_attributes',
+                                                    getattr(settings,
+                                                            'SAML_ENCRYPT_ADV_ATTRIBUTES',
+                                                            False))
+        self.encrypt_cert = encryption_certificate(IDP, entity_id)
+
+        # NameID formats
+        self.idp_name_id_formats = IDP.config.getattr("name_id_format", "idp") or []
+
+        self.attrs_to_exclude = config.get('user_agreement_attr_exclude', []) + \
+                                getattr(settings, "SAML_IDP_USER_AGREEMENT_ATTR_EXCLUDE", [])
+
+        # attribute release policy
+        self.policy = compile_policy(IDP, entity_id)
+
+        from saml2.authn_context import (PASSWORD,
+                                         AuthnBroker,
+                                         authn_context_class_ref)
+        self.authn_broker = AuthnBroker()
+        self.authn_broker.add(authn_context_class_ref(PASSWORD), "")
+
+    @property
+    def server(self):
+        """ The Server the profile was compiled against, None if it
+            was rebuilt and collected: a weak reference, idle profiles
+            don't keep the previous Servers and their metadata alive
+        """
+        return self._server()
+
+    @server.setter
+    def server(self, IDP):
+        self._server = weakref.ref(IDP)
+
+    def get_processor(self):
+        """ Instance of the user-specified processor or
+            of the all-access base processor.
+            Raises ImproperlyConfigured if the configured
+            processor can not be found or initialized.
+        """
+        processor_string = self.config.get('processor', None)
+        msg = _("Failed to instantiate processor: {} - {}")
+        if self.processor_error:
+            logger.error(msg.format(processor_string, self.processor_error))
+            raise ImproperlyConfigured(msg.format(processor_string,
+                                                  self.processor_error))
+        try:
+            return self.processor_class(self.entity_id)
+        except Exception as e:
+            logger.error(msg.format(processor_string, e), exc_info=True)
+            raise ImproperlyConfigured(msg.format(processor_string, e))
+
+    def get_authn(self):
+        from saml2.authn_context import PASSWORD
+        return self.authn_broker.get_authn_by_accr(PASSWORD)
+
+    def pick_endpoint(self):
+        """ (binding, destination) for unsolicited responses
+        """
+        if not self.default_endpoint:
+            from saml2.s_utils import UnsupportedBinding
+            raise UnsupportedBinding(_("No AssertionConsumerService "
+                                       "found for {}").format(self.entity_id))
+        return self.default_endpoint
+
+    def has_endpoint(self, binding, destination):
+        return destination in self.endpoints.get(binding, ())
+
+    def name_id_format(self, requested=None):
+        """ Negotiates the NameID format with the one requested by the SP
+        """
+        idp_formats = self.idp_name_id_formats
+        if idp_formats and not requested:
+            return idp_formats[0]
+        elif requested and not idp_formats:
+            return requested
+        elif requested in idp_formats:
+            return requested
+        elif requested:
+            raise ValueError(_('SP requested a name_id_format '
+                               'that is not supported in the IDP'))
+        from saml2.saml import NAMEID_FORMAT_UNSPECIFIED
+        return NAMEID_FORMAT_UNSPECIFIED
+
+
+class SPProfileCache(object):
+    """ Profiles of the current configuration version and IdP Server.
+        When they change, or the metadata is updated in place,
+        a profile is compiled again only if its SP configuration
+        or its metadata changed, see metadata_changes
+    """
+
+    def __init__(self):
+        self.profiles = {}
+        self._lock = threading.Lock()
+
+    def get(self, IDP, entity_id):
+        version = config_version.current()
+        profile = self.profiles.get(entity_id)
+        if profile is not None and profile.server is IDP and \
+           profile.version == version and \
+           profile.generation == getattr(IDP.metadata, 'generation', None):
+            return profile
+
+        try:
+            config = get_sp_registry()[entity_id]
+        except KeyError:
+            config = None
+        if config is None and auto_federate(IDP, entity_id):
+            config = get_sp_registry()[entity_id]
+        if config is None:
+            with self._lock:
+                self.profiles.pop(entity_id, None)
+            return None
+        generation = getattr(IDP.metadata, 'generation', None)
+        if profile is not None and generation is not None and \
+           profile.generation is not None and generation < profile.generation:
+            # a request still served by the previous Server
+            return SPRuntimeProfile(IDP, entity_id, config)
+        if profile is not None and profile.config == config and \
+           metadata_changes.unchanged_since(entity_id, profile.generation):
+            # still valid with the new Server
+            profile.server = IDP
+            profile.generation = generation
+        else:
+            profile = SPRuntimeProfile(IDP, entity_id, config)
+        profile.version = version
+        with self._lock:
+            self.profiles[entity_id] = profile
+        return profile
+
+    def clear(self):
+        with self._lock:
+            self.profiles = {}
+
+
+sp_profile_cache = SPProfileCache()
+
+
+def get_sp_profile(IDP, entity_id):
+    """ Runtime profile of entity_id, None if the SP is not configured
+    """
+    return sp_profile_cache.get(IDP, entity_id)
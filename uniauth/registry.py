@@ -0,0 +1,86 @@
+import threading
+
+from collections.abc import Mapping
+from types import MappingProxyType
+
+from django.conf import settings
+
+from . models import MetadataStore, ServiceProvider
+from . versioning import config_version
+
+
+class ServiceProviderRegistry(Mapping):
+    """ Immutable view of the federated SPs for a configuration version:
+        settings.SAML_IDP_SPCONFIG plus the active ServiceProvider rows.
+        Building it only reads (entity_id, pk, updated) of each row,
+        an SP is compiled the first time it's requested and then reused
+        by the next versions until its row changes.
+        SPs federated on first use are added to it, see add().
+    """
+    # (pk, updated) -> compiled SP configuration
+    _compiled = {}
+    _lock = threading.Lock()
+
+    def __init__(self, version=None):
+        self.version = version
+        self._static = {entity_id: MappingProxyType(dict(conf))
+                        for entity_id, conf in settings.SAML_IDP_SPCONFIG.items()}
+        rows = ServiceProvider.objects.filter(is_active=True).\
+                                       values_list('entity_id', 'pk', 'updated')
+        self._rows = {entity_id: (pk, updated) for entity_id, pk, updated in rows}
+        # trusted for the auto federation, see uniauth.federation
+        self.auto_federate_stores = list(MetadataStore.objects.filter(is_active=True,
+                                                                      is_valid=True,
+                                                                      auto_federate=True))
+
+        # forget compiled SPs that have been changed, disabled or deleted
+        current = set(self._rows.values())
+        with self._lock:
+            for key in [k for k in self._compiled if k not in current]:
+                del self._compiled[key]
+
+    def add(self, sp):
+        """ Adds a ServiceProvider created after this version was built
+        """
+        self._rows[sp.entity_id] = (sp.pk, sp.updated)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._rows or entity_id in self._static
+
+    def __getitem__(self, entity_id):
+        row = self._rows.get(entity_id)
+        if row is None:
+            return self._static[entity_id]
+        conf = self._compiled.get(row)
+        if conf is None:
+            sp = ServiceProvider.objects.filter(pk=row[0]).first()
+            if sp is None:
+                raise KeyError(entity_id)
+            conf = MappingProxyType(sp.as_idpspconfig_dict_element())
+            with self._lock:
+                self._compiled[row] = conf
+        return conf
+
+    def __iter__(self):
+        yield from self._rows
+        for entity_id in self._static:
+            if entity_id not in self._rows:
+                yield entity_id
+
+    def __len__(self):
+        return len(self._rows) + len([i for i in self._static
+                                      if i not in self._rows])
+
+
+_registry = None
+
+
+def get_sp_registry():
+    """ Registry of the current configuration version
+    """
+    global _registry
+    version = config_version.current()
+    registry = _registry
+    if registry is None or registry.version != version:
+        registry = _registry = ServiceProviderRegistry(version)
+    return registry
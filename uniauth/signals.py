@@ -0,0 +1,21 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . models import MetadataStore, ServiceProvider
+from . utils import idp_server_cache
+from . versioning import config_version
+
+
+@receiver(post_save, sender=MetadataStore)
+@receiver(post_delete, sender=MetadataStore)
+@receiver(post_save, sender=ServiceProvider)
+@receiver(post_delete, sender=ServiceProvider)
+def invalidate_idp_server(sender, **kwargs):
+    """ Notifies all the workers that the IdP configuration changed
+        and rebuilds the IdP Server of this process
+    """
+    if getattr(kwargs['instance'], 'auto_federated', False):
+        # see uniauth.federation.auto_federate
+        return
+    config_version.bump()
+    idp_server_cache.invalidate()
@@ -0,0 +1,30 @@
+// entityID suggestions from the metadata loaded by the IdP
+document.addEventListener('DOMContentLoaded', function () {
+    'use strict';
+    var inputs = document.querySelectorAll('input.entity-search');
+    Array.prototype.forEach.call(inputs, function (input) {
+        var datalist = document.createElement('datalist');
+        var timer = null;
+        datalist.id = input.id + '_entities';
+        input.setAttribute('list', datalist.id);
+        input.parentNode.appendChild(datalist);
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(function () {
+                var url = input.getAttribute('data-entity-search') +
+                          '?q=' + encodeURIComponent(input.value);
+                fetch(url, {credentials: 'same-origin'})
+                    .then(function (response) { return response.json(); })
+                    .then(function (data) {
+                        datalist.innerHTML = '';
+                        data.results.forEach(function (result) {
+                            var option = document.createElement('option');
+                            option.value = result.id;
+                            option.textContent = result.text;
+                            datalist.appendChild(option);
+                        });
+                    });
+            }, 200);
+        });
+    });
+});
@@ -0,0 +1,695 @@
+import copy
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from unittest import mock
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from saml2 import BINDING_HTTP_POST
+
+from . federation import auto_federate
+from . mdq import CachingMetaDataMDX
+from . models import MetadataStore, ServiceProvider
+from . registry import get_sp_registry
+from . versioning import CacheConfigVersion
+
+
+ENTITY_ID = 'https://sp.example.org/metadata'
+
+SIGNED_ENTITY = """<?xml version="1.0"?>
+<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+                     xmlns:ds="http://www.w3.org/2000/09/xmldsig#"
+                     entityID="{}" ID="_md">
+  <ds:Signature>
+    <ds:SignedInfo>
+      <ds:CanonicalizationMethod Algorithm="http://www.w3.org/2001/10/xml-exc-c14n#"/>
+      <ds:SignatureMethod Algorithm="http://www.w3.org/2001/04/xmldsig-more#rsa-sha256"/>
+      <ds:Reference URI="#_md">
+        <ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>
+        <ds:DigestValue>AAAA</ds:DigestValue>
+      </ds:Reference>
+    </ds:SignedInfo>
+    <ds:SignatureValue>AAAA</ds:SignatureValue>
+  </ds:Signature>
+  <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+                                 Location="https://sp.example.org/acs/" index="0"/>
+  </md:SPSSODescriptor>
+</md:EntityDescriptor>
+""".format(ENTITY_ID)
+
+
+class MDQStandIn(object):
+    """ MDQ server on 127.0.0.1, in a thread: answers /entities/{sha1}
+        with the signed entities it has, 404 otherwise, and counts
+        the requests and the connections
+    """
+
+    def __init__(self, entities):
+        import hashlib
+        import http.server
+        import threading
+        from urllib.parse import unquote
+
+        self.entities = {'{sha1}' + hashlib.sha1(k.encode()).hexdigest(): v
+                         for k, v in entities.items()}
+        self.requests = []
+        self.connections = set()
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep-alive, as a real MDQ server
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stand_in.requests.append(self.path)
+                stand_in.connections.add(self.client_address)
+                body = stand_in.entities.get(unquote(self.path.rsplit('/', 1)[-1]))
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/samlmetadata+xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05}, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MDQTestCase(SimpleTestCase):
+
+    def setUp(self):
+        from . import mdq
+
+        self.server = MDQStandIn({ENTITY_ID: SIGNED_ENTITY})
+        self.addCleanup(self.server.stop)
+        # a session of this test, with its own connections
+        self.addCleanup(setattr, mdq, '_session', None)
+        mdq._session = None
+        # the signature check itself is pysaml2's
+        self.security = mock.Mock()
+        self.mdq = CachingMetaDataMDX(self.server.url,
+                                      security=self.security,
+                                      cert='/path/to/mdq.pem')
+
+
+class MDQSignatureTest(MDQTestCase):
+    """ an entity enters the MDQ cache only if its signature is valid
+    """
+
+    def test_bad_signature_is_not_cached(self):
+        from saml2.sigver import SignatureError
+
+        self.security.verify_signature.side_effect = SignatureError('forged')
+        with self.assertRaises(KeyError):
+            self.mdq[ENTITY_ID]
+        self.assertIsNone(self.mdq.entity.get(ENTITY_ID))
+        # the second lookup must not find the forged entity
+        with self.assertRaises(KeyError):
+            self.mdq[ENTITY_ID]
+        self.assertNotIn(ENTITY_ID, self.mdq)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_good_signature_is_cached(self):
+        entity = self.mdq[ENTITY_ID]
+        self.assertIn('spsso_descriptor', entity)
+        self.assertIs(self.mdq[ENTITY_ID], entity)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.security.verify_signature.call_count, 1)
+
+
+class MDQClientTest(MDQTestCase):
+    """ hits and misses of the MDQ client against a local server
+    """
+
+    def test_hits_do_not_query_the_server(self):
+        for i in range(5):
+            self.assertIn('spsso_descriptor', self.mdq[ENTITY_ID])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_missing_entities_are_remembered(self):
+        unknown = 'https://unknown.example.org/metadata'
+        for i in range(3):
+            self.assertNotIn(unknown, self.mdq)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_missing_entities_expire(self):
+        from django.test import override_settings
+
+        unknown = 'https://unknown.example.org/metadata'
+        with override_settings(SAML_IDP_MDQ_NEGATIVE_TTL=0):
+            mdq = CachingMetaDataMDX(self.server.url, security=self.security,
+                                     cert='/path/to/mdq.pem')
+        self.assertNotIn(unknown, mdq)
+        self.assertNotIn(unknown, mdq)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_connection_reused(self):
+        unknown = 'https://unknown{}.example.org/metadata'
+        self.mdq[ENTITY_ID]
+        for i in range(4):
+            self.assertNotIn(unknown.format(i), self.mdq)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_session_per_process(self):
+        from . mdq import mdq_session
+
+        session = mdq_session()
+        self.assertIs(mdq_session(), session)
+        # a forked worker
+        with mock.patch('uniauth.mdq.os.getpid', return_value=-1):
+            worker_session = mdq_session()
+            self.assertIsNot(worker_session, session)
+            self.assertIs(mdq_session(), worker_session)
+
+    def test_prefetch(self):
+        unknown = 'https://unknown.example.org/metadata'
+        self.assertEqual(self.mdq.prefetch([ENTITY_ID, unknown]), 1)
+        self.assertEqual(len(self.server.requests), 2)
+        # already in the caches
+        self.assertEqual(self.mdq.prefetch([ENTITY_ID]), 0)
+        self.assertIn(ENTITY_ID, self.mdq)
+        self.assertNotIn(unknown, self.mdq)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class CacheConfigVersionTest(SimpleTestCase):
+    """ the slots of the nodes gone are reused by the new ones
+    """
+
+    def setUp(self):
+        self.backend = CacheConfigVersion()
+        self.backend.cache.clear()
+        self.addCleanup(self.backend.cache.clear)
+
+    def expire(self, node):
+        slot = self.backend.cache.get('{}:{}'.format(self.backend.nodes_key, node))
+        self.backend.cache.delete_many([self.backend.slot_key(slot),
+                                        '{}:{}'.format(self.backend.nodes_key, node)])
+
+    def test_counter_reset(self):
+        self.backend.report('live:1', 1, None)
+        for i in range(150):
+            self.backend.report('gone:{}'.format(i), 1, None)
+            self.expire('gone:{}'.format(i))
+        self.assertEqual(self.backend.cache.get(self.backend.nodes_key), 151)
+        self.assertEqual(self.backend.nodes(), [('live:1', 1, None)])
+        self.assertEqual(self.backend.cache.get(self.backend.nodes_key), 1)
+        self.backend.report('new:1', 2, None)
+        self.assertEqual(self.backend.slot('new:1'), 2)
+        self.assertEqual([i[0] for i in self.backend.nodes()], ['live:1', 'new:1'])
+
+    def test_slot_taken_after_reset(self):
+        self.backend.report('a', 1, None)
+        self.backend.report('b', 1, None)
+        # the counter went back under the slot of b
+        self.backend.cache.set(self.backend.nodes_key, 1, timeout=None)
+        self.backend.report('c', 1, None)
+        self.backend.report('b', 2, None)
+        self.assertEqual([i[:2] for i in self.backend.nodes()],
+                         [('a', 1), ('b', 2), ('c', 1)])
+
+
+class EffectivePolicyPreviewTest(SimpleTestCase):
+    """ the release policy preview escapes what comes from the metadata
+    """
+
+    def test_entity_categories_escaped(self):
+        from django.contrib import admin
+        from . admin import ServiceProviderAdmin
+        from . models import ServiceProvider
+
+        policy = mock.Mock(allowed=None)
+        policy.as_dict.return_value = {'entity_categories': ['<script>x</script>']}
+        sp_admin = ServiceProviderAdmin(ServiceProvider, admin.site)
+        with mock.patch('uniauth.admin.get_idp_config'), \
+             mock.patch('uniauth.admin.compile_policy', return_value=policy):
+            html = sp_admin.effective_policy_html(ServiceProvider(entity_id=ENTITY_ID))
+        self.assertNotIn('<script>', html)
+        self.assertIn('&lt;script&gt;', html)
+        self.assertIn('&nbsp', html)
+
+
+class AttributeConversionTest(SimpleTestCase):
+    """ the registry converts the released attributes as pysaml2 does
+    """
+
+    def test_same_attributes_as_pysaml2(self):
+        from saml2 import saml
+        from saml2.attribute_converter import from_local
+        from . attribute_maps import converter_registry
+
+        converters = converter_registry.converters()
+        ava = {'uid': ['joe'], 'Mail': ['joe@example.org', 'j@example.org'],
+               'eduPersonTargetedID': ['abc'], 'not-mapped': ['x']}
+        for name_format in (saml.NAME_FORMAT_URI,
+                            saml.NAME_FORMAT_BASIC,
+                            saml.NAME_FORMAT_UNSPECIFIED):
+            expected = from_local(converters, ava, name_format)
+            attributes = converter_registry.from_local(converters, ava, name_format)
+            self.assertEqual([str(i) for i in attributes or []],
+                             [str(i) for i in expected or []])
+
+
+SP_ENTITY = """<md:EntityDescriptor entityID="https://{name}.example.org/metadata"{valid_until}>
+  <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+                                 Location="https://{name}.example.org/{acs}/" index="0"/>
+  </md:SPSSODescriptor>
+</md:EntityDescriptor>"""
+
+
+def sp_entity_id(name):
+    return 'https://{}.example.org/metadata'.format(name)
+
+
+def aggregate(entities, valid_until=None):
+    """ EntitiesDescriptor of the SPs in entities, {name: acs path}
+        or {name: (acs path, validUntil)}
+    """
+    xml = []
+    for name, acs in entities.items():
+        acs, entity_valid_until = acs if isinstance(acs, tuple) else (acs, None)
+        xml.append(SP_ENTITY.format(name=name, acs=acs,
+                                    valid_until=' validUntil="{}"'.format(entity_valid_until)
+                                                if entity_valid_until else ''))
+    return ('<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"{}>'
+            '{}</md:EntitiesDescriptor>').format(' validUntil="{}"'.format(valid_until)
+                                                 if valid_until else '',
+                                                 ''.join(xml))
+
+
+def in_days(days):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + days * 86400))
+
+
+def days_later(days):
+    """ patches the clock of the pysaml2 validity checks
+    """
+    gmtime = time.gmtime
+    return mock.patch('time.gmtime',
+                      side_effect=lambda *args: gmtime(*args) if args else
+                                                gmtime(time.time() + days * 86400))
+
+
+class IncrementalMetadataTest(SimpleTestCase):
+    """ incremental reloads of a metadata file
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'metadata.xml')
+
+    def load(self, xml):
+        from saml2.attribute_converter import ac_factory
+        from . mdstore import SlicedMetaDataFile
+
+        with open(self.path, 'w') as f:
+            f.write(xml)
+        md = SlicedMetaDataFile(ac_factory(), self.path, check_validity=True)
+        md.incremental = True
+        md.load()
+        return md
+
+    def test_expired_document_loaded_twice(self):
+        from saml2.mdstore import TooOld
+
+        xml = aggregate({'sp1': 'acs'}, valid_until=in_days(1))
+        self.assertIn(sp_entity_id('sp1'), self.load(xml))
+        with days_later(2):
+            with self.assertRaises(TooOld):
+                self.load(xml)
+            with self.assertRaises(TooOld):
+                self.load(xml)
+
+    def test_expired_entity_dropped(self):
+        xml = aggregate({'sp1': ('acs', in_days(1)), 'sp2': 'acs'})
+        md = self.load(xml)
+        self.assertIn(sp_entity_id('sp1'), md)
+        with days_later(2):
+            md = self.load(xml)
+            self.assertNotIn(sp_entity_id('sp1'), md)
+            self.assertIn(sp_entity_id('sp2'), md)
+            self.assertEqual(md.changes, {sp_entity_id('sp1')})
+            # also when another entity changed
+            md = self.load(aggregate({'sp1': ('acs', in_days(1)), 'sp2': 'new-acs'}))
+            self.assertNotIn(sp_entity_id('sp1'), md)
+            self.assertIn(sp_entity_id('sp2'), md)
+
+    def test_reload_diff(self):
+        first = self.load(aggregate({'sp1': 'acs', 'sp2': 'acs', 'sp3': 'acs'}))
+        self.assertIsNone(first.report)
+        md = self.load(aggregate({'sp1': 'acs', 'sp2': 'new-acs', 'sp4': 'acs'}))
+        self.assertEqual(md.report, {'added': [sp_entity_id('sp4')],
+                                     'changed': [sp_entity_id('sp2')],
+                                     'removed': [sp_entity_id('sp3')],
+                                     'entities': 3})
+        self.assertEqual(md.changes, {sp_entity_id('sp2'),
+                                      sp_entity_id('sp3'),
+                                      sp_entity_id('sp4')})
+        self.assertNotIn(sp_entity_id('sp3'), md)
+        self.assertIn('new-acs', str(md[sp_entity_id('sp2')]))
+        # the unchanged entity is reused, not parsed again
+        self.assertIs(md[sp_entity_id('sp1')], first[sp_entity_id('sp1')])
+
+    def test_unchanged_digest(self):
+        xml = aggregate({'sp1': 'acs', 'sp2': 'acs'})
+        first = self.load(xml)
+        with mock.patch('uniauth.mdstore.EntitySlicer') as slicer:
+            md = self.load(xml)
+        slicer.assert_not_called()
+        self.assertEqual(md.changes, set())
+        self.assertEqual(set(md.keys()), set(first.keys()))
+        for entity_id in first.keys():
+            self.assertIs(md[entity_id], first[entity_id])
+
+
+class IdPMetadataViewTest(SimpleTestCase):
+    """ metadata of this IdP, served once per configuration version
+    """
+
+    def setUp(self):
+        from . idp_metadata import idp_metadata_cache
+
+        self.cache = idp_metadata_cache
+        self.cache.invalidate()
+        self.addCleanup(self.cache.invalidate)
+        patcher = mock.patch('uniauth.idp_metadata.config_version.current', return_value=1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse('uniauth:saml2_idp_metadata')
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age', response['Cache-Control'])
+        with mock.patch('uniauth.idp_metadata.build_idp_metadata') as build:
+            again = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again['ETag'], response['ETag'])
+            self.assertEqual(again.content, b'')
+            again = self.client.get(self.url,
+                                    HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(again.status_code, 304)
+            build.assert_not_called()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"').status_code,
+                         200)
+
+    def test_config_change(self):
+        response = self.client.get(self.url)
+        key = self.cache.key(1)
+        idp_config = copy.deepcopy(settings.SAML_IDP_CONFIG)
+        idp_config['entityid'] = 'https://other-idp.example.org/metadata'
+        with self.settings(SAML_IDP_CONFIG=idp_config):
+            self.assertNotEqual(self.cache.key(1), key)
+            changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed['ETag'], response['ETag'])
+            self.assertIn(b'https://other-idp.example.org/metadata', changed.content)
+        with self.settings(SAML_IDP_METADATA_SIGN=True):
+            self.assertNotEqual(self.cache.key(1), key)
+        self.assertEqual(self.cache.key(1), key)
+
+    def test_document_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        idp_config = copy.deepcopy(settings.SAML_IDP_CONFIG)
+        idp_config['entityid'] = 'https://other-idp.example.org/metadata'
+        with self.settings(SAML_IDP_METADATA_DOCUMENT_DIR=directory):
+            response = self.client.get(self.url)
+            self.assertEqual(os.listdir(directory),
+                             ['idp-metadata-{}.xml'.format(self.cache.key(1))])
+            # another worker serves the same document
+            self.cache.invalidate()
+            with mock.patch('uniauth.idp_metadata.build_idp_metadata') as build:
+                self.assertEqual(self.client.get(self.url)['ETag'], response['ETag'])
+                build.assert_not_called()
+            with self.settings(SAML_IDP_CONFIG=idp_config):
+                self.client.get(self.url)
+                # the previous configuration is pruned
+                self.assertEqual(os.listdir(directory),
+                                 ['idp-metadata-{}.xml'.format(self.cache.key(1))])
+
+
+RS_CATEGORY = 'http://refeds.org/category/research-and-scholarship'
+
+
+class MetadataStandIn(object):
+    """ IDP.metadata of the SPs in entities,
+        {entity_id: (source, entity categories)}
+    """
+
+    def __init__(self, entities):
+        self.entities = entities
+
+    def service(self, entity_id, typ, service):
+        if entity_id in self.entities:
+            return [{'location': 'https://sp.example.org/acs/'}]
+
+    def source(self, entity_id):
+        return self.entities[entity_id][0] if entity_id in self.entities else None
+
+    def entity_categories(self, entity_id):
+        return self.entities[entity_id][1]
+
+    def name(self, entity_id):
+        return 'SP {}'.format(entity_id)
+
+
+@override_settings(SAML_IDP_AUTO_FEDERATE_ENTITY_CATEGORIES=[RS_CATEGORY])
+class AutoFederationTest(TestCase):
+    """ SPs federated on first use
+    """
+
+    def setUp(self):
+        # the rows saved here don't need an IdP Server
+        patcher = mock.patch('uniauth.signals.idp_server_cache')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = MetadataStore.objects.create(name='trusted', type='local',
+                                                  url='/srv/metadata/trusted',
+                                                  is_active=True, is_valid=True,
+                                                  auto_federate=True)
+        self.IDP = mock.Mock()
+        self.IDP.metadata = MetadataStandIn({
+            sp_entity_id('category'): ('/srv/metadata/other.xml', [RS_CATEGORY]),
+            sp_entity_id('store'): ('/srv/metadata/trusted/sp.xml', []),
+            sp_entity_id('other'): ('/srv/metadata/other.xml', []),
+        })
+
+    def test_entity_category(self):
+        self.assertTrue(auto_federate(self.IDP, sp_entity_id('category')))
+        sp = ServiceProvider.objects.get(entity_id=sp_entity_id('category'))
+        self.assertTrue(sp.is_active)
+        self.assertIn(RS_CATEGORY, sp.description)
+        self.assertIn(sp_entity_id('category'), get_sp_registry())
+
+    def test_metadata_store(self):
+        self.assertTrue(auto_federate(self.IDP, sp_entity_id('store')))
+        sp = ServiceProvider.objects.get(entity_id=sp_entity_id('store'))
+        self.assertIn('MetadataStore trusted', sp.description)
+
+    def test_refused(self):
+        self.assertFalse(auto_federate(self.IDP, sp_entity_id('other')))
+        self.assertFalse(auto_federate(self.IDP, sp_entity_id('unknown')))
+        self.assertFalse(ServiceProvider.objects.exists())
+
+    def test_disabled_not_enabled_again(self):
+        ServiceProvider.objects.create(entity_id=sp_entity_id('category'),
+                                       display_name='disabled', is_active=False)
+        self.assertFalse(auto_federate(self.IDP, sp_entity_id('category')))
+        self.assertFalse(ServiceProvider.objects.get(entity_id=sp_entity_id('category')).is_active)
+        self.assertNotIn(sp_entity_id('category'), get_sp_registry())
+
+    def test_created_by_another_worker(self):
+        # registry of this worker, built before the other one saved the SP
+        self.assertNotIn(sp_entity_id('category'), get_sp_registry())
+        ServiceProvider.objects.bulk_create([ServiceProvider(entity_id=sp_entity_id('category'),
+                                                             display_name='other worker',
+                                                             is_active=True)])
+        first = QuerySet.first
+        lookups = []
+
+        def stale_first(queryset):
+            # the first lookup ran before the row was committed
+            lookups.append(queryset)
+            return None if len(lookups) == 1 else first(queryset)
+
+        with mock.patch.object(QuerySet, 'first', autospec=True, side_effect=stale_first):
+            self.assertTrue(auto_federate(self.IDP, sp_entity_id('category')))
+        self.assertEqual(len(lookups), 2)
+        sp = ServiceProvider.objects.get(entity_id=sp_entity_id('category'))
+        self.assertEqual(sp.display_name, 'other worker')
+        self.assertIn(sp_entity_id('category'), get_sp_registry())
+
+
+class MetadataSidecarTest(SimpleTestCase):
+    """ metadata sidecar on a Unix socket, queried by the workers' client
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'sidecar.sock')
+        self.version = 1
+        self.entities = {'sp1': 'acs'}
+        for patcher in (mock.patch('uniauth.metadata_sidecar._serving', False),
+                        mock.patch('uniauth.metadata_sidecar.config_version.current',
+                                   side_effect=lambda: self.version),
+                        mock.patch('uniauth.utils.build_idp_server',
+                                   side_effect=self.build_idp_server)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def build_idp_server(self):
+        from saml2.attribute_converter import ac_factory
+        from saml2.config import Config
+        from . mdstore import UniAuthMetadataStore
+
+        path = os.path.join(self.dir, 'metadata-{}.xml'.format(self.version))
+        with open(path, 'w') as f:
+            f.write(aggregate(self.entities))
+        # no signed sources, no xmlsec
+        with mock.patch('saml2.mdstore.security_context'):
+            mds = UniAuthMetadataStore(ac_factory(), Config(), check_validity=False)
+        mds.track_changes = False
+        mds.load('local', path)
+        return mock.Mock(metadata=mds)
+
+    def start(self):
+        from . metadata_sidecar import MetadataSidecar, SidecarServer
+
+        modes = []
+        server_bind = SidecarServer.server_bind
+
+        def record_mode(server):
+            server_bind(server)
+            modes.append(os.stat(self.path).st_mode & 0o777)
+
+        stop_event = threading.Event()
+        self.sidecar = MetadataSidecar(self.path)
+        with mock.patch.object(SidecarServer, 'server_bind', autospec=True,
+                               side_effect=record_mode):
+            thread = threading.Thread(target=self.sidecar.serve, args=(stop_event,))
+            thread.start()
+            for i in range(100):
+                if self.sidecar.server is not None:
+                    break
+                time.sleep(0.05)
+        self.addCleanup(thread.join)
+        self.assertIsNotNone(self.sidecar.server)
+        self.addCleanup(stop_event.set)
+        # mode of the socket just after bind()
+        return modes
+
+    def sidecar_client(self):
+        from . metadata_sidecar import MetadataSidecarClient
+
+        client = MetadataSidecarClient(self.path)
+        self.addCleanup(client.close)
+        return client
+
+    def test_socket_mode(self):
+        with self.settings(SAML_IDP_METADATA_SIDECAR_MODE=0o600):
+            self.assertEqual(self.start(), [0o600])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_json_lines(self):
+        self.start()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.settimeout(5)
+        sock.connect(self.path)
+        stream = sock.makefile('rwb')
+        self.addCleanup(stream.close)
+
+        def ask(line):
+            stream.write(line + b'\n')
+            stream.flush()
+            return json.loads(stream.readline().decode())
+
+        self.assertEqual(ask(b'{"op": "ping"}')['version'], 1)
+        self.assertEqual(ask(b'{"op": "ping"}')['result']['entities'], 1)
+        # errors are answered on the same connection
+        self.assertIn('error', ask(b'not json'))
+        self.assertEqual(ask(b'{"op": "nope"}'), {'error': 'Unknown request: nope'})
+        answer = ask(json.dumps({'op': 'keys'}).encode())
+        self.assertEqual(answer, {'version': 1, 'result': [sp_entity_id('sp1')]})
+
+    def test_lookups(self):
+        from saml2.attribute_converter import ac_factory
+        from . metadata_sidecar import MetaDataSidecar
+
+        self.start()
+        md = MetaDataSidecar(ac_factory(), path=self.path, version=1)
+        md.load()
+        self.assertIn(sp_entity_id('sp1'), md)
+        self.assertNotIn(sp_entity_id('sp2'), md)
+        self.assertEqual(md.keys(), [sp_entity_id('sp1')])
+        acs = md.service(sp_entity_id('sp1'), 'spsso_descriptor',
+                         'assertion_consumer_service')
+        self.assertEqual(acs[BINDING_HTTP_POST][0]['location'],
+                         'https://sp1.example.org/acs/')
+        self.assertEqual(md.source(sp_entity_id('sp1')),
+                         os.path.join(self.dir, 'metadata-1.xml'))
+        # errors of the sidecar are lookups that fail
+        with self.assertLogs('uniauth.metadata_sidecar', 'ERROR'):
+            with self.assertRaises(KeyError):
+                md.certs(sp_entity_id('sp2'), 'spsso')
+
+    def test_reload_on_version_change(self):
+        self.start()
+        client = self.sidecar_client()
+        self.assertIsNone(client.entity(sp_entity_id('sp2'), version=1))
+        self.version = 2
+        self.entities = {'sp1': 'acs', 'sp2': 'acs'}
+        # a worker asking for the new version wakes up the reload,
+        # the previous metadata is served meanwhile
+        client.ping()
+        self.assertEqual(client.request('ping', version=2)[0], 1)
+        for i in range(100):
+            if client.ping()[0] == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(client.ping()[0], 2)
+        # the cached answer of version 1 is not used for version 2
+        self.assertIsNotNone(client.entity(sp_entity_id('sp2'), version=2))
+
+    def test_unreachable(self):
+        from saml2.attribute_converter import ac_factory
+        from . metadata_sidecar import MetaDataSidecar
+
+        md = MetaDataSidecar(ac_factory(), path=self.path, version=1)
+        with self.assertLogs('uniauth.metadata_sidecar', 'ERROR'):
+            with self.assertRaises(KeyError):
+                md[sp_entity_id('sp1')]
+            self.assertNotIn(sp_entity_id('sp1'), md)
+            self.assertEqual(md.keys(), [])
+            self.assertIsNone(md.service(sp_entity_id('sp1'), 'spsso_descriptor',
+                                         'assertion_consumer_service'))
@@ -17,4 +17,5 @@ urlpatterns = [
     path('slo/<str:binding>', views.LogoutProcessView.as_view(),
          name="saml_logout_binding"),
     path('metadata/', views.metadata, name='saml2_idp_metadata'),
+    path('ready/', views.ready, name='saml_idp_ready'),
 ]
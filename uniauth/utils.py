@@ -1,18 +1,28 @@
 import base64
 import copy
+import logging
+import threading
+import time
 import xml.dom.minidom
 import xml.etree.ElementTree
 import zlib
 
 from django.conf import settings
-from saml2.config import IdPConfig
-from saml2.server import Server
+from django.db import connections
 from xml.parsers.expat import ExpatError
 
+from . attribute_maps import install as install_attribute_maps
 from . exceptions import (MetadataNotFound,
                           MetadataCorruption,
                           SPConfigurationMissing)
-from . models import MetadataStore, ServiceProvider
+from . metadata_watch import metadata_watch_enabled, metadata_watcher
+from . models import MetadataStore
+from . registry import get_sp_registry
+from . versioning import config_version
+from . warmup import warmup_running
+
+
+logger = logging.getLogger(__name__)
 
 
 def repr_saml(saml_str, b64=False):
@@ -34,8 +44,20 @@ def encode_http_redirect_saml(saml_envelope):
     return base64.b64encode(zlib.compress(saml_envelope.encode()))
 
 
-def get_idp_config(saml_idp_config=settings.SAML_IDP_CONFIG):
-    conf = IdPConfig()
+def build_idp_server(saml_idp_config=settings.SAML_IDP_CONFIG):
+    """ Builds a brand new pysaml2 Server merging the settings
+        configuration with the active DB MetadataStores.
+        This reloads every metadata source, it's expensive!
+    """
+    # pysaml2 Server imports the whole crypto stack
+    from saml2.server import Server
+    from . crypto_backend import install as install_crypto_backend
+    from . mdq import prefetch_mdq
+    from . mdstore import UniAuthIdPConfig
+
+    install_attribute_maps()
+    install_crypto_backend()
+    conf = UniAuthIdPConfig()
     idp_config = copy.deepcopy(saml_idp_config)
 
     # this is only used for merge DB metadatastores configurations
@@ -55,14 +77,132 @@ def get_idp_config(saml_idp_config=settings.SAML_IDP_CONFIG):
         raise SPConfigurationMissing(e)
     except Exception as e:
         raise Exception(e)
+    prefetch_mdq(conf.metadata)
     return Server(config=conf)
 
 
+class IdPServerCache(object):
+    """ Per-process pysaml2 Server, built once and then rebuilt
+        in a background thread when the shared configuration version
+        moves, when invalidated (MetadataStore or ServiceProvider changes)
+        or when SAML_IDP_CONFIG_TTL expires.
+        Requests keep using the previous Server until the new one
+        is swapped in. If SAML_IDP_METADATA_WATCH is enabled the local
+        metadata directories of the current Server are updated in place.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.version = None
+        self.expires = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._rebuilding = False
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'SAML_IDP_CONFIG_TTL', 3600)
+
+    def get(self):
+        version = config_version.current()
+        server = self.server
+        if server is None:
+            # first build happens in the request, nothing to serve yet
+            with self._lock:
+                if self.server is None:
+                    self._swap(build_idp_server(), version)
+                    config_version.report(version)
+                server = self.server
+        elif version != self.version or time.monotonic() > self.expires:
+            self.rebuild()
+        # in the process that serves the requests: a thread started
+        # in the uwsgi master while warming up would not survive the fork
+        if metadata_watch_enabled() and not warmup_running():
+            metadata_watcher.start(self.current_metadata)
+        return server
+
+    def invalidate(self):
+        """ Marks the current Server as outdated and rebuilds it
+        """
+        with self._lock:
+            self.generation += 1
+        if self.server is not None:
+            self.rebuild()
+
+    def rebuild(self):
+        """ Starts a background rebuild, if one is not already running
+        """
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        thread = threading.Thread(target=self._rebuild,
+                                  name='uniauth-idp-rebuild',
+                                  daemon=True)
+        thread.start()
+
+    def clear(self):
+        with self._lock:
+            self.server = None
+            self.version = None
+            self.expires = 0
+
+    def _swap(self, server, version):
+        self.server = server
+        self.version = version
+        self.expires = time.monotonic() + self.ttl
+        logger.debug('IdP Server rebuilt [version {}]'.format(version))
+
+    def current_metadata(self):
+        server = self.server
+        return server.metadata if server is not None else None
+
+    def _rebuild(self):
+        try:
+            while True:
+                generation = self.generation
+                version = config_version.current()
+                try:
+                    server = build_idp_server()
+                except Exception as e:
+                    logger.error('IdP Server rebuild failed, '
+                                 'still serving the previous one: {}'.format(e))
+                    with self._lock:
+                        # do not hammer a broken metadata source
+                        self.expires = time.monotonic() + min(self.ttl, 60)
+                        self.version = version
+                        self._rebuilding = False
+                    return
+                with self._lock:
+                    self._swap(server, version)
+                    # changes happened while building: build again
+                    if generation == self.generation and \
+                       version == config_version.version:
+                        self._rebuilding = False
+                        break
+            config_version.report(version)
+        finally:
+            connections.close_all()
+
+
+idp_server_cache = IdPServerCache()
+
+
+def get_idp_config(saml_idp_config=settings.SAML_IDP_CONFIG):
+    """ Returns the cached pysaml2 Server of this process.
+        A custom configuration always builds a new one.
+    """
+    if saml_idp_config is not settings.SAML_IDP_CONFIG:
+        return build_idp_server(saml_idp_config)
+    return idp_server_cache.get()
+
+
 def get_idp_sp_config():
-    idp_sp_config = settings.SAML_IDP_SPCONFIG
-    idp_sp_config_db = ServiceProvider.as_idpspconfig_dict()
-    idp_sp_config.update(idp_sp_config_db)
-    return idp_sp_config
+    """ SP configurations as an immutable mapping entity_id -> config,
+        rebuilt only when the shared configuration version moves.
+        See uniauth.registry.ServiceProviderRegistry
+    """
+    return get_sp_registry()
 
 
 def get_client_id(request):
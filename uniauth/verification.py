@@ -0,0 +1,61 @@
+import hashlib
+import logging
+
+from django.conf import settings
+
+from . ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+# (issuer, message digest, signer certs fingerprint) -> verification outcome
+signature_cache = TTLCache(maxsize=getattr(settings,
+                                           'SAML_IDP_SIGNATURE_CACHE_SIZE',
+                                           10000),
+                           ttl=getattr(settings,
+                                       'SAML_IDP_SIGNATURE_CACHE_TTL',
+                                       300))
+
+
+def signer_fingerprint(IDP, entity_id):
+    """ Digest of the signing certificates that the metadata
+        publishes for entity_id, empty if it's unknown
+    """
+    try:
+        certs = IDP.metadata.certs(entity_id, "any", "signing")
+    except Exception:
+        return ''
+    digest = hashlib.sha256()
+    for cert in sorted(cert for name, cert in certs):
+        digest.update(cert.encode())
+    return digest.hexdigest()
+
+
+def verify_request_signature(IDP, req_info):
+    """ Cached req_info.signature_check. The key is made of the exact
+        message bytes and the signer certificates found in metadata,
+        a metadata change of the signer results in a new verification.
+    """
+    xmlstr = req_info.xmlstr
+    if isinstance(xmlstr, str):
+        xmlstr = xmlstr.encode()
+    issuer = req_info.message.issuer.text
+    key = (issuer,
+           hashlib.sha256(xmlstr).hexdigest(),
+           signer_fingerprint(IDP, issuer))
+
+    verified = signature_cache.get(key)
+    if verified is None:
+        verified = bool(req_info.signature_check(req_info.xmlstr))
+        signature_cache.set(key, verified)
+    else:
+        logger.debug('Signature verification of {} [{}] '
+                     'found in cache'.format(issuer, req_info.message.id))
+    return verified
+
+
+def invalidate_signatures(entity_ids):
+    """ Drops the cached verifications of these signers
+    """
+    entity_ids = set(entity_ids)
+    signature_cache.discard(lambda key: key[0] in entity_ids)
@@ -0,0 +1,205 @@
+import logging
+import os
+import socket
+import time
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . models import ConfigVersion, ConfigVersionNode
+
+
+logger = logging.getLogger(__name__)
+
+CONFIG_VERSION_NAME = 'idp'
+
+
+def node_name():
+    """ Identifies this worker as hostname:pid
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def config_version_node_ttl():
+    """ seconds after which a node that didn't report is forgotten,
+        the live ones report again every half of it
+    """
+    return getattr(settings, 'SAML_IDP_CONFIG_VERSION_NODE_TTL', 3600)
+
+
+class DatabaseConfigVersion(object):
+    """ Configuration version stored in a ConfigVersion row,
+        shared by all the nodes using the same database
+    """
+
+    def get(self):
+        version = ConfigVersion.objects.filter(name=CONFIG_VERSION_NAME).\
+                                        values_list('version', flat=True).first()
+        return version or 0
+
+    def bump(self):
+        row = ConfigVersion.objects.get_or_create(name=CONFIG_VERSION_NAME)[0]
+        ConfigVersion.objects.filter(pk=row.pk).update(version=F('version') + 1)
+        return self.get()
+
+    def report(self, node, version, updated):
+        ConfigVersionNode.objects.update_or_create(node=node,
+                                                   defaults={'version': version,
+                                                             'updated': updated,
+                                                             'last_seen': timezone.now()})
+
+    def nodes(self):
+        # workers recycled or restarted don't report anymore
+        cutoff = timezone.now() - timedelta(seconds=config_version_node_ttl())
+        ConfigVersionNode.objects.filter(last_seen__lt=cutoff).delete()
+        return [(i.node, i.version, i.updated)
+                for i in ConfigVersionNode.objects.order_by('node')]
+
+
+class CacheConfigVersion(object):
+    """ Configuration version stored in a Django cache key,
+        SAML_IDP_CONFIG_VERSION_CACHE must be a cache shared by all the nodes
+        (memcached, redis...), a local memory cache only works on a single worker
+    """
+    key = 'uniauth:config_version'
+    # counter of the node slots, each node writes only its own slot key
+    nodes_key = 'uniauth:config_version:nodes'
+    # expired slots after the last live one that reset the counter
+    slots_reset = 100
+
+    def __init__(self):
+        self.cache = caches[getattr(settings,
+                                    'SAML_IDP_CONFIG_VERSION_CACHE',
+                                    'default')]
+
+    def get(self):
+        return self.cache.get(self.key, 0)
+
+    def bump(self):
+        self.cache.add(self.key, 0, timeout=None)
+        try:
+            return self.cache.incr(self.key)
+        except ValueError:
+            # evicted in the meantime
+            self.cache.set(self.key, 1, timeout=None)
+            return 1
+
+    def slot_key(self, slot):
+        return '{}:slot:{}'.format(self.nodes_key, slot)
+
+    def slot(self, node):
+        """ The number of the cache key where node reports, assigned
+            atomically the first time, or again if another node took it
+            after the counter was reset
+        """
+        node_key = '{}:{}'.format(self.nodes_key, node)
+        slot = self.cache.get(node_key)
+        if slot is not None:
+            owner = self.cache.get(self.slot_key(slot))
+            if owner is not None and owner[0] != node:
+                slot = None
+        if slot is None:
+            self.cache.add(self.nodes_key, 0, timeout=None)
+            try:
+                slot = self.cache.incr(self.nodes_key)
+            except ValueError:
+                # evicted in the meantime
+                self.cache.set(self.nodes_key, 1, timeout=None)
+                slot = 1
+        self.cache.set(node_key, slot, timeout=config_version_node_ttl())
+        return slot
+
+    def report(self, node, version, updated):
+        # expires with the node if it doesn't report anymore
+        self.cache.set(self.slot_key(self.slot(node)),
+                       (node, version, updated),
+                       timeout=config_version_node_ttl())
+
+    def nodes(self):
+        slots = self.cache.get(self.nodes_key, 0)
+        nodes = {}
+        last_live = 0
+        for start in range(1, slots + 1, 500):
+            keys = {self.slot_key(i): i
+                    for i in range(start, min(start + 500, slots + 1))}
+            for key, (node, version, updated) in self.cache.get_many(keys).items():
+                nodes[node] = (version, updated)
+                last_live = max(last_live, keys[key])
+        if slots - last_live > self.slots_reset:
+            # the slots of the respawned workers expired: the new ones
+            # start again after the last live slot
+            self.cache.set(self.nodes_key, last_live, timeout=None)
+        return [(k, v[0], v[1]) for k,v in sorted(nodes.items())]
+
+
+class ConfigVersionWatcher(object):
+    """ Local view of the shared configuration version.
+        The shared store is queried at most once every
+        SAML_IDP_CONFIG_VERSION_CHECK_INTERVAL seconds,
+        otherwise the last known version is returned.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._backend = None
+        self._next_check = 0
+        # (version, reload time) last reported by this worker
+        self._reported = None
+        self._next_report = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            backend = getattr(settings,
+                              'SAML_IDP_CONFIG_VERSION_BACKEND',
+                              'uniauth.versioning.DatabaseConfigVersion')
+            self._backend = import_string(backend)()
+        return self._backend
+
+    @property
+    def interval(self):
+        return getattr(settings, 'SAML_IDP_CONFIG_VERSION_CHECK_INTERVAL', 5)
+
+    def current(self):
+        now = time.monotonic()
+        if self.version is None or now >= self._next_check:
+            try:
+                self.version = self.backend.get()
+            except Exception as e:
+                logger.error('Unable to read the configuration version: {}'.format(e))
+                if self.version is None:
+                    self.version = 0
+            self._next_check = now + self.interval
+            if self._reported is not None and now >= self._next_report:
+                # still alive
+                self._send_report()
+        return self.version
+
+    def bump(self):
+        self.version = self.backend.bump()
+        self._next_check = time.monotonic() + self.interval
+        logger.info('Configuration version bumped to {}'.format(self.version))
+        return self.version
+
+    def report(self, version):
+        self._reported = (version, timezone.now())
+        self._send_report()
+
+    def _send_report(self):
+        self._next_report = time.monotonic() + config_version_node_ttl() / 2
+        version, updated = self._reported
+        try:
+            self.backend.report(node_name(), version, updated)
+        except Exception as e:
+            logger.error('Unable to report the configuration version: {}'.format(e))
+
+    def nodes(self):
+        return self.backend.nodes()
+
+
+config_version = ConfigVersionWatcher()
@@ -1,6 +1,5 @@
 import base64
 import datetime
-import copy
 import logging
 
 from django.conf import settings
@@ -12,9 +11,11 @@ from django.core.exceptions import (ImproperlyConfigured,
                                     SuspiciousOperation)
 from django.http import (HttpResponse,
                          HttpResponseBadRequest,
-                         HttpResponseRedirect)
+                         HttpResponseRedirect,
+                         JsonResponse)
 from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.datastructures import MultiValueDictKeyError
 from django.utils.decorators import method_decorator
 from django.utils.module_loading import import_string
@@ -26,32 +27,28 @@ from django.views.decorators.http import require_http_methods
 from django.views.decorators.cache import never_cache
 from django.shortcuts import render_to_response
 from saml2 import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
-from saml2.authn_context import (PASSWORD,
-                                 AuthnBroker,
-                                 authn_context_class_ref)
-
-from saml2.assertion import Policy
-from saml2.config import IdPConfig
-from saml2.ident import NameID
-from saml2.metadata import entity_descriptor
 from saml2.s_utils import (UnknownPrincipal,
                            UnsupportedBinding,
                            UnknownSystemEntity)
-from saml2.saml import NAMEID_FORMAT_UNSPECIFIED
-from saml2.response import (IncorrectlySigned,)
-from six import text_type
 
+from . authn_request import ParsedAuthnRequest, get_authn_request
 from . decorators import (_not_valid_saml_msg,
                           store_params_in_session_func,
                           require_saml_request)
 from . exceptions import MetadataNotFound, MetadataCorruption
+from . federation import auto_federate
 from . forms import AgreementForm, LoginForm
+from . idp_metadata import idp_metadata_cache
 from . models import AgreementRecord, ServiceProvider
-from . processors import BaseProcessor
+from . prefetch import sp_prefetcher
+from . profiles import get_sp_profile
 from . utils import (repr_saml,
                      get_idp_config,
                      get_idp_sp_config,
-                     get_client_id)
+                     get_client_id,
+                     idp_server_cache)
+from . verification import verify_request_signature
+from . warmup import warmup_state
 
 
 # already registered into decorators
@@ -68,13 +65,22 @@ def sso_entry(request, binding):
     """
     # decoratos do the most
     logger.info("SSO req from client {}".format(get_client_id(request)))
+    # the SP profile is compiled while the user is on the login form
+    authn_request = ParsedAuthnRequest.from_session(request)
+    if authn_request is not None:
+        sp_prefetcher.prefetch(get_idp_config(settings.SAML_IDP_CONFIG),
+                               authn_request.issuer)
     return HttpResponseRedirect(reverse('uniauth:saml_login_process'))
 
 
 class ErrorHandler(object):
-    error_view = import_string(getattr(settings,
-                                       'SAML_IDP_ERROR_VIEW_CLASS',
-                                       'uniauth.error_views.SamlIDPErrorView'))
+
+    @property
+    def error_view(self):
+        # resolved when an error happens, not at import time
+        return import_string(getattr(settings,
+                                     'SAML_IDP_ERROR_VIEW_CLASS',
+                                     'uniauth.error_views.SamlIDPErrorView'))
 
     def handle_error(self, request, **kwargs):
         logger.error(kwargs)
@@ -100,38 +106,29 @@ class IdPHandlerViewMixin(ErrorHandler):
             the given entity id cannot be found.
         """
         self.sp = {'id': sp_entity_id}
-        try:
-            self.sp['config'] = get_idp_sp_config()[sp_entity_id]
-        except KeyError:
+        self.profile = get_sp_profile(self.IDP, sp_entity_id)
+        if self.profile is None:
             msg = _("No config for SP {} was defined in SAML_IDP_SPCONFIG").format(sp_entity_id)
             raise ImproperlyConfigured(msg)
+        self.sp['config'] = self.profile.config
 
     def set_processor(self):
         """ Instantiate user-specified processor or
             default to an all-access base processor.
             Raises an exception if the configured processor
             class can not be found or initialized.
+            The class is resolved once, see uniauth.profiles
         """
-        processor_string = self.sp['config'].get('processor', None)
-        if processor_string:
-            try:
-                self.processor = import_string(processor_string)(self.sp['id'])
-                return
-            except Exception as e:
-                msg = _("Failed to instantiate processor: {} - {}")
-                logger.error(msg.format(processor_string,e),
-                                        exc_info=True)
-                raise ImproperlyConfigured(_(msg.format(processor_string, e),
-                                                        exc_info=True))
-        self.processor = BaseProcessor(self.sp['id'])
+        self.processor = self.profile.get_processor()
 
     def verify_request_signature(self, req_info):
         """ Signature verification
             for authn request signature_check is at
             saml2.sigver.SecurityContext.correctly_signed_authn_request
+            outcomes are cached, see uniauth.verification
         """
         # TODO: Add unit tests for this
-        if not req_info.signature_check(req_info.xmlstr):
+        if not verify_request_signature(self.IDP, req_info):
             raise ValueError(_("Message signature verification failure"))
 
     def check_access(self, request):
@@ -141,10 +138,11 @@ class IdPHandlerViewMixin(ErrorHandler):
             raise PermissionDenied(_("You do not have access to this resource"))
 
     def get_authn(self, req_info=None):
-        if req_info:
-            req_authn_context = req_info.message.requested_authn_context
-        else:
-             req_authn_context = PASSWORD
+        if not req_info:
+            return self.profile.get_authn()
+        from saml2.authn_context import AuthnBroker, authn_context_class_ref
+
+        req_authn_context = req_info.message.requested_authn_context
         broker = AuthnBroker()
         broker.add(authn_context_class_ref(req_authn_context), "")
         return broker.get_authn_by_accr(req_authn_context)
@@ -152,31 +150,17 @@ class IdPHandlerViewMixin(ErrorHandler):
     def build_authn_response(self, user, authn, resp_args):
         """ pysaml2 server.Server.create_authn_response wrapper
         """
-        self.sp['name_id_format'] = resp_args.get('name_id_policy').format
-        idp_name_id_format_list = self.IDP.config.getattr("name_id_format",
-                                                          "idp")
-
+        name_id_policy = resp_args.get('name_id_policy')
+        self.sp['name_id_format'] = getattr(name_id_policy, 'format', None)
         # name_id format availability
-        if idp_name_id_format_list and not self.sp['name_id_format']:
-            name_id_format = idp_name_id_format_list[0]
-
-        elif self.sp['name_id_format'] and not idp_name_id_format_list:
-            name_id_format = self.sp['name_id_format']
-
-        elif self.sp['name_id_format'] not in idp_name_id_format_list:
-            return self.handle_error(request,
-                                     exception=_('SP requested a name_id_format '
-                                                 'that is not supported in the IDP'))
-        elif self.sp['name_id_format'] in idp_name_id_format_list:
-            name_id_format = self.sp['name_id_format']
-
-        else:
-            name_id_format = NAMEID_FORMAT_UNSPECIFIED
+        name_id_format = self.profile.name_id_format(self.sp['name_id_format'])
 
         # if SP doesn't request a specific name_id_format...
         if not self.sp['name_id_format']:
             self.sp['name_id_format'] = name_id_format
 
+        from saml2.ident import NameID
+
         user_id = self.processor.get_user_id(user, self.sp, self.IDP.config)
         name_id = NameID(format=name_id_format,
                          sp_name_qualifier=self.sp['id'],
@@ -185,8 +169,7 @@ class IdPHandlerViewMixin(ErrorHandler):
         #user_attrs = self.processor.create_identity(user, self.sp)
 
         # Generate request session stuff needed for user agreement screen
-        attrs_to_exclude = self.sp['config'].get('user_agreement_attr_exclude', []) + \
-                           getattr(settings, "SAML_IDP_USER_AGREEMENT_ATTR_EXCLUDE", [])
+        attrs_to_exclude = self.profile.attrs_to_exclude
 
         self.request.session['identity'] = {
             k: v
@@ -196,19 +179,6 @@ class IdPHandlerViewMixin(ErrorHandler):
         }
 
 
-        # ASSERTION ENCRYPTED
-        encrypt_response = getattr(settings,
-                                   'SAML_ENCRYPT_AUTHN_RESPONSE',
-                                   False)
-        if 'encrypt_saml_responses' in self.sp['config'].keys():
-            encrypt_response = self.sp['config'].get('encrypt_saml_responses')
-
-        encrypt_advice_attributes = getattr(settings,
-                                            'SAML_ENCRYPT_ADV_ATTRIBUTES',
-                                             False)
-        if 'encrypt_advice_attributes' in self.sp['config'].keys():
-            encrypt_advice_attributes = self.sp['config'].get('encrypt_advice_attributes')
-
         authn_resp = self.IDP.create_authn_response(
             authn=authn,
             identity=self.request.session['identity'],
@@ -216,31 +186,24 @@ class IdPHandlerViewMixin(ErrorHandler):
             name_id=name_id,
 
             # signature
-            sign_response=self.sp['config'].get("sign_response") or \
-                          self.IDP.config.getattr("sign_response", "idp") or \
-                          False,
-            sign_assertion=self.sp['config'].get("sign_assertion") or \
-                           self.IDP.config.getattr("sign_assertion", "idp") or \
-                           False,
+            sign_response=self.profile.sign_response,
+            sign_assertion=self.profile.sign_assertion,
 
             # default will be sha1 in pySAML2
-            sign_alg=self.sp['config'].get("signing_algorithm") or \
-                     getattr(settings, 'SAML_AUTHN_SIGN_ALG', False),
-            digest_alg=self.sp['config'].get("digest_algorithm") or \
-                       getattr(settings, 'SAML_AUTHN_DIGEST_ALG', False),
+            sign_alg=self.profile.sign_alg,
+            digest_alg=self.profile.digest_alg,
 
             # Encryption
-            encrypt_assertion=encrypt_response,
-            encrypt_advice_attributes=encrypt_advice_attributes,
+            encrypt_assertion=self.profile.encrypt_assertion,
+            encrypt_advice_attributes=self.profile.encrypt_advice_attributes,
+            encrypt_cert_assertion=self.profile.encrypt_cert if \
+                                   self.profile.encrypt_assertion else None,
             **resp_args
         )
 
         # entity categories and other pysaml2 policies could filter out some attributes
-        policy = Policy(restrictions=settings.SAML_IDP_CONFIG['service']['idp'].get('policy'))
-        ava = policy.filter(self.request.session['identity'],
-                            self.sp['id'],
-                            self.IDP.config.metadata,
-                            required=[])
+        # evaluated once per SP, see uniauth.policy
+        ava = self.profile.policy.filter(self.request.session['identity'])
 
         # talking logs
         self.request.session['authn_log'] = ('SSO AuthnResponse to {} [{}]:'
@@ -342,7 +305,8 @@ class LoginAuthView(LoginView):
     def dispatch(self, request, *args, **kwargs):
         """ Check if the SP is in metadata and have required attr mapping
         """
-        binding = request.session.get('Binding', BINDING_HTTP_POST)
+        # saml2.response loads the whole pysaml2 stack, not needed at startup
+        from saml2.response import IncorrectlySigned
 
         # Check if SP is federated
         try:
@@ -369,10 +333,15 @@ class LoginAuthView(LoginView):
                                        status=403)
 
         try:
-            req_info = IDP.parse_authn_request(request.session['SAMLRequest'],
-                                               binding)
+            authn_request = get_authn_request(request, IDP)
             # later we'll check if the authnrequest is older then the IDP session age
-            request.session['issue_instant'] = req_info.message.issue_instant
+            request.session['issue_instant'] = authn_request.issue_instant
+        except UnknownSystemEntity as exp:
+            return render_to_response('error.html',
+                                      {'exception_type': exp,
+                                       'exception_msg': _("This SP is not federated"),
+                                       'extra_message': _('Metadata is missing')},
+                                       status=403)
         except IncorrectlySigned as exp:
             return render_to_response('error.html',
                                       {'exception_type': exp,
@@ -386,15 +355,9 @@ class LoginAuthView(LoginView):
                                       {'exception_type': exp},
                                        status=403)
 
-        try:
-            resp_args = IDP.response_args(req_info.message)
-        except UnknownSystemEntity as exp:
-            return render_to_response('error.html',
-                                      {'exception_type': exp,
-                                       'exception_msg': _("This SP is not federated"),
-                                       'extra_message': _('Metadata is missing')},
-                                       status=403)
-        if resp_args.get('sp_entity_id') not in get_idp_sp_config().keys():
+        resp_args = authn_request.resp_args
+        if resp_args.get('sp_entity_id') not in get_idp_sp_config() and \
+           not auto_federate(IDP, resp_args.get('sp_entity_id')):
             return render_to_response('error.html',
                                       {'exception_type': _("This SP is not federated yet"),
                                        'exception_msg': _("Attribute Processor needs "
@@ -462,18 +425,22 @@ class LoginProcessView(LoginRequiredMixin, IdPHandlerViewMixin, View):
     """
 
     def get(self, request, *args, **kwargs):
-        binding = request.session.get('Binding', BINDING_HTTP_POST)
         try:
-            # Parse incoming request
-            req_info = self.IDP.parse_authn_request(request.session['SAMLRequest'],
-                                                    binding)
+            # AuthnRequest parsed in sso_entry
+            authn_request = get_authn_request(request, self.IDP)
             # check SAML request signature
-            self.verify_request_signature(req_info)
+            if not authn_request.verified:
+                raise ValueError(_("Message signature verification failure"))
 
             # Compile Response Arguments
-            self.resp_args = self.IDP.response_args(req_info.message)
+            self.resp_args = authn_request.resp_args
             # Set SP and Processor
             self.set_sp(self.resp_args['sp_entity_id'])
+            # SP metadata could have changed since sso_entry
+            if not self.profile.has_endpoint(self.resp_args['binding'],
+                                             self.resp_args['destination']):
+                raise UnsupportedBinding(_("{} is not an AssertionConsumerService "
+                                           "of this SP").format(self.resp_args['destination']))
             self.set_processor()
             # Check if user has access
             self.check_access(request)
@@ -536,9 +503,10 @@ class SSOInitView(LoginRequiredMixin, IdPHandlerViewMixin, View):
         except PermissionDenied as excp:
             return self.handle_error(request, exception=excp, status=403)
 
-        binding_out, destination = self.IDP.pick_binding(
-            service="assertion_consumer_service",
-            entity_id=self.sp['id'])
+        try:
+            binding_out, destination = self.profile.pick_endpoint()
+        except UnsupportedBinding as excp:
+            return self.handle_error(request, exception=excp, status=400)
 
         # ##Adding a few things that would have been added
         # if this were SP Initiated
@@ -743,13 +711,33 @@ def get_metadata(request):
 
 
 @never_cache
+def ready(request):
+    """ Readiness probe: 200 when the warm-up is completed
+        (or disabled and the IdP Server is already built), otherwise 503
+    """
+    state = dict(warmup_state)
+    if state['enabled']:
+        is_ready = state['done']
+    else:
+        is_ready = idp_server_cache.server is not None
+    state['ready'] = is_ready
+    return JsonResponse(state, status=200 if is_ready else 503)
+
+
 def metadata(request):
     """ Returns an XML with the SAML 2.0 metadata for this Idp.
-        The metadata is constructed on-the-fly based on the
-        config dict in the django settings.
+        The metadata is constructed once per configuration version,
+        based on the config dict in the django settings, then served
+        with ETag and Last-Modified: pollers get a 304 if unchanged.
     """
-    conf = IdPConfig()
-    conf.load(copy.deepcopy(settings.SAML_IDP_CONFIG))
-    metadata = entity_descriptor(conf)
-    return HttpResponse(content=text_type(metadata).encode('utf-8'),
-                        content_type="text/xml; charset=utf8")
+    document = idp_metadata_cache.get()
+    response = get_conditional_response(request,
+                                         etag=document.etag,
+                                         last_modified=int(document.generated))
+    if response is None:
+        response = HttpResponse(content=document.content,
+                                content_type="text/xml; charset=utf8")
+    response['ETag'] = document.etag
+    response['Last-Modified'] = document.last_modified
+    patch_cache_control(response, public=True, max_age=document.max_age())
+    return response
@@ -0,0 +1,64 @@
+import gc
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.template.loader import get_template
+
+
+logger = logging.getLogger(__name__)
+
+WARMUP_TEMPLATES = ['saml_login.html',
+                    'saml_post.html',
+                    'user_agreement.html',
+                    'error.html']
+
+# state of the warm-up in this process, inherited by the forked workers
+warmup_state = {'enabled': False,
+                'done': False,
+                'started': None,
+                'duration': None,
+                'error': None}
+
+
+def warmup_running():
+    return warmup_state['enabled'] and warmup_state['duration'] is None
+
+
+def warm_up():
+    """ Loads up front what the first SSO requests would load:
+        IdP Server (metadata and attribute converters included),
+        SP registry and runtime profiles, templates.
+        Meant to run in the uwsgi master before fork, for this reason
+        it closes the DB connections and freezes the surviving objects
+        out of the garbage collector, to keep their pages shared
+        between the workers (copy-on-write).
+    """
+    from . profiles import get_sp_profile
+    from . registry import get_sp_registry
+    from . utils import get_idp_config
+
+    warmup_state['enabled'] = True
+    warmup_state['started'] = time.time()
+    try:
+        IDP = get_idp_config()
+        for entity_id in get_sp_registry():
+            get_sp_profile(IDP, entity_id)
+        for template in getattr(settings, 'SAML_IDP_WARMUP_TEMPLATES',
+                                WARMUP_TEMPLATES):
+            get_template(template)
+    except Exception as e:
+        warmup_state['error'] = '{}'.format(e)
+        logger.error('IdP warm-up failed: {}'.format(e))
+    finally:
+        # DB sockets must not be shared by the forked workers
+        connections.close_all()
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    warmup_state['duration'] = time.time() - warmup_state['started']
+    warmup_state['done'] = warmup_state['error'] is None
+    logger.info('IdP warm-up completed in {:.2f}s'.format(warmup_state['duration']))
+    return warmup_state['done']
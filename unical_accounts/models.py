@@ -1,11 +1,16 @@
-import pycountry
-
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 
+from django_idp.lazy_choices import LazyChoices
+
+
+def country_choices():
+    import pycountry
+    return [(i.name, i.name) for i in pycountry.countries]
+
 
 class User(AbstractUser):
     GENDER= (
@@ -27,7 +32,7 @@ class User(AbstractUser):
                                  max_length=12, blank=True, null=True)
     place_of_birth = models.CharField('Luogo di nascita', max_length=30,
                                       blank=True, null=True,
-                                      choices=[(i.name, i.name) for i in pycountry.countries])
+                                      choices=LazyChoices(country_choices))
     birth_date = models.DateField('Data di nascita',
                                   null=True, blank=True)
     persistent_id = models.CharField(_('SAML Persistent Stored ID'),